@@ -0,0 +1,130 @@
+import json
+import os
+import shlex
+
+import pytest
+
+from vedit import vedit
+
+
+# What the fake ffprobe reports for a video, unless a test says
+# otherwise.
+VIDEO_STREAM = { 'codec_type'          : 'video',
+                 'codec_name'          : 'h264',
+                 'profile'             : 'High',
+                 'level'               : 31,
+                 'extradata_hash'      : 'MD5:0123456789abcdef',
+                 'duration'            : '20.000000',
+                 'width'               : 1280,
+                 'height'              : 720,
+                 'sample_aspect_ratio' : '1:1',
+                 'pix_fmt'             : 'yuv420p',
+                 'r_frame_rate'        : '30000/1001' }
+
+AUDIO_STREAM = { 'codec_type'  : 'audio',
+                 'codec_name'  : 'aac',
+                 'duration'    : '20.000000',
+                 'channels'    : 2,
+                 'sample_rate' : '48000' }
+
+
+class FakeFFmpeg( object ):
+    '''Stands in for Window.run_command so renders can be run without
+    ffmpeg.
+
+    Each command is recorded in cmds as a list of arguments.  ffmpeg
+    commands write a small file at their output, the last argument,
+    and ffprobe commands report the streams of a file from
+    VIDEO_STREAM and AUDIO_STREAM, updated by streams[filename] and
+    audio_streams[filename], and its packets from packets[filename].  A command whose arguments
+    contain one of the strings in fail exits with status 1.
+    '''
+
+    def __init__( self ):
+        self.cmds = []
+        self.streams = {}
+        self.audio_streams = {}
+        self.packets = {}
+        self.fail = []
+
+    def __call__( self, cmd, timeout=None ):
+        if isinstance( cmd, list ):
+            argv = cmd
+        else:
+            argv = shlex.split( cmd )
+        self.cmds.append( argv )
+
+        for pattern in self.fail:
+            if pattern in " ".join( argv ):
+                return ( 1, "Failed on purpose." )
+
+        filename = argv[-1]
+        if os.path.basename( argv[0] ) == os.path.basename( vedit.FFPROBE ):
+            if 'packet=pts_time,flags' in argv:
+                return ( 0, json.dumps( { 'packets' : self.packets.get( filename, [] ) } ) )
+            video = dict( VIDEO_STREAM )
+            video.update( self.streams.get( filename, {} ) )
+            audio = dict( AUDIO_STREAM )
+            audio.update( self.audio_streams.get( filename, {} ) )
+            return ( 0, json.dumps( { 'streams' : [ video, audio ] } ) )
+
+        f = open( filename, 'w' )
+        f.write( 'x' * 100 )
+        f.close()
+        return ( 0, "" )
+
+    def ffmpeg_cmds( self ):
+        '''Returns the ffmpeg commands run, as strings.'''
+        return [ " ".join( argv ) for argv in self.cmds if os.path.basename( argv[0] ) == os.path.basename( vedit.FFMPEG ) ]
+
+
+@pytest.fixture
+def ffmpeg( tmp_path, monkeypatch ):
+    '''Gives each test its own tmpdir and Video metadata, and runs
+    its commands with a FakeFFmpeg, which is returned.'''
+    tmpdir = str( tmp_path / 'cache' )
+    os.makedirs( tmpdir )
+    monkeypatch.setattr( vedit.Window, 'tmpdir', tmpdir )
+    monkeypatch.setattr( vedit.Window, 'cache_size_limit', None )
+    monkeypatch.setattr( vedit.Window, 'content_fingerprints', False )
+    monkeypatch.setattr( vedit.Window, 'file_fingerprints', {} )
+    monkeypatch.setattr( vedit.Window, 'cache_renders', False )
+    monkeypatch.setattr( vedit.Window, 'intermediate_profile', vedit.DELIVERY )
+    monkeypatch.setattr( vedit.Window, 'max_concurrency', 2 )
+    monkeypatch.setattr( vedit.Window, 'render_farm', False )
+    monkeypatch.setattr( vedit.Window, 'cache_pins', set() )
+    monkeypatch.setattr( vedit.Window, 'cache_pin_holds', 0 )
+    monkeypatch.setattr( vedit.Video, 'videos', {} )
+
+    fake = FakeFFmpeg()
+    monkeypatch.setattr( vedit.Window, 'run_command', staticmethod( fake ) )
+
+    # Some commands, such as the probes of Video.probe_many, are run
+    # by FFmpegJob directly.
+    def run( job ):
+        ( job.status, job.output ) = fake( job.argv, timeout=job.timeout )
+        job.finished = True
+        job.elapsed = 0
+        return job
+    monkeypatch.setattr( vedit.FFmpegJob, 'run', run )
+
+    return fake
+
+
+@pytest.fixture
+def make_video( tmp_path, ffmpeg ):
+    '''Returns a function which creates a file with name in a media
+    directory, reported by ffprobe with the stream parameters in
+    kwargs, and returns a Video of it.'''
+    media = tmp_path / 'media'
+    media.mkdir()
+
+    def make( name, **kwargs ):
+        filename = str( media / name )
+        f = open( filename, 'w' )
+        f.write( name )
+        f.close()
+        ffmpeg.streams[filename] = kwargs
+        return vedit.Video( filename )
+
+    return make
@@ -0,0 +1,71 @@
+import pytest
+
+from vedit.vedit import Clip, Window
+
+
+@pytest.fixture
+def make_audio( tmp_path, ffmpeg ):
+    '''Returns a function which creates an audio file with name,
+    reported by ffprobe with the audio stream parameters in kwargs,
+    and returns its path.'''
+    def make( name, **kwargs ):
+        filename = str( tmp_path / name )
+        f = open( filename, 'w' )
+        f.write( name )
+        f.close()
+        ffmpeg.audio_streams[filename] = kwargs
+        return filename
+
+    return make
+
+
+def get_window( make_video, tmp_path, audio_file, **kwargs ):
+    a = make_video( 'a.mp4' )
+    child = Window( clips=[ Clip( a, 0, 6 ) ], width=320, height=180, x=10, y=10, **kwargs )
+    return Window( clips=[ Clip( a, 0, 5 ) ],
+                   windows=[ child ],
+                   audio_file=audio_file,
+                   output_file=str( tmp_path / 'output.mp4' ),
+                   **kwargs )
+
+
+def get_audio_cmds( ffmpeg ):
+    '''Returns the ffmpeg commands which mix in or normalize audio.'''
+    return [ cmd for cmd in ffmpeg.ffmpeg_cmds() if 'dynaudnorm' in cmd or 'afade' in cmd ]
+
+
+def test_audio_is_processed_without_reencoding_the_video( make_video, make_audio, tmp_path, ffmpeg ):
+    music = make_audio( 'music.m4a', duration='30.000000' )
+    get_window( make_video, tmp_path, music, audio_only_stages=True ).render()
+    cmds = get_audio_cmds( ffmpeg )
+    # The audio_file and the volume adjustment of the Window are done
+    # in one step, and the volume of the child Window is not adjusted.
+    assert len( cmds ) == 1
+    assert 'amix' in cmds[0] and 'dynaudnorm' in cmds[0]
+    assert ' -c:v copy ' in cmds[0]
+    assert 'libx264' not in cmds[0]
+    assert [ cmd for cmd in ffmpeg.ffmpeg_cmds() if ' -vf copy ' in cmd ] == []
+
+
+def test_volume_adjustment_alone_copies_the_video( make_video, tmp_path, ffmpeg ):
+    a = make_video( 'a.mp4' )
+    Window( clips=[ Clip( a, 0, 5 ) ], output_file=str( tmp_path / 'output.mp4' ), audio_only_stages=True ).render()
+    cmds = get_audio_cmds( ffmpeg )
+    assert len( cmds ) == 1
+    assert 'dynaudnorm' in cmds[0] and 'amix' not in cmds[0]
+    assert ' -c:v copy ' in cmds[0]
+
+
+def test_converted_audio_files_are_cached( make_video, make_audio, tmp_path, ffmpeg ):
+    music = make_audio( 'music.m4a', duration='30.000000', channels=1 )
+    get_window( make_video, tmp_path, music, audio_only_stages=True ).render()
+    converted = [ cmd for cmd in ffmpeg.ffmpeg_cmds() if cmd.startswith( 'ffmpeg -y -i %s -ac 2 ' % ( music ) ) ]
+    assert len( converted ) == 1
+
+    # The second render mixes in the cached conversion.
+    del ffmpeg.cmds[:]
+    get_window( make_video, tmp_path, music, audio_only_stages=True ).render()
+    assert [ cmd for cmd in ffmpeg.ffmpeg_cmds() if cmd.startswith( 'ffmpeg -y -i %s ' % ( music ) ) ] == []
+    cmds = get_audio_cmds( ffmpeg )
+    assert len( cmds ) == 1
+    assert cmds[0].split()[5].startswith( Window.tmpdir )
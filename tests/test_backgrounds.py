@@ -0,0 +1,41 @@
+from vedit.vedit import Window
+
+
+def segments( ffmpeg ):
+    '''Returns the ffmpeg commands which encoded background segments.'''
+    return [ cmd for cmd in ffmpeg.ffmpeg_cmds() if ',setpts=PTS-STARTPTS/TB' in cmd and '-g 1' in cmd ]
+
+
+def loops( ffmpeg ):
+    return [ cmd for cmd in ffmpeg.ffmpeg_cmds() if '-stream_loop -1' in cmd ]
+
+
+def test_long_backgrounds_loop_a_short_segment( tmp_path, ffmpeg ):
+    Window( duration=600, output_file=str( tmp_path / 'output.mp4' ) ).render()
+    ( segment, ) = segments( ffmpeg )
+    assert '-t %f' % ( Window.background_segment_duration ) in segment
+    ( loop, ) = loops( ffmpeg )
+    assert '-c:v copy' in loop and '-t 600.000000' in loop
+
+
+def test_background_segments_are_cached( tmp_path, ffmpeg ):
+    Window( duration=600, bgcolor='blue', output_file=str( tmp_path / 'a.mp4' ) ).render()
+    Window( duration=30, bgcolor='blue', output_file=str( tmp_path / 'b.mp4' ) ).render()
+    assert len( segments( ffmpeg ) ) == 1
+    assert len( loops( ffmpeg ) ) == 2
+
+    Window( duration=30, bgcolor='red', output_file=str( tmp_path / 'c.mp4' ) ).render()
+    assert len( segments( ffmpeg ) ) == 2
+
+
+def test_background_hashes( tmp_path, ffmpeg ):
+    image = str( tmp_path / 'image.png' )
+    open( image, 'w' ).write( 'an image' )
+    hashes = [ Window( **kwargs ).get_background_hash( 2, '' ) for kwargs in [ {}, { 'duration' : 30 }, { 'bgcolor' : 'red' }, { 'width' : 640 }, { 'bgimage_file' : image } ] ]
+    assert hashes[0] == hashes[1]
+    assert len( set( hashes ) ) == 4
+    assert Window().get_background_hash( 1, '' ) != hashes[0]
+
+    # Images are identified by their contents.
+    open( image, 'w' ).write( 'another image' )
+    assert Window( bgimage_file=image ).get_background_hash( 2, '' ) != hashes[4]
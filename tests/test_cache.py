@@ -0,0 +1,148 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from vedit.vedit import Video, Window
+
+
+def cache_file( name, size=100 ):
+    filename = os.path.join( Window.tmpdir, name )
+    f = open( filename, 'w' )
+    f.write( 'x' * size )
+    f.close()
+    return filename
+
+
+def add( key, size=100 ):
+    filename = cache_file( key + '.mp4', size )
+    Window.add_cache_entry( key, filename )
+    # Keep the order of last_access unambiguous.
+    time.sleep( 0.01 )
+    return filename
+
+
+def test_hits_and_misses( ffmpeg ):
+    filename = add( 'a' )
+    assert Window.get_cache_entry( 'a' ) == filename
+    assert Window.get_cache_entry( 'b' ) is None
+    stats = Window.get_cache_stats()
+    assert ( stats['entries'], stats['bytes'], stats['hits'], stats['misses'] ) == ( 1, 100, 1, 1 )
+
+
+def test_peek_leaves_the_cache_as_it_was( ffmpeg ):
+    filename = add( 'a' )
+    assert Window.get_cache_entry( 'a', peek=True ) == filename
+    assert Window.get_cache_entry( 'b', peek=True ) is None
+
+    # Peeks only answer from the cache index.
+    published = cache_file( 'c.mp4' )
+    assert Window.get_cache_entry( 'c', peek=True, filename=published ) is None
+
+    stats = Window.get_cache_stats()
+    assert ( stats['entries'], stats['hits'], stats['misses'] ) == ( 1, 0, 0 )
+
+
+def test_files_published_without_an_entry_are_found( ffmpeg ):
+    published = cache_file( 'c.mp4' )
+    assert Window.get_cache_entry( 'c', filename=published ) == published
+    assert Window.get_cache_entry( 'c' ) == published
+
+
+def test_entries_whose_file_is_gone_are_misses( ffmpeg ):
+    filename = add( 'a' )
+    os.remove( filename )
+    assert Window.get_cache_entry( 'a' ) is None
+    assert Window.get_cache_stats()['entries'] == 0
+
+
+def test_the_least_recently_used_files_are_evicted( ffmpeg, monkeypatch ):
+    a = add( 'a' )
+    b = add( 'b' )
+    c = add( 'c' )
+    Window.get_cache_entry( 'a' )
+
+    assert Window.evict_cache( cache_size_limit=200 ) == 1
+    assert os.path.exists( a ) and not os.path.exists( b ) and os.path.exists( c )
+
+    # Adding beyond the cache_size_limit evicts, but not what was
+    # just added.
+    monkeypatch.setattr( Window, 'cache_size_limit', 150 )
+    d = add( 'd' )
+    assert os.path.exists( d )
+    assert not os.path.exists( c ) and not os.path.exists( a )
+
+    stats = Window.get_cache_stats()
+    assert ( stats['entries'], stats['evictions'], stats['evicted_bytes'] ) == ( 1, 3, 300 )
+
+
+def test_files_used_by_renders_in_progress_are_not_evicted( ffmpeg ):
+    a = add( 'a' )
+    b = add( 'b' )
+    Window.hold_cache_pins()
+    Window.get_cache_entry( 'a' )
+    c = add( 'c' )
+
+    assert Window.evict_cache( cache_size_limit=0 ) == 1
+    assert os.path.exists( a ) and not os.path.exists( b ) and os.path.exists( c )
+
+    Window.release_cache_pins()
+    assert Window.evict_cache( cache_size_limit=0 ) == 2
+    assert not os.path.exists( a ) and not os.path.exists( c )
+
+
+def test_eviction_forgets_the_metadata_of_evicted_files( ffmpeg ):
+    a = add( 'a' )
+    Video( a )
+    assert a in Video.videos
+    Window.evict_cache( cache_size_limit=0 )
+    assert a not in Video.videos
+
+
+def test_clear_cache_empties_the_tmpdir_and_databases( ffmpeg ):
+    a = add( 'a' )
+    Video( a )
+    Window.get_cache_entry( 'a' )
+    os.makedirs( os.path.join( Window.tmpdir, 'farm', 'queued' ) )
+
+    Window.clear_cache()
+
+    assert [ name for name in os.listdir( Window.tmpdir ) if not ( name.startswith( Window.cache_db_file ) or name.startswith( Video.metadata_db_file ) ) ] == []
+    assert Window.get_cache_entry( 'a', peek=True ) is None
+    stats = Window.get_cache_stats()
+    assert ( stats['entries'], stats['hits'] ) == ( 0, 0 )
+    assert Video.videos == {}
+
+    # The databases are still usable.
+    b = add( 'b' )
+    assert Window.get_cache_entry( 'b' ) == b
+
+
+def test_entries_added_at_once_are_all_kept( ffmpeg ):
+    filenames = [ cache_file( '%d.mp4' % ( idx ) ) for idx in range( 20 ) ]
+    threads = [ threading.Thread( target=Window.add_cache_entry, args=( str( idx ), filename ) ) for ( idx, filename ) in enumerate( filenames ) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [ Window.get_cache_entry( str( idx ), peek=True ) for idx in range( 20 ) ] == filenames
+
+
+def test_entries_are_shared_with_other_programs( ffmpeg ):
+    filename = add( 'a' )
+    code = "from vedit.vedit import Window; Window.tmpdir = %r; print( Window.get_cache_entry( 'a', peek=True ) )" % ( Window.tmpdir )
+    output = subprocess.check_output( [ sys.executable, '-c', code ], cwd=os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+    assert output.decode( 'utf-8' ).strip() == filename
+
+
+def test_json_cache_indices_are_imported( ffmpeg ):
+    filename = cache_file( 'a.mp4' )
+    cache_dict_file = os.path.join( Window.tmpdir, Window.cache_dict_file )
+    f = open( cache_dict_file, 'w' )
+    json.dump( { 'a' : filename }, f )
+    f.close()
+
+    assert Window.get_cache_entry( 'a' ) == filename
+    assert not os.path.exists( cache_dict_file )
@@ -0,0 +1,145 @@
+import os
+import shutil
+
+from vedit import vedit
+from vedit.vedit import Clip, Display, OVERLAY, Watermark, Window
+
+
+def test_clip_hashes_are_stable( make_video ):
+    video = make_video( 'a.mp4' )
+    window = Window( clips=[ Clip( video, 1, 5 ) ] )
+    assert window.get_clip_hash( Clip( video, 1, 5 ), 640, 360 ) == Window( clips=[ Clip( video, 1, 5 ) ] ).get_clip_hash( Clip( video, 1, 5 ), 640, 360 )
+
+
+def test_clip_hashes_change_with_what_is_rendered( make_video, monkeypatch ):
+    video = make_video( 'a.mp4' )
+    clip = Clip( video, 1, 5 )
+    window = Window( clips=[ clip ] )
+    key = window.get_clip_hash( clip, 640, 360 )
+
+    others = [ window.get_clip_hash( Clip( video, 1, 6 ), 640, 360 ),
+               window.get_clip_hash( clip, 320, 360 ),
+               window.get_clip_hash( clip, 640, 360, include_audio=False ),
+               window.get_clip_hash( clip, 640, 360, smart_cut=True ) ]
+
+    monkeypatch.setattr( Window, 'intermediate_profile', vedit.FFV1 )
+    others.append( window.get_clip_hash( clip, 640, 360 ) )
+
+    assert len( set( [ key ] + others ) ) == 1 + len( others )
+
+
+def test_clip_hashes_change_with_the_video_file( make_video ):
+    video = make_video( 'a.mp4' )
+    clip = Clip( video, 1, 5 )
+    window = Window( clips=[ clip ] )
+    key = window.get_clip_hash( clip, 640, 360 )
+
+    f = open( video.filename, 'a' )
+    f.write( 'more' )
+    f.close()
+    assert window.get_clip_hash( clip, 640, 360 ) != key
+
+
+def test_content_fingerprints_follow_the_contents_not_the_path( make_video, monkeypatch ):
+    monkeypatch.setattr( Window, 'content_fingerprints', True )
+    video = make_video( 'a.mp4' )
+    copy = os.path.join( os.path.dirname( video.filename ), 'copy.mp4' )
+    shutil.copy( video.filename, copy )
+    os.utime( copy, ( 0, 0 ) )
+    other = make_video( 'b.mp4' )
+
+    window = Window( clips=[ Clip( video ) ] )
+    key = window.get_clip_hash( Clip( video, 1, 5 ), 640, 360 )
+    assert window.get_clip_hash( Clip( vedit.Video( copy ), 1, 5 ), 640, 360 ) == key
+    assert window.get_clip_hash( Clip( other, 1, 5 ), 640, 360 ) != key
+
+
+def test_file_fingerprints_are_computed_once_per_version_of_a_file( make_video, monkeypatch ):
+    monkeypatch.setattr( Window, 'content_fingerprints', True )
+    video = make_video( 'a.mp4' )
+    computed = []
+    compute_fingerprint = vedit.Video.compute_fingerprint
+    def record( filename ):
+        computed.append( filename )
+        return compute_fingerprint( filename )
+    monkeypatch.setattr( vedit.Video, 'compute_fingerprint', staticmethod( record ) )
+
+    key = Window.get_file_key( video.filename )
+    assert Window.get_file_key( video.filename ) == key
+    assert len( computed ) == 1
+
+    f = open( video.filename, 'a' )
+    f.write( 'more' )
+    f.close()
+    assert Window.get_file_key( video.filename ) != key
+    assert len( computed ) == 2
+
+
+def tree( video, child_clip_end=5, **kwargs ):
+    child = Window( clips=[ Clip( video, 0, child_clip_end ) ], width=320, height=180, x=10, y=10 )
+    return Window( clips=[ Clip( video, 0, 10 ) ], windows=[ child ], **kwargs )
+
+
+def test_render_hashes_match_for_identical_trees( make_video ):
+    video = make_video( 'a.mp4' )
+    assert tree( video ).get_render_hash( 2 ) == tree( video ).get_render_hash( 2 )
+
+
+def test_render_hashes_change_with_the_tree( make_video ):
+    video = make_video( 'a.mp4' )
+    key = tree( video ).get_render_hash( 2 )
+    others = [ tree( video ).get_render_hash( 1 ),
+               tree( video, child_clip_end=6 ).get_render_hash( 2 ),
+               tree( video, bgcolor='White' ).get_render_hash( 2 ),
+               tree( video, watermarks=[ Watermark( bgcolor='red', width=10, height=10 ) ] ).get_render_hash( 2 ),
+               tree( video, pipe_stages=True ).get_render_hash( 2 ),
+               tree( video, overlay_batch_concurrency=4 ).get_render_hash( 2 ) ]
+    assert key is not None
+    assert len( set( [ key ] + others ) ) == 1 + len( others )
+
+
+def test_render_hashes_leave_child_windows_alone( make_video ):
+    video = make_video( 'a.mp4' )
+    window = tree( video )
+    child = window.windows[0]
+    window.get_render_hash( 2 )
+    assert ( child.duration, child.sample_aspect_ratio, child.pix_fmt ) == ( None, None, None )
+
+
+def test_render_hashes_of_final_renders( make_video, monkeypatch ):
+    video = make_video( 'a.mp4' )
+    # Intermediate renders in the DELIVERY profile are the same as
+    # final ones.
+    assert tree( video ).get_render_hash( 2, final=True ) == tree( video ).get_render_hash( 2 )
+    monkeypatch.setattr( Window, 'intermediate_profile', vedit.FFV1 )
+    assert tree( video ).get_render_hash( 2, final=True ) != tree( video ).get_render_hash( 2 )
+
+
+def test_render_hashes_need_a_seed_for_overlay_clips( make_video ):
+    video = make_video( 'a.mp4' )
+    overlay = Display( display_style=OVERLAY )
+
+    child = Window( clips=[ Clip( video, 0, 5, display=overlay ) ], width=320, height=180 )
+    assert child.get_render_hash( 2 ) is None
+    assert Window( clips=[ Clip( video, 0, 10 ) ], windows=[ child ] ).get_render_hash( 2 ) is None
+
+    seeded = Window( clips=[ Clip( video, 0, 5, display=overlay ) ], width=320, height=180, seed=1 )
+    assert seeded.get_render_hash( 2 ) is not None
+    reseeded = Window( clips=[ Clip( video, 0, 5, display=overlay ) ], width=320, height=180, seed=2 )
+    assert reseeded.get_render_hash( 2 ) != seeded.get_render_hash( 2 )
+
+
+def test_watermark_layer_hashes( ffmpeg ):
+    def layer_hash( width=1280, duration=10, **kwargs ):
+        watermark = dict( bgcolor='red', width=20, height=20, x=5, y=5 )
+        watermark.update( kwargs )
+        return Window( width=width, duration=duration, watermarks=[ Watermark( **watermark ) ] ).get_watermark_layer_hash()
+
+    key = layer_hash()
+    assert layer_hash() == key
+    others = [ layer_hash( width=640 ),
+               layer_hash( duration=11 ),
+               layer_hash( x=6 ),
+               layer_hash( bgcolor='blue' ),
+               layer_hash( fade_in_start=1, fade_in_duration=2 ) ]
+    assert len( set( [ key ] + others ) ) == 1 + len( others )
@@ -0,0 +1,158 @@
+import pytest
+
+from vedit.vedit import Clip, Display, OVERLAY, PAD, Video, Window
+
+
+def get_window( **kwargs ):
+    window = Window( smart_cut=True, **kwargs )
+    window.pix_fmt = 'yuv420p'
+    return window
+
+
+def keyframes( ffmpeg, video, times ):
+    ffmpeg.packets[video.filename] = [ { 'pts_time' : '%f' % ( time ), 'flags' : 'K_' } for time in times ]
+
+
+def smart_cut( window, clip ):
+    return window.get_smart_cut_cmds( clip, window.get_display( clip ), 2, 'clip.mp4' )
+
+
+def test_clips_are_smart_cut_between_keyframes( make_video, ffmpeg ):
+    video = make_video( 'a.mp4' )
+    keyframes( ffmpeg, video, [ 0, 2, 4, 6, 8 ] )
+    window = get_window()
+
+    cut = smart_cut( window, Clip( video, 1, 7 ) )
+    assert len( cut['cmds'] ) == 3
+    ( head, middle, tail ) = [ " ".join( cmd ) for cmd in cut['cmds'] ]
+    assert '-ss 1.000000' in head and '-t 1.000000' in head and '-profile:v high -level 31' in head
+    assert '-ss 2.000000' in middle and '-c:v copy' in middle and '-t 4.000000' in middle
+    assert '-ss 6.000000' in tail and '-t 1.000000' in tail
+    assert cut['join_cmds'][-1][-1] == 'clip.mp4'
+
+
+def test_clips_starting_on_a_keyframe_have_no_head( make_video, ffmpeg ):
+    video = make_video( 'a.mp4' )
+    keyframes( ffmpeg, video, [ 0, 2, 4, 6, 8 ] )
+    cut = smart_cut( get_window(), Clip( video, 2, 8 ) )
+    assert len( cut['cmds'] ) == 1
+    assert '-c:v copy' in " ".join( cut['cmds'][0] )
+
+
+@pytest.mark.parametrize( 'params', [ { 'width' : 640 },
+                                      { 'pix_fmt' : 'yuv422p' },
+                                      { 'r_frame_rate' : '25/1' },
+                                      { 'codec_name' : 'hevc' },
+                                      { 'profile' : 'High 4:4:4 Intra' },
+                                      { 'level' : -99 } ] )
+def test_clips_which_would_be_converted_are_not_smart_cut( make_video, ffmpeg, params ):
+    video = make_video( 'a.mp4', **params )
+    keyframes( ffmpeg, video, [ 0, 2, 4, 6, 8 ] )
+    assert smart_cut( get_window(), Clip( video, 1, 7 ) ) is None
+
+
+def test_overlay_clips_of_another_size_are_smart_cut( make_video, ffmpeg ):
+    video = make_video( 'a.mp4', width=640 )
+    keyframes( ffmpeg, video, [ 0, 2, 4, 6, 8 ] )
+    assert smart_cut( get_window(), Clip( video, 1, 7, display=Display( display_style=OVERLAY ) ) ) is not None
+
+
+def test_clips_with_too_few_keyframes_are_not_smart_cut( make_video, ffmpeg ):
+    video = make_video( 'a.mp4' )
+    keyframes( ffmpeg, video, [ 0, 4, 8 ] )
+    assert smart_cut( get_window(), Clip( video, 1, 7 ) ) is None
+
+
+def transcodes( cmds, video ):
+    '''Returns the commands which transcode the video of all of
+    Clip( video, 1, 7 ).'''
+    return [ cmd for cmd in cmds if ( '-ss 1.000000 -i %s' % ( video.filename ) ) in cmd and '-pix_fmt' in cmd and '-t 6.000000' in cmd ]
+
+
+class PieceStreams( dict ):
+    '''Streams for FakeFFmpeg which give each file not otherwise listed,
+    such as each piece of a smart cut, its own value of param.'''
+
+    def __init__( self, streams, param ):
+        dict.__init__( self, streams )
+        self.param = param
+
+    def get( self, filename, default=None ):
+        if filename in self:
+            return self[filename]
+        return { self.param : 'piece:%s' % ( filename ) }
+
+
+def render( video, tmp_path, **kwargs ):
+    Window( clips=[ Clip( video, 1, 7 ) ], smart_cut=True, output_file=str( tmp_path / 'output.mp4' ), display=Display( display_style=PAD ), **kwargs ).render()
+
+
+def test_smart_cuts_fall_back_to_transcoding_when_pieces_differ( make_video, ffmpeg, tmp_path ):
+    video = make_video( 'a.mp4' )
+    keyframes( ffmpeg, video, [ 0, 2, 4, 6, 8 ] )
+    ffmpeg.streams = PieceStreams( ffmpeg.streams, 'profile' )
+
+    render( video, tmp_path )
+    cmds = ffmpeg.ffmpeg_cmds()
+    assert len( [ cmd for cmd in cmds if '-c:v copy -bsf:v dump_extra' in cmd ] ) == 1
+    assert len( transcodes( cmds, video ) ) == 1
+
+
+def test_smart_cut_pieces_with_their_own_parameter_sets_are_joined( make_video, ffmpeg, tmp_path ):
+    video = make_video( 'a.mp4' )
+    keyframes( ffmpeg, video, [ 0, 2, 4, 6, 8 ] )
+    ffmpeg.streams = PieceStreams( ffmpeg.streams, 'extradata_hash' )
+
+    render( video, tmp_path )
+    cmds = ffmpeg.ffmpeg_cmds()
+    assert len( [ cmd for cmd in cmds if '-c:v copy -bsf:v dump_extra' in cmd ] ) == 1
+    assert len( transcodes( cmds, video ) ) == 0
+
+
+def test_smart_cuts_are_used_when_pieces_match( make_video, ffmpeg, tmp_path ):
+    video = make_video( 'a.mp4' )
+    keyframes( ffmpeg, video, [ 0, 2, 4, 6, 8 ] )
+    render( video, tmp_path )
+    cmds = ffmpeg.ffmpeg_cmds()
+    assert len( [ cmd for cmd in cmds if '-c:v copy -bsf:v dump_extra' in cmd ] ) == 1
+    assert len( transcodes( cmds, video ) ) == 0
+
+
+@pytest.mark.parametrize( 'params, expected', [ ( {}, True ),
+                                                ( { 'profile' : 'Main' }, False ),
+                                                ( { 'level' : 40 }, False ),
+                                                ( { 'extradata_hash' : 'MD5:fedcba9876543210' }, False ),
+                                                ( { 'sample_aspect_ratio' : '4:3' }, False ) ] )
+def test_can_stream_copy( make_video, ffmpeg, params, expected ):
+    a = make_video( 'a.mp4' )
+    b = make_video( 'b.mp4', **params )
+    assert get_window().can_stream_copy( [ a.filename, b.filename ] ) == expected
+
+
+def test_rendered_clips_are_not_remembered_as_videos( make_video, ffmpeg, tmp_path ):
+    a = make_video( 'a.mp4' )
+    b = make_video( 'b.mp4' )
+    Window( clips=[ Clip( a, 0, 5 ), Clip( b, 0, 5 ) ], output_file=str( tmp_path / 'output.mp4' ) ).render()
+    assert sorted( Video.videos ) == [ a.filename, b.filename ]
+
+
+def test_clips_without_audio_are_given_silence( make_video, ffmpeg ):
+    video = make_video( 'a.mp4' )
+    video.channels = None
+    window = Window( clips=[ Clip( video, 0, 5 ) ] )
+    window.resolve_render_settings()
+    ( cmd, ) = window.get_clip_job( window.clips[0], 2 )['cmds']
+    assert 'aevalsrc=0' in cmd
+    assert '[1:a] afifo' in " ".join( cmd )
+
+
+def test_filenames_are_passed_as_single_arguments( make_video, ffmpeg, tmp_path ):
+    video = make_video( "it's a clip.mp4" )
+    overlay = make_video( 'an "overlay".mp4' )
+    keyframes( ffmpeg, video, [ 0, 2, 4, 6, 8 ] )
+    Window( clips=[ Clip( video, 1, 7 ), Clip( overlay, 0, 2, display=Display( display_style=OVERLAY ) ) ],
+            smart_cut=True, output_file=str( tmp_path / 'output.mp4' ), display=Display( display_style=PAD ) ).render()
+
+    for filename in ( video.filename, overlay.filename ):
+        assert len( [ argv for argv in ffmpeg.cmds if filename in argv ] ) > 0
+    assert len( [ argv for argv in ffmpeg.cmds if '-bsf:v' in argv and video.filename in argv ] ) == 1
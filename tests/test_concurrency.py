@@ -0,0 +1,68 @@
+import threading
+import time
+
+import pytest
+
+from vedit import vedit
+from vedit.vedit import Clip, Window
+
+
+class Overlap( object ):
+    '''Stands in for Window.run_command, running commands with a
+    FakeFFmpeg slowly enough that those run at the same time overlap,
+    and recording the most ffmpeg commands reading one of the files
+    in watch which ran at once.'''
+
+    def __init__( self, fake, watch ):
+        self.fake = fake
+        self.watch = watch
+        self.lock = threading.Lock()
+        self.running = 0
+        self.most = 0
+
+    def __call__( self, cmd, timeout=None ):
+        watched = cmd[0] == vedit.FFMPEG and len( [ arg for arg in cmd if arg in self.watch ] ) > 0
+        if not watched:
+            return self.fake( cmd, timeout=timeout )
+        with self.lock:
+            self.running += 1
+            self.most = max( self.most, self.running )
+        try:
+            time.sleep( 0.05 )
+            return self.fake( cmd, timeout=timeout )
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+@pytest.fixture
+def overlap( ffmpeg, monkeypatch ):
+    monkeypatch.setattr( Window, 'max_concurrency', 4 )
+    overlap = Overlap( ffmpeg, [] )
+    monkeypatch.setattr( Window, 'run_command', staticmethod( overlap ) )
+    return overlap
+
+
+def test_clips_are_transcoded_at_the_same_time( make_video, tmp_path, overlap ):
+    videos = [ make_video( '%d.mp4' % ( idx ) ) for idx in range( 4 ) ]
+    overlap.watch = [ video.filename for video in videos ]
+    window = Window( clips=[ Clip( video, 0, 5 ) for video in videos ], output_file=str( tmp_path / 'output.mp4' ) )
+    window.render()
+    assert overlap.most == 4
+
+    # Each of the transcodes which finished together was recorded in
+    # the cache index.
+    assert len( [ job for job in window.plan().get_cache_hits() if job['name'].startswith( 'using cached clip' ) ] ) == 4
+
+
+def test_sibling_windows_are_rendered_at_the_same_time( make_video, tmp_path, overlap ):
+    videos = [ make_video( '%d.mp4' % ( idx ) ) for idx in range( 3 ) ]
+    overlap.watch = [ video.filename for video in videos ]
+    children = [ Window( clips=[ Clip( video, 0, 5 ) ], width=320, height=180, x=idx + 1, z_index=z_index )
+                 for ( idx, ( video, z_index ) ) in enumerate( zip( videos, [ 3, 1, 2 ] ) ) ]
+    Window( windows=children, duration=5, output_file=str( tmp_path / 'output.mp4' ) ).render()
+    assert overlap.most == 3
+
+    # They are composited in z_index order.
+    composites = [ cmd for cmd in overlap.fake.ffmpeg_cmds() if '[v0] [v1] overlay' in cmd ]
+    assert [ int( cmd.split( 'overlay=x=' )[1].split( ':' )[0] ) for cmd in composites ] == [ 2, 3, 1 ]
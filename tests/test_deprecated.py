@@ -0,0 +1,51 @@
+import os
+
+from vedit.vedit import Clip, Watermark, Window
+
+
+def test_render_clips( make_video, ffmpeg ):
+    video = make_video( 'a.mp4' )
+    window = Window( clips=[ Clip( video, 0, 5 ), Clip( video, 5, 10 ) ] )
+    ( audio_channels, sar_clause ) = window.resolve_render_settings()
+    background_file = os.path.join( Window.tmpdir, 'background.mp4' )
+    open( background_file, 'w' ).close()
+
+    assert window.render_clips( [], background_file, audio_channels ) == background_file
+    result = window.render_clips( window.clips, background_file, audio_channels )
+    assert os.path.exists( result )
+    assert Window.get_cache_stats()['entries'] == 2
+
+
+def test_clip_render( make_video, ffmpeg ):
+    video = make_video( 'a.mp4' )
+    window = Window( clips=[ Clip( video, 0, 5 ) ] )
+    window.resolve_render_settings()
+    filename = window.clip_render( window.clips[0], 2 )
+    assert os.path.exists( filename )
+    assert window.clip_render( window.clips[0], 2 ) == filename
+    assert len( ffmpeg.ffmpeg_cmds() ) == 1
+
+
+def test_add_watermarks( ffmpeg ):
+    window = Window( duration=10 )
+    window.resolve_render_settings()
+    current = os.path.join( Window.tmpdir, 'current.mp4' )
+    open( current, 'w' ).close()
+
+    result = window.add_watermarks( [ Watermark( bgcolor='red', width=20, height=20 ) ], current )
+    assert os.path.exists( result )
+    assert window.watermarks == []
+    ( layer, overlay ) = ffmpeg.ffmpeg_cmds()
+    assert 'yuva420p' in layer
+    assert '[0:v] [1:v] overlay' in overlay
+
+
+def test_cache_dict( ffmpeg, monkeypatch ):
+    filename = os.path.join( Window.tmpdir, 'a.mp4' )
+    open( filename, 'w' ).close()
+    monkeypatch.setattr( Window, 'cache_dict', { 'a' : filename } )
+    Window.save_cache_dict()
+    Window.cache_dict = {}
+    Window.load_cache_dict()
+    assert Window.cache_dict == { 'a' : filename }
+    assert Window.get_cache_entry( 'a' ) == filename
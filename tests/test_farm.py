@@ -0,0 +1,143 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+from vedit import vedit
+from vedit.vedit import FarmQueue, Window, run_farm_worker
+
+
+@pytest.fixture
+def queue( tmp_path, monkeypatch ):
+    '''A FarmQueue in its own tmpdir, which gives up quickly.'''
+    monkeypatch.setattr( Window, 'tmpdir', str( tmp_path ) )
+    monkeypatch.setattr( FarmQueue, 'poll_interval', 0.01 )
+    monkeypatch.setattr( FarmQueue, 'lease_duration', 0.5 )
+    monkeypatch.setattr( FarmQueue, 'claim_timeout', 0.5 )
+    monkeypatch.setattr( FarmQueue, 'deadline_slack', 0.2 )
+    monkeypatch.setattr( FarmQueue, 'max_attempts', 2 )
+    return Window.get_farm_queue()
+
+
+def python( code ):
+    return [ sys.executable, '-c', code ]
+
+
+def start( target, *args, **kwargs ):
+    thread = threading.Thread( target=target, args=args, kwargs=kwargs )
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def listing( queue ):
+    return dict( [ ( subdir, [ name for name in os.listdir( os.path.join( queue.path, subdir ) ) ] ) for subdir in [ 'pending', 'claimed', 'done' ] ] )
+
+
+def test_workers_run_commands_and_return_their_results( queue ):
+    worker = start( run_farm_worker, max_jobs=2 )
+    assert queue.run( python( "print( 'hello' )" ) ) == ( 0, "hello" )
+    assert queue.run( python( "import sys; sys.exit( 4 )" ) )[0] == 4
+    worker.join( 10 )
+    assert not worker.is_alive()
+    assert listing( queue ) == { 'pending' : [], 'claimed' : [], 'done' : [] }
+
+
+def test_render_farm_runs_ffmpeg_commands_through_the_queue( queue, monkeypatch ):
+    monkeypatch.setattr( Window, 'render_farm', True )
+    claims = []
+
+    def worker():
+        while len( claims ) == 0:
+            claimed = queue.claim()
+            if claimed is not None:
+                claims.append( claimed[1] )
+                queue.finish( claimed[0], 0, "farmed" )
+            time.sleep( FarmQueue.poll_interval )
+
+    start( worker )
+    assert Window.run_command( [ vedit.FFMPEG, '-version' ], timeout=5 ) == ( 0, "farmed" )
+    assert claims == [ { 'argv' : [ vedit.FFMPEG, '-version' ], 'timeout' : 5 } ]
+
+
+def test_farmed_commands_take_no_command_slot( queue, monkeypatch ):
+    monkeypatch.setattr( Window, 'render_farm', True )
+    monkeypatch.setattr( Window, 'command_slots', threading.BoundedSemaphore( 1 ) )
+    Window.command_slots.acquire()
+    results = []
+
+    start( run_farm_worker, max_jobs=1 )
+    thread = start( lambda: results.append( Window.run_command( [ vedit.FFMPEG, '-version' ], timeout=5 ) ) )
+    thread.join( 10 )
+    assert not thread.is_alive()
+    assert len( results ) == 1
+
+
+def test_commands_are_claimed_in_order( queue ):
+    first = queue.submit( [ 'first' ] )
+    second = queue.submit( [ 'second' ] )
+    assert queue.claim() == ( first, { 'argv' : [ 'first' ], 'timeout' : None } )
+    assert queue.claim()[0] == second
+    assert queue.claim() is None
+
+
+def test_unclaimed_commands_are_withdrawn( queue ):
+    result = queue.wait( queue.submit( [ 'nobody' ] ) )
+    assert result['status'] == -1
+    assert "claimed" in result['output']
+    assert listing( queue ) == { 'pending' : [], 'claimed' : [], 'done' : [] }
+
+
+def test_commands_of_dead_workers_are_returned_to_the_queue( queue ):
+    # A worker which claims commands but dies without renewing them.
+    done = threading.Event()
+    claims = []
+
+    def dead_worker():
+        while not done.is_set():
+            claimed = queue.claim()
+            if claimed is not None:
+                claims.append( claimed[0] )
+            done.wait( 0.01 )
+
+    start( dead_worker )
+    job_id = queue.submit( [ 'doomed' ] )
+    result = queue.wait( job_id )
+    done.set()
+
+    assert result['status'] == -1
+    assert "2 times" in result['output']
+    assert claims == [ job_id, job_id ]
+    assert listing( queue ) == { 'pending' : [], 'claimed' : [], 'done' : [] }
+
+
+def test_commands_which_run_past_their_deadline_are_withdrawn( queue ):
+    # A worker which renews its claim but never finishes.
+    done = threading.Event()
+
+    def stuck_worker():
+        claimed = None
+        while not done.is_set():
+            if claimed is None:
+                claimed = queue.claim()
+            else:
+                queue.renew( claimed[0] )
+            done.wait( 0.01 )
+
+    start( stuck_worker )
+    result = queue.wait( queue.submit( [ 'stuck' ], timeout=0.1 ), timeout=0.1 )
+    done.set()
+
+    assert result['status'] == -1
+    assert "did not finish" in result['output']
+
+
+def test_results_of_withdrawn_commands_are_discarded( queue ):
+    job_id = queue.submit( [ 'withdrawn' ] )
+    assert queue.claim()[0] == job_id
+    queue.withdraw( job_id )
+    assert not queue.renew( job_id )
+    queue.finish( job_id, 0, "" )
+    assert listing( queue ) == { 'pending' : [], 'claimed' : [], 'done' : [] }
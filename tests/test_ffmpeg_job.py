@@ -0,0 +1,45 @@
+import sys
+
+from vedit.vedit import FFmpegJob
+
+
+def python( code ):
+    return [ sys.executable, '-c', code ]
+
+
+def test_status_and_output():
+    job = FFmpegJob( python( "import sys; print( 'out' ); sys.stderr.write( 'err\\n' ); sys.exit( 3 )" ) ).run()
+    assert job.finished
+    assert job.status == 3
+    assert 'out' in job.output and 'err' in job.output
+    assert not job.timed_out
+    assert job.elapsed >= 0
+
+
+def test_string_commands_are_split_without_a_shell():
+    job = FFmpegJob( "%s -c \"import sys; print( sys.argv[1:] )\" 'a b' '$HOME'" % ( sys.executable ) ).run()
+    assert job.status == 0
+    assert job.output == "['a b', '$HOME']"
+
+
+def test_commands_are_killed_after_their_timeout():
+    job = FFmpegJob( python( "import time; time.sleep( 30 )" ), timeout=0.2 ).run()
+    assert job.timed_out
+    assert job.status < 0
+    assert job.elapsed < 10
+    assert "killed" in job.output
+
+
+def test_the_callback_is_called_when_the_command_finishes():
+    finished = []
+    FFmpegJob( python( "pass" ), callback=lambda job: finished.append( job.finished ) ).run()
+    assert finished == [ True ]
+
+
+def test_commands_which_have_exited_are_not_killed():
+    job = FFmpegJob( python( "pass" ), timeout=30 ).run()
+    job.kill()
+    assert job.exited
+    assert not job.timed_out
+    assert job.timer.finished.is_set()
+    assert job.status == 0
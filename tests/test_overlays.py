@@ -0,0 +1,76 @@
+import re
+
+from vedit.vedit import Clip, Display, OVERLAY, Window
+
+
+class EveryFile( dict ):
+    '''Gives every file not otherwise listed the same value, for
+    FakeFFmpeg's packets or streams.'''
+
+    def __init__( self, value, files=None ):
+        dict.__init__( self, files or {} )
+        self.value = value
+
+    def get( self, filename, default=None ):
+        if filename in self:
+            return self[filename]
+        return self.value( filename )
+
+
+def keyframes( ffmpeg, times ):
+    ffmpeg.packets = EveryFile( lambda filename: [ { 'pts_time' : '%f' % ( time ), 'flags' : 'K_' } for time in times ] )
+
+
+def render( make_video, tmp_path, **kwargs ):
+    '''Renders two OVERLAY Clips on a 20 second Clip, in batches of one,
+    and returns the ffmpeg commands which applied them.'''
+    a = make_video( 'a.mp4' )
+    b = make_video( 'b.mp4' )
+    overlay = Display( display_style=OVERLAY )
+    window = Window( clips=[ Clip( a, 0, 20 ), Clip( b, 0, 3, display=overlay ), Clip( b, 5, 8, display=overlay ) ],
+                     overlay_batch_concurrency=1, seed=1, output_file=str( tmp_path / 'output.mp4' ), **kwargs )
+    window.render()
+
+
+def applied( ffmpeg ):
+    '''Returns the commands which overlaid OVERLAY Clips.'''
+    return [ argv for argv in ffmpeg.cmds if '-filter_complex' in argv and re.search( r'\[o\d+\]', argv[argv.index( '-filter_complex' ) + 1] ) and '-vn' not in argv ]
+
+
+def test_batches_re_encode_only_the_span_they_cover( make_video, tmp_path, ffmpeg ):
+    keyframes( ffmpeg, range( 0, 21, 2 ) )
+    render( make_video, tmp_path, windowed_overlays=True )
+
+    # Each batch re-encodes from the keyframe before it to the one
+    # after it.
+    spans = [ ( argv[argv.index( '-ss' ) + 1], argv[argv.index( '-t' ) + 1] ) for argv in applied( ffmpeg ) ]
+    assert spans == [ ( '0.000000', '4.000000' ), ( '4.000000', '4.000000' ) ]
+
+    # The video before and after each span is copied.
+    copies = [ " ".join( argv ) for argv in ffmpeg.cmds if '-c:v' in argv and argv[argv.index( '-c:v' ) + 1] == 'copy' and '-an' in argv ]
+    assert len( [ cmd for cmd in copies if '-t 4.000000' in cmd and '-ss' not in cmd ] ) == 1
+    assert len( [ cmd for cmd in copies if '-ss 4.000000' in cmd ] ) == 1
+    assert len( [ cmd for cmd in copies if '-ss 8.000000' in cmd ] ) == 1
+    assert len( [ cmd for cmd in ffmpeg.ffmpeg_cmds() if '-f concat' in cmd and '-c copy' in cmd ] ) == 2
+
+
+def test_batches_covering_everything_re_encode_everything( make_video, tmp_path, ffmpeg ):
+    keyframes( ffmpeg, [ 0 ] )
+    render( make_video, tmp_path, windowed_overlays=True )
+    for argv in applied( ffmpeg ):
+        assert '-ss' not in argv
+
+
+def test_spans_which_can_not_be_joined_are_placed_the_same_way( make_video, tmp_path, ffmpeg ):
+    render( make_video, tmp_path )
+    placed = [ argv[argv.index( '-filter_complex' ) + 1] for argv in applied( ffmpeg ) ]
+    assert len( placed ) == 2
+
+    # Every file has its own profile, so no re-encoded span can be
+    # joined with the video around it.
+    del ffmpeg.cmds[:]
+    keyframes( ffmpeg, range( 0, 21, 2 ) )
+    ffmpeg.streams = EveryFile( lambda filename: { 'profile' : filename }, ffmpeg.streams )
+    render( make_video, tmp_path, windowed_overlays=True, force=True )
+    fallbacks = [ argv[argv.index( '-filter_complex' ) + 1] for argv in applied( ffmpeg ) if '-ss' not in argv ]
+    assert fallbacks == placed
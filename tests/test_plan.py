@@ -0,0 +1,159 @@
+import os
+
+import pytest
+
+from vedit import vedit
+from vedit.vedit import Clip, Display, PAN, RenderPlan, Scheduler, Watermark, Window
+
+
+@pytest.fixture
+def scheduled( monkeypatch ):
+    '''Records the name and dependencies of each task of each graph a
+    render runs.'''
+    graphs = []
+    run = Scheduler.run
+
+    def record( scheduler ):
+        graphs.append( [ ( task['name'], [ dep['id'] for dep in task['depends'] ] ) for task in scheduler.tasks ] )
+        return run( scheduler )
+
+    monkeypatch.setattr( Scheduler, 'run', record )
+    return graphs
+
+
+def get_window( make_video, tmp_path, **kwargs ):
+    a = make_video( 'a.mp4' )
+    b = make_video( 'b.mp4' )
+    c = make_video( 'c.mp4' )
+    child = Window( clips=[ Clip( c, 0, 6 ) ], width=320, height=180, x=10, y=10 )
+    return Window( clips=[ Clip( a, 0, 5 ), Clip( b, 2, 8 ), Clip( a, 0, 5 ) ],
+                   windows=[ child ],
+                   display=Display( display_style=PAN ),
+                   output_file=str( tmp_path / 'output.mp4' ),
+                   **kwargs )
+
+
+def get_files():
+    '''Returns the files in the tmpdir other than the databases.'''
+    return sorted( [ name for name in os.listdir( Window.tmpdir ) if not ( name.startswith( Window.cache_db_file ) or name.startswith( vedit.Video.metadata_db_file ) ) ] )
+
+
+def get_jobs( plan ):
+    return [ ( job['name'], job['depends'] ) for job in plan.jobs ]
+
+
+def test_the_plan_is_the_graph_render_runs( make_video, tmp_path, ffmpeg, scheduled ):
+    window = get_window( make_video, tmp_path )
+    plan = window.plan()
+    window.render()
+    assert scheduled == [ get_jobs( plan ) ]
+
+
+@pytest.mark.parametrize( 'options', [ { 'watermarks' : [ Watermark( bgcolor='red', width=20, height=20 ) ] },
+                                       { 'encode_segment_duration' : 2 },
+                                       { 'separate_audio' : True },
+                                       { 'audio_only_stages' : True, 'windowed_overlays' : True } ] )
+def test_the_plan_is_the_graph_render_runs_with_options( make_video, tmp_path, ffmpeg, scheduled, options ):
+    window = get_window( make_video, tmp_path, **options )
+    plan = window.plan()
+    window.render()
+    assert scheduled == [ get_jobs( plan ) ]
+
+
+def test_identical_clips_are_transcoded_once( make_video, tmp_path, ffmpeg ):
+    plan = get_window( make_video, tmp_path ).plan()
+    names = [ job['name'] for job in plan.jobs ]
+    clips = [ name for name in names if name.startswith( 'transcoding clip' ) ]
+    assert len( clips ) == 3
+
+
+def test_planning_changes_nothing( make_video, tmp_path, ffmpeg ):
+    window = get_window( make_video, tmp_path )
+    settings = [ ( w.duration, w.sample_aspect_ratio, w.pix_fmt ) for w in window.get_child_windows( include_self=True ) ]
+    files = get_files()
+    count = len( ffmpeg.cmds )
+
+    plan = window.plan()
+
+    assert len( plan.jobs ) > 0
+    assert ffmpeg.ffmpeg_cmds() == []
+    assert len( ffmpeg.cmds ) == count
+    assert get_files() == files
+    assert [ ( w.duration, w.sample_aspect_ratio, w.pix_fmt ) for w in window.get_child_windows( include_self=True ) ] == settings
+    stats = Window.get_cache_stats()
+    assert ( stats['entries'], stats['hits'], stats['misses'] ) == ( 0, 0, 0 )
+
+
+def test_a_rendered_window_is_planned_from_the_cache( make_video, tmp_path, ffmpeg, monkeypatch ):
+    monkeypatch.setattr( Window, 'cache_renders', True )
+    window = get_window( make_video, tmp_path )
+    planned = window.plan()
+    assert planned.get_cache_hits() == []
+    assert planned.get_pixel_seconds() > 0
+
+    window.render()
+    plan = window.plan()
+    assert len( plan.jobs ) == 1
+    assert plan.get_cache_hits() == plan.jobs
+    assert plan.get_pixel_seconds() == 0
+
+    # The cached render was not deleted as an intermediate file.
+    os.remove( window.output_file )
+    window.render()
+    assert os.path.exists( window.output_file )
+
+
+def test_renders_are_not_cached_by_default( make_video, tmp_path, ffmpeg ):
+    window = get_window( make_video, tmp_path )
+    window.render()
+    files = get_files()
+    assert window.plan().get_pixel_seconds() > 0
+    window.render()
+    assert get_files() == files
+
+
+def test_planning_computes_no_fingerprints( make_video, tmp_path, ffmpeg, monkeypatch ):
+    monkeypatch.setattr( Window, 'content_fingerprints', True )
+    computed = []
+    compute_fingerprint = vedit.Video.compute_fingerprint
+    def record( filename ):
+        computed.append( filename )
+        return compute_fingerprint( filename )
+    monkeypatch.setattr( vedit.Video, 'compute_fingerprint', staticmethod( record ) )
+
+    window = get_window( make_video, tmp_path )
+    assert window.plan().get_cache_hits() == []
+    assert computed == []
+
+    # Once the fingerprints are known, the plan finds what the render
+    # cached.
+    window.render()
+    count = len( computed )
+    assert count > 0
+    assert len( window.plan().get_cache_hits() ) > 0
+    assert len( computed ) == count
+
+
+def test_plan_windows( make_video, tmp_path, ffmpeg ):
+    window = get_window( make_video, tmp_path )
+    plan = window.plan()
+    assert [ w['window'] for w in plan.windows ] == list( window.get_child_windows( include_self=True ) )
+    assert [ ( w['width'], w['height'] ) for w in plan.windows ] == [ ( 1280, 720 ), ( 320, 180 ) ]
+    assert [ w['audio_channels'] for w in plan.windows ] == [ 2, 2 ]
+
+
+def test_critical_path():
+    scheduler = Scheduler( dry_run=True )
+    a = scheduler.add( None, cost=5, name='a' )
+    b = scheduler.add( None, cost=1, name='b' )
+    c = scheduler.add( None, cost=3, name='c', depends=[ b ] )
+    d = scheduler.add( None, cost=1, name='d', depends=[ a, c ] )
+    scheduler.add( None, name='e', cached=True )
+
+    plan = RenderPlan()
+    plan.add_tasks( scheduler.tasks )
+    assert plan.jobs[3]['depends'] == [ 0, 2 ]
+    assert plan.get_pixel_seconds() == 10
+    assert [ job['name'] for job in plan.get_critical_path() ] == [ 'a', 'd' ]
+    assert [ job['name'] for job in plan.get_cache_hits() ] == [ 'e' ]
+    assert RenderPlan().get_critical_path() == []
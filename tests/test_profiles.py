@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+from vedit.vedit import Clip, FFV1, INTERMEDIATE_PROFILES, Window
+
+
+def test_invalid_profiles_are_refused( monkeypatch ):
+    monkeypatch.setattr( Window, 'intermediate_profile', Window.intermediate_profile )
+    with pytest.raises( Exception ):
+        Window.set_intermediate_profile( 'mpeg1' )
+    Window.set_intermediate_profile( FFV1 )
+    assert Window.get_codecs() == INTERMEDIATE_PROFILES[FFV1]
+    assert Window.get_codecs( final=True )['extension'] == 'mp4'
+
+
+def test_only_the_output_gets_the_delivery_encode( make_video, tmp_path, ffmpeg, monkeypatch ):
+    monkeypatch.setattr( Window, 'intermediate_profile', FFV1 )
+    a = make_video( 'a.mp4' )
+    child = Window( clips=[ Clip( a, 0, 5 ) ], width=320, height=180 )
+    window = Window( clips=[ Clip( a, 0, 5 ), Clip( a, 2, 6 ) ], windows=[ child ], output_file=str( tmp_path / 'output.mp4' ) )
+    window.render()
+
+    encodes = [ argv for argv in ffmpeg.cmds if '-c:v' in argv and argv[argv.index( '-c:v' ) + 1] != 'copy' ]
+    delivery = [ argv for argv in encodes if 'libx264' in argv ]
+    assert len( delivery ) == 1
+    assert len( encodes ) > 1
+    for argv in encodes:
+        if argv not in delivery:
+            assert 'ffv1' in argv
+            assert '-c:a' not in argv or 'pcm_s16le' in argv
+            assert os.path.splitext( argv[-1] )[1] == '.nut'
+
+    # Clips are cached in the intermediate profile.
+    cached = [ name for name in os.listdir( Window.tmpdir ) if name.endswith( '.nut' ) ]
+    assert len( cached ) >= 2
@@ -0,0 +1,104 @@
+import os
+import subprocess
+
+import pytest
+
+from vedit import vedit
+from vedit.vedit import Clip, Display, PAN, Video, Watermark, Window
+
+
+def get_encoders():
+    try:
+        output = subprocess.check_output( [ vedit.FFMPEG, '-hide_banner', '-encoders' ], stderr=subprocess.STDOUT )
+    except ( OSError, subprocess.CalledProcessError ):
+        return ""
+    return output.decode( 'utf-8', 'replace' )
+
+
+# Renders encode with libx264 and libfdk_aac.
+encoders = get_encoders()
+pytestmark = pytest.mark.skipif( 'libx264' not in encoders or 'libfdk_aac' not in encoders, reason="ffmpeg with libx264 and libfdk_aac is needed to render" )
+
+
+@pytest.fixture
+def cache( tmp_path, monkeypatch ):
+    tmpdir = str( tmp_path / 'cache' )
+    monkeypatch.setattr( Window, 'tmpdir', tmpdir )
+    monkeypatch.setattr( Video, 'videos', {} )
+    return tmpdir
+
+
+def make_testsrc( tmp_path, name, duration, size ):
+    '''Returns a Video of a test pattern with a tone.'''
+    filename = str( tmp_path / name )
+    subprocess.check_call( [ vedit.FFMPEG, '-v', 'quiet', '-y',
+                             '-f', 'lavfi', '-i', 'testsrc=duration=%d:size=%s:rate=30000/1001' % ( duration, size ),
+                             '-f', 'lavfi', '-i', 'sine=duration=%d' % ( duration ),
+                             '-pix_fmt', 'yuv420p', '-c:v', 'libx264', '-g', '30', '-c:a', 'libfdk_aac', '-ac', '2', filename ] )
+    return Video( filename )
+
+
+def test_render( tmp_path, cache, monkeypatch ):
+    monkeypatch.setattr( Window, 'cache_renders', True )
+    a = make_testsrc( tmp_path, 'a.mp4', 6, '320x240' )
+    b = make_testsrc( tmp_path, 'b.mp4', 4, '640x360' )
+    child = Window( clips=[ Clip( b ) ], width=160, height=90, x=10, y=10 )
+    window = Window( clips=[ Clip( a, 0, 3 ), Clip( b, 1, 4 ) ],
+                     windows=[ child ],
+                     watermarks=[ Watermark( bgcolor='red', width=20, height=20, x=300, y=200 ) ],
+                     display=Display( display_style=PAN ),
+                     width=320,
+                     height=240,
+                     output_file=str( tmp_path / 'output.mp4' ) )
+
+    plan = window.plan()
+    assert plan.get_cache_hits() == []
+    window.render()
+
+    output = Video( window.output_file, persist=False )
+    assert ( output.width, output.height, output.channels ) == ( 320, 240, 2 )
+    assert abs( output.duration - 6 ) < 0.5
+
+    # A second render comes from the cache.
+    assert len( window.plan().jobs ) == 1
+    os.remove( window.output_file )
+    window.render()
+    assert os.path.exists( window.output_file )
+
+
+def count_frames( filename ):
+    output = subprocess.check_output( [ vedit.FFPROBE, '-v', 'quiet', '-count_frames', '-select_streams', 'v:0', '-show_entries', 'stream=nb_read_frames', '-of', 'csv=p=0', filename ] )
+    return int( output.decode( 'utf-8' ).strip() )
+
+
+def test_segmented_render( tmp_path, cache ):
+    a = make_testsrc( tmp_path, 'a.mp4', 6, '320x240' )
+    window = Window( clips=[ Clip( a ) ], width=320, height=240, encode_segment_duration=2, output_file=str( tmp_path / 'output.mp4' ) )
+    window.render()
+    output = Video( window.output_file, persist=False )
+    assert abs( output.duration - 6 ) < 0.5
+
+    single = Window( clips=[ Clip( a ) ], width=320, height=240, output_file=str( tmp_path / 'single.mp4' ) )
+    single.render()
+    assert count_frames( window.output_file ) == count_frames( single.output_file )
+
+
+def test_smart_cut_render( tmp_path, cache, monkeypatch ):
+    a = make_testsrc( tmp_path, 'a.mp4', 6, '320x240' )
+
+    cmds = []
+    run_command = Window.run_command
+    def record( cmd, timeout=None ):
+        cmds.append( cmd if isinstance( cmd, str ) else " ".join( cmd ) )
+        return run_command( cmd, timeout=timeout )
+    monkeypatch.setattr( Window, 'run_command', staticmethod( record ) )
+
+    window = Window( clips=[ Clip( a, 0.5, 5.5 ) ], smart_cut=True, width=320, height=240, output_file=str( tmp_path / 'output.mp4' ) )
+    window.render()
+
+    # The pieces of x264 output each have their own parameter sets,
+    # but are joined rather than the clip being transcoded whole.
+    assert [ cmd for cmd in cmds if 'dump_extra' in cmd ]
+    assert [ cmd for cmd in cmds if ( '-ss 0.500000 -i %s' % ( a.filename ) ) in cmd and '-t 5.000000' in cmd ] == []
+    output = Video( window.output_file, persist=False )
+    assert abs( output.duration - 5 ) < 0.5
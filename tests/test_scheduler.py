@@ -0,0 +1,86 @@
+import threading
+
+import pytest
+
+from vedit.vedit import Scheduler
+
+
+def test_tasks_run_after_their_dependencies():
+    scheduler = Scheduler( max_workers=4 )
+    order = []
+    lock = threading.Lock()
+
+    def record( name ):
+        with lock:
+            order.append( name )
+        return name
+
+    a = scheduler.add( lambda: record( 'a' ) )
+    b = scheduler.add( lambda: record( 'b' ) )
+    c = scheduler.add( lambda: record( 'c' ), depends=[ a, b ] )
+    d = scheduler.add( lambda: record( 'd' ), depends=[ c ] )
+    scheduler.run()
+
+    assert sorted( order ) == [ 'a', 'b', 'c', 'd' ]
+    assert order.index( 'c' ) > max( order.index( 'a' ), order.index( 'b' ) )
+    assert order.index( 'd' ) > order.index( 'c' )
+    assert d['result'] == 'd'
+
+
+def test_tasks_see_the_results_of_their_dependencies():
+    scheduler = Scheduler( max_workers=2 )
+    a = scheduler.add( lambda: 2 )
+    b = scheduler.add( lambda: 3 )
+    c = scheduler.add( lambda: a['result'] * b['result'], depends=[ a, b ] )
+    scheduler.run()
+    assert c['result'] == 6
+
+
+def test_tasks_with_the_same_key_are_shared():
+    scheduler = Scheduler()
+    a = scheduler.add( lambda: 1, key='clip' )
+    assert scheduler.add( lambda: 2, key='clip' ) is a
+    assert scheduler.get( 'clip' ) is a
+    assert scheduler.get( 'other' ) is None
+    assert len( scheduler.tasks ) == 1
+
+
+def test_a_dependency_listed_twice_is_waited_on_once():
+    scheduler = Scheduler()
+    a = scheduler.add( lambda: 1 )
+    b = scheduler.add( lambda: a['result'] + 1, depends=[ a, a ] )
+    assert b['depends'] == [ a ]
+    assert b['waiting'] == 1
+    scheduler.run()
+    assert b['result'] == 2
+
+
+def test_longest_chain_starts_first():
+    scheduler = Scheduler( max_workers=1 )
+    order = []
+    short = scheduler.add( lambda: order.append( 'short' ), cost=5, name='short' )
+    head = scheduler.add( lambda: order.append( 'head' ), cost=1, name='head' )
+    scheduler.add( lambda: order.append( 'tail' ), depends=[ head ], cost=10, name='tail' )
+    scheduler.run()
+    assert order == [ 'head', 'short', 'tail' ] or order == [ 'head', 'tail', 'short' ]
+
+
+def test_an_error_stops_the_graph_and_is_raised():
+    scheduler = Scheduler( max_workers=2 )
+    ran = []
+
+    def fail():
+        raise Exception( "task failed" )
+
+    bad = scheduler.add( fail )
+    scheduler.add( lambda: ran.append( 'dependent' ), depends=[ bad ] )
+    with pytest.raises( Exception, match="task failed" ):
+        scheduler.run()
+    assert ran == []
+
+
+def test_a_dry_run_can_not_be_run():
+    scheduler = Scheduler( dry_run=True )
+    scheduler.add( lambda: 1 )
+    with pytest.raises( Exception ):
+        scheduler.run()
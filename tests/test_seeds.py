@@ -0,0 +1,49 @@
+from vedit.vedit import Clip, Display, OVERLAY, Window, distribute_clips
+
+
+def overlay_filters( make_video, tmp_path, ffmpeg, seed ):
+    '''Renders a Window with OVERLAY Clips, and returns the filters
+    which placed them.'''
+    video = make_video( 'a.mp4' )
+    overlay = Display( display_style=OVERLAY )
+    del ffmpeg.cmds[:]
+    Window( clips=[ Clip( video, 0, 5 ), Clip( video, 1, 4, display=overlay ), Clip( video, 2, 6, display=overlay ) ],
+            seed=seed, force=True, output_file=str( tmp_path / 'output.mp4' ) ).render()
+    return [ argv[argv.index( '-filter_complex' ) + 1] for argv in ffmpeg.cmds if '-filter_complex' in argv and '[outv]' in argv[argv.index( '-filter_complex' ) + 1] ]
+
+
+def test_seeded_overlays_are_placed_the_same_way_each_time( make_video, tmp_path, ffmpeg ):
+    placed = overlay_filters( make_video, tmp_path, ffmpeg, 7 )
+    assert len( placed ) > 0
+    assert overlay_filters( make_video, tmp_path, ffmpeg, 7 ) == placed
+    assert overlay_filters( make_video, tmp_path, ffmpeg, 8 ) != placed
+
+
+def test_seeded_renders_are_cached( make_video, tmp_path, ffmpeg, monkeypatch ):
+    monkeypatch.setattr( Window, 'cache_renders', True )
+    video = make_video( 'a.mp4' )
+    overlay = Display( display_style=OVERLAY )
+
+    def get_window( seed ):
+        return Window( clips=[ Clip( video, 0, 5 ), Clip( video, 1, 4, display=overlay ) ], seed=seed, output_file=str( tmp_path / 'output.mp4' ) )
+
+    def cached_renders( window ):
+        return [ job for job in window.plan().get_cache_hits() if job['name'].startswith( 'using cached render' ) ]
+
+    get_window( 1 ).render()
+    assert len( cached_renders( get_window( 1 ) ) ) == 1
+    get_window( None ).render()
+    assert len( cached_renders( get_window( None ) ) ) == 0
+
+
+def test_seeded_clips_are_distributed_the_same_way_each_time( make_video, ffmpeg ):
+    video = make_video( 'a.mp4' )
+
+    def distribute( seed ):
+        clips = [ Clip( video, start, start + 1 ) for start in range( 10 ) ]
+        windows = [ Window( width=320, height=180 ), Window( width=320, height=180 ) ]
+        distribute_clips( clips, windows, randomize_clips=True, seed=seed )
+        return [ [ clip.start for clip in window.clips ] for window in windows ]
+
+    assert distribute( 3 ) == distribute( 3 )
+    assert distribute( 3 ) != distribute( 4 )
@@ -0,0 +1,90 @@
+import math
+import os
+
+from vedit.vedit import Video, Window
+
+
+def test_short_or_unsegmented_windows_are_not_split( ffmpeg ):
+    assert Window( duration=10 ).get_encode_segments() is None
+    assert Window( duration=2, encode_segment_duration=2 ).get_encode_segments() is None
+
+
+def test_segments_are_whole_numbers_of_frames( ffmpeg ):
+    assert Window( duration=10, encode_segment_duration=2 ).get_encode_segments() == [ ( 0, 60 ), ( 60, 60 ), ( 120, 60 ), ( 180, 60 ), ( 240, None ) ]
+    assert Window( duration=5, encode_segment_duration=2 ).get_encode_segments() == [ ( 0, 60 ), ( 60, 60 ), ( 120, None ) ]
+
+
+def intermediate( tmp_path, ffmpeg, keyframes ):
+    filename = str( tmp_path / 'intermediate.mp4' )
+    open( filename, 'w' ).close()
+    ffmpeg.packets[filename] = [ { 'pts_time' : '%f' % ( keyframe ), 'flags' : 'K_' } for keyframe in keyframes ]
+    return filename
+
+
+def test_boundaries_move_to_nearby_keyframes( tmp_path, ffmpeg ):
+    window = Window( duration=10, encode_segment_duration=2 )
+    current = intermediate( tmp_path, ffmpeg, [ 0, 1.8, 4.5, 8.3 ] )
+    assert window.align_encode_segments( current, window.get_encode_segments() ) == [ ( 0, 54 ), ( 54, 81 ), ( 135, 45 ), ( 180, 69 ), ( 249, None ) ]
+
+
+def test_boundaries_stay_put_without_keyframes( tmp_path, ffmpeg ):
+    window = Window( duration=10, encode_segment_duration=2 )
+    segments = window.get_encode_segments()
+    assert window.align_encode_segments( intermediate( tmp_path, ffmpeg, [] ), segments ) == segments
+
+
+def test_aligned_segments_cover_every_frame( tmp_path, ffmpeg ):
+    # Segments of 8 frames, with keyframes close to two boundaries.
+    window = Window( duration=1, encode_segment_duration=8 * 1001 / 30000.0 )
+    segments = window.get_encode_segments()
+    assert segments[:3] == [ ( 0, 8 ), ( 8, 8 ), ( 16, 8 ) ]
+    current = intermediate( tmp_path, ffmpeg, [ 0, 9 * 1001 / 30000.0, 15 * 1001 / 30000.0 ] )
+    aligned = window.align_encode_segments( current, segments )
+    assert [ start for ( start, frames ) in aligned ][:3] == [ 0, 9, 15 ]
+    assert sum( [ frames for ( start, frames ) in aligned[:-1] ] ) == aligned[-1][0]
+
+
+def test_alignment_leaves_the_metadata_database_alone( tmp_path, ffmpeg ):
+    window = Window( duration=10, encode_segment_duration=2 )
+    current = intermediate( tmp_path, ffmpeg, [ 0, 1.8 ] )
+    window.align_encode_segments( current, window.get_encode_segments() )
+    assert current not in Video.videos
+    assert Video.load_metadata( current, os.stat( current ) ) is None
+
+
+def test_segments_are_encoded_separately_and_joined( tmp_path, ffmpeg ):
+    window = Window( duration=10, encode_segment_duration=2, output_file=str( tmp_path / 'output.mp4' ) )
+    window.render()
+
+    cmds = ffmpeg.ffmpeg_cmds()
+    segments = [ cmd for cmd in cmds if '-ss' in cmd and '-an' in cmd ]
+    assert len( segments ) == 5
+    assert len( [ cmd for cmd in segments if '-frames:v 60' in cmd ] ) == 4
+    joins = [ cmd for cmd in cmds if '-f concat' in cmd and '-c copy' in cmd ]
+    assert len( joins ) == 1
+    assert os.path.exists( window.output_file )
+
+
+def test_segments_hold_the_frames_of_a_single_encode( tmp_path, ffmpeg ):
+    window = Window( duration=10, encode_segment_duration=7 * 1001 / 30000.0, output_file=str( tmp_path / 'output.mp4' ) )
+    window.render()
+
+    # The first frame each segment keeps, and how many it keeps.
+    segments = []
+    for argv in ffmpeg.cmds:
+        if '-ss' in argv and '-an' in argv:
+            start = float( argv[argv.index( '-ss' ) + 1] ) * 30000 / 1001.0
+            frames = None
+            if '-frames:v' in argv:
+                frames = int( argv[argv.index( '-frames:v' ) + 1] )
+            segments.append( ( int( math.ceil( start ) ), frames ) )
+            assert start == 0 or math.ceil( start ) - start > 0.25
+
+    # The segments are encoded concurrently.
+    segments.sort()
+    total = int( round( window.duration * 30000 / 1001.0 ) )
+    assert len( segments ) > 1
+    assert segments[0][0] == 0
+    for ( ( start, frames ), ( next_start, next_frames ) ) in zip( segments, segments[1:] ):
+        assert start + frames == next_start
+    assert sum( [ frames for ( start, frames ) in segments[:-1] ] ) + ( total - segments[-1][0] ) == total
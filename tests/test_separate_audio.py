@@ -0,0 +1,99 @@
+import pytest
+
+from vedit.vedit import Clip, Display, Window
+
+
+@pytest.fixture
+def graphs( ffmpeg, monkeypatch ):
+    '''Records the filter graph of each command which reads one from a
+    file, before the file is deleted.'''
+    graphs = []
+    run = Window.run_command
+
+    def record( cmd, timeout=None ):
+        if '-filter_complex_script' in cmd:
+            graphs.append( open( cmd[cmd.index( '-filter_complex_script' ) + 1] ).read() )
+        return run( cmd, timeout=timeout )
+
+    monkeypatch.setattr( Window, 'run_command', staticmethod( record ) )
+    return graphs
+
+
+def get_window( make_video, tmp_path, **kwargs ):
+    a = make_video( 'a.mp4' )
+    b = make_video( 'b.mp4' )
+    music = str( tmp_path / 'music.m4a' )
+    f = open( music, 'w' )
+    f.write( 'music' )
+    f.close()
+    child = Window( clips=[ Clip( b, 0, 6 ) ], width=320, height=180, x=10, y=10 )
+    return Window( clips=[ Clip( a, 0, 5 ), Clip( b, 7, 9, display=Display( include_audio=False ) ) ],
+                   windows=[ child ],
+                   audio_file=music,
+                   output_file=str( tmp_path / 'output.mp4' ),
+                   separate_audio=True,
+                   **kwargs )
+
+
+def get_audio_renders( ffmpeg ):
+    return [ cmd for cmd in ffmpeg.ffmpeg_cmds() if '-filter_complex_script' in cmd ]
+
+
+def test_the_audio_of_the_tree_is_rendered_once( make_video, tmp_path, ffmpeg, graphs ):
+    window = get_window( make_video, tmp_path )
+    window.render()
+    renders = get_audio_renders( ffmpeg )
+    assert len( renders ) == 1
+    assert ' -vn ' in renders[0]
+
+    # Each Clip's range is read straight from its Video, along with
+    # the audio_file, other than that of the Clip without
+    # include_audio, which is silent.
+    assert ' -ss 0.000000 -t 5.000000 -i %s ' % ( window.clips[0].video.filename ) in renders[0]
+    assert ' -ss 0.000000 -t 6.000000 -i %s ' % ( window.windows[0].clips[0].video.filename ) in renders[0]
+    assert ' -ss 7.000000 ' not in renders[0]
+    assert ' -i %s ' % ( window.audio_file ) in renders[0]
+    assert len( graphs ) == 1
+    assert graphs[0].count( 'asetpts' ) == 2
+    assert 'aevalsrc=0:c=stereo:s=48000:d=2.000000 ' in graphs[0]
+
+
+def test_the_video_is_rendered_without_audio( make_video, tmp_path, ffmpeg ):
+    get_window( make_video, tmp_path ).render()
+    composites = [ cmd for cmd in ffmpeg.ffmpeg_cmds() if 'overlay=' in cmd ]
+    assert len( composites ) == 3
+    for cmd in composites:
+        assert ' -an ' in cmd
+        assert 'amix' not in cmd and 'adelay' not in cmd
+    assert [ cmd for cmd in ffmpeg.ffmpeg_cmds() if 'dynaudnorm' in cmd or 'afade' in cmd ] == []
+
+    # Backgrounds get no silent track.
+    backgrounds = [ cmd for cmd in ffmpeg.ffmpeg_cmds() if '-stream_loop' in cmd ]
+    assert len( backgrounds ) == 2
+    for cmd in backgrounds:
+        assert 'aevalsrc' not in cmd and ' -map 0:v -c:v copy ' in cmd
+
+
+def test_the_audio_is_added_to_the_finished_video( make_video, tmp_path, ffmpeg ):
+    window = get_window( make_video, tmp_path )
+    window.render()
+    cmds = ffmpeg.ffmpeg_cmds()
+    audio = get_audio_renders( ffmpeg )[0].split()[-1]
+    assert ' -i %s -map 0:v -map 1:a -c:v copy -c:a copy ' % ( audio ) in cmds[-1]
+
+
+def test_segmented_renders_join_the_audio_with_the_segments( make_video, tmp_path, ffmpeg ):
+    get_window( make_video, tmp_path, encode_segment_duration=2 ).render()
+    cmds = ffmpeg.ffmpeg_cmds()
+    renders = get_audio_renders( ffmpeg )
+    assert len( renders ) == 1
+    assert [ cmd for cmd in cmds if 'dynaudnorm' in cmd ] == []
+    audio = renders[0].split()[-1]
+    assert ' -i %s -map 0:v -map 1:a -c copy ' % ( audio ) in cmds[-1]
+
+
+def test_single_pass_renders_ignore_separate_audio( make_video, tmp_path, ffmpeg ):
+    get_window( make_video, tmp_path, single_pass=True ).render()
+    renders = get_audio_renders( ffmpeg )
+    assert len( renders ) == 1
+    assert ' -vn ' not in renders[0]
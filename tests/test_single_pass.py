@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+from vedit.vedit import Clip, Display, OVERLAY, Watermark, Window
+
+
+@pytest.fixture
+def graphs( ffmpeg, monkeypatch ):
+    '''Records the filter graph of each command which reads one from a
+    file, before the file is deleted.'''
+    graphs = []
+    run = Window.run_command
+
+    def record( cmd, timeout=None ):
+        if '-filter_complex_script' in cmd:
+            graphs.append( open( cmd[cmd.index( '-filter_complex_script' ) + 1] ).read() )
+        return run( cmd, timeout=timeout )
+
+    monkeypatch.setattr( Window, 'run_command', staticmethod( record ) )
+    return graphs
+
+
+def get_window( make_video, tmp_path, **kwargs ):
+    a = make_video( 'a.mp4' )
+    b = make_video( 'b.mp4' )
+    child = Window( clips=[ Clip( b, 0, 5 ) ], width=320, height=180, x=10, y=10, z_index=2,
+                    windows=[ Window( clips=[ Clip( a, 1, 4 ) ], width=80, height=60, z_index=3 ) ] )
+    return Window( clips=[ Clip( a, 0, 5 ), Clip( b, 0, 3, display=Display( display_style=OVERLAY ) ) ],
+                   windows=[ child ],
+                   watermarks=[ Watermark( bgcolor='red', width=20, height=20 ) ],
+                   output_file=str( tmp_path / 'output.mp4' ),
+                   seed=1,
+                   **kwargs )
+
+
+def test_the_whole_tree_is_encoded_once( make_video, tmp_path, ffmpeg, graphs ):
+    window = get_window( make_video, tmp_path, single_pass=True )
+    window.render()
+
+    assert len( ffmpeg.ffmpeg_cmds() ) == 1
+    ( cmd, ) = [ argv for argv in ffmpeg.cmds if '-filter_complex_script' in argv ]
+    for video in ( 'a.mp4', 'b.mp4' ):
+        assert len( [ arg for arg in cmd if arg.endswith( video ) ] ) > 0
+
+    ( graph, ) = graphs
+    # The clips, the overlay, the two child Windows and the watermark
+    # are each overlaid in the graph.
+    assert graph.count( 'overlay=' ) >= 4
+    assert 'color=red' in graph
+    assert os.path.exists( window.output_file )
+
+
+def test_single_pass_renders_are_planned_as_one_job( make_video, tmp_path, ffmpeg ):
+    plan = get_window( make_video, tmp_path, single_pass=True ).plan()
+    assert len( plan.jobs ) == 1
+    assert len( get_window( make_video, tmp_path ).plan().jobs ) > 1
@@ -0,0 +1,71 @@
+import sys
+import threading
+
+from vedit.vedit import Window
+
+
+# Appends an x to what it reads from its input, the first argument,
+# and writes it to its output, the last argument, either of which may
+# be a pipe.
+STAGE = '''
+import sys
+if sys.argv[1] == 'pipe:0':
+    data = sys.stdin.read()
+else:
+    data = open( sys.argv[1] ).read()
+if sys.argv[-1] == 'pipe:1':
+    sys.stdout.write( data + 'x' )
+else:
+    open( sys.argv[-1], 'w' ).write( data + 'x' )
+'''
+
+
+class Slots( object ):
+    '''Stands in for Window.command_slots, counting the slots held.'''
+
+    def __init__( self, count ):
+        self.semaphore = threading.BoundedSemaphore( count )
+        self.held = 0
+        self.most = 0
+
+    def acquire( self ):
+        self.semaphore.acquire()
+        self.held += 1
+        self.most = max( self.most, self.held )
+
+    def release( self ):
+        self.held -= 1
+        self.semaphore.release()
+
+    def __enter__( self ):
+        self.acquire()
+
+    def __exit__( self, *args ):
+        self.release()
+
+
+def run_pipeline( tmp_path, monkeypatch, stage_count, max_concurrency ):
+    script = str( tmp_path / 'stage.py' )
+    open( script, 'w' ).write( STAGE )
+    source = str( tmp_path / 'source.txt' )
+    open( source, 'w' ).write( 'a' )
+
+    slots = Slots( max_concurrency )
+    monkeypatch.setattr( Window, 'max_concurrency', max_concurrency )
+    monkeypatch.setattr( Window, 'command_slots', slots )
+
+    stages = [ { 'name' : 'stage %d' % ( idx ), 'cmd' : lambda current, codecs, output: [ sys.executable, script, current, output ] } for idx in range( stage_count ) ]
+    result = Window().run_piped_stages( stages, source )
+    return ( open( result ).read(), slots )
+
+
+def test_each_piped_stage_takes_a_command_slot( tmp_path, ffmpeg, monkeypatch ):
+    ( output, slots ) = run_pipeline( tmp_path, monkeypatch, 3, 4 )
+    assert output == 'axxx'
+    assert ( slots.most, slots.held ) == ( 3, 0 )
+
+
+def test_pipelines_are_no_wider_than_max_concurrency( tmp_path, ffmpeg, monkeypatch ):
+    ( output, slots ) = run_pipeline( tmp_path, monkeypatch, 5, 2 )
+    assert output == 'axxxxx'
+    assert ( slots.most, slots.held ) == ( 2, 0 )
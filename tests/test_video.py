@@ -0,0 +1,144 @@
+import os
+import threading
+import time
+
+from vedit import vedit
+from vedit.vedit import Video
+
+
+def probes( ffmpeg ):
+    return [ argv for argv in ffmpeg.cmds if argv[0] == vedit.FFPROBE ]
+
+
+def test_metadata_comes_from_ffprobe( make_video ):
+    video = make_video( 'a.mp4', width=640, height=360, duration='12.5' )
+    assert ( video.width, video.height, video.duration ) == ( 640, 360, 12.5 )
+    assert video.frame_rate == '30000/1001'
+    assert ( video.channels, video.audio_codec_name, video.sample_rate ) == ( 2, 'aac', '48000' )
+
+
+def test_metadata_is_probed_once_and_kept_in_the_database( make_video, ffmpeg ):
+    video = make_video( 'a.mp4' )
+    Video( video.filename )
+    assert len( probes( ffmpeg ) ) == 1
+
+    # A new program with the same tmpdir finds the metadata in the
+    # database.
+    Video.videos.clear()
+    Video( video.filename )
+    assert len( probes( ffmpeg ) ) == 1
+
+
+def test_metadata_of_a_changed_file_is_probed_again( make_video, ffmpeg ):
+    video = make_video( 'a.mp4' )
+    f = open( video.filename, 'a' )
+    f.write( 'more' )
+    f.close()
+    Video( video.filename )
+    assert len( probes( ffmpeg ) ) == 2
+
+
+def test_metadata_of_another_version_is_probed_again( make_video, ffmpeg, monkeypatch ):
+    video = make_video( 'a.mp4' )
+    Video.videos.clear()
+    monkeypatch.setattr( Video, 'metadata_version', Video.metadata_version + 1 )
+    Video( video.filename )
+    assert len( probes( ffmpeg ) ) == 2
+
+
+def test_videos_which_do_not_persist_stay_out_of_the_database( make_video, ffmpeg ):
+    video = make_video( 'a.mp4' )
+    scratch = os.path.join( os.path.dirname( video.filename ), 'scratch.mp4' )
+    open( scratch, 'w' ).close()
+    Video( scratch, persist=False ).get_keyframes()
+    assert scratch not in Video.videos
+    assert Video.load_metadata( scratch, os.stat( scratch ) ) is None
+
+
+def test_prune_metadata_removes_entries_for_missing_and_changed_files( make_video ):
+    kept = make_video( 'kept.mp4' )
+    deleted = make_video( 'deleted.mp4' )
+    changed = make_video( 'changed.mp4' )
+    os.remove( deleted.filename )
+    f = open( changed.filename, 'a' )
+    f.write( 'more' )
+    f.close()
+
+    assert Video.prune_metadata() == 2
+    assert Video.load_metadata( kept.filename, os.stat( kept.filename ) ) is not None
+    assert Video.prune_metadata() == 0
+
+
+def test_forget_metadata( make_video, ffmpeg ):
+    video = make_video( 'a.mp4' )
+    Video.forget_metadata( [ video.filename ] )
+    assert video.filename not in Video.videos
+    Video( video.filename )
+    assert len( probes( ffmpeg ) ) == 2
+
+
+def test_probe_many_matches_video( make_video, ffmpeg ):
+    filenames = [ make_video( name, width=width ).filename for ( name, width ) in [ ( 'a.mp4', 320 ), ( 'b.mp4', 640 ), ( 'c.mp4', 960 ) ] ]
+    Video.clear_metadata()
+
+    videos = Video.probe_many( filenames, workers=1 )
+    assert [ video.filename for video in videos ] == filenames
+    assert [ video.width for video in videos ] == [ 320, 640, 960 ]
+    assert len( probes( ffmpeg ) ) == 6
+
+
+def test_probe_many_probes_at_once( make_video, ffmpeg, monkeypatch ):
+    filenames = [ make_video( '%d.mp4' % ( idx ) ).filename for idx in range( 4 ) ]
+    Video.clear_metadata()
+
+    lock = threading.Lock()
+    counts = { 'running' : 0, 'most' : 0 }
+    run = vedit.FFmpegJob.run
+
+    def slow( job ):
+        with lock:
+            counts['running'] += 1
+            counts['most'] = max( counts['most'], counts['running'] )
+        time.sleep( 0.05 )
+        try:
+            return run( job )
+        finally:
+            with lock:
+                counts['running'] -= 1
+    monkeypatch.setattr( vedit.FFmpegJob, 'run', slow )
+
+    Video.probe_many( filenames, workers=4 )
+    assert counts['most'] == 4
+
+    # Only the streams and fields vedit uses are asked for.
+    for argv in probes( ffmpeg )[-len( filenames ):]:
+        assert '-show_entries' in argv and '-show_streams' not in argv
+
+
+def test_probe_many_uses_the_database( make_video, ffmpeg ):
+    filenames = [ make_video( '%d.mp4' % ( idx ) ).filename for idx in range( 3 ) ]
+    count = len( probes( ffmpeg ) )
+    Video.videos.clear()
+    assert [ video.width for video in Video.probe_many( filenames ) ] == [ 1280 ] * 3
+    assert len( probes( ffmpeg ) ) == count
+
+
+def test_keyframes_leave_out_open_gops( make_video, ffmpeg ):
+    video = make_video( 'a.mp4' )
+    # Packets in decoding order: the GOP at 4.0 is open, since the
+    # packet after it is displayed before it.
+    ffmpeg.packets[video.filename] = [ { 'pts_time' : '0.000000', 'flags' : 'K_' },
+                                       { 'pts_time' : '0.033367', 'flags' : '__' },
+                                       { 'pts_time' : '2.000000', 'flags' : 'K_' },
+                                       { 'pts_time' : '2.033367', 'flags' : '__' },
+                                       { 'pts_time' : '4.000000', 'flags' : 'K_' },
+                                       { 'pts_time' : '3.966633', 'flags' : '__' },
+                                       { 'pts_time' : 'N/A', 'flags' : '__' },
+                                       { 'pts_time' : '6.000000', 'flags' : 'K_' } ]
+    assert video.get_keyframes() == [ 0.0, 2.0, 6.0 ]
+
+    # The keyframes are kept with the metadata.
+    Video.videos.clear()
+    count = len( ffmpeg.cmds )
+    assert Video( video.filename ).get_keyframes() == [ 0.0, 2.0, 6.0 ]
+    assert len( ffmpeg.cmds ) == count
@@ -0,0 +1,79 @@
+import pytest
+
+from vedit.vedit import Clip, Watermark, Window
+
+
+def get_watermarks():
+    return [ Watermark( bgcolor='red', width=20, height=20, x=5, y=5 ) ]
+
+
+def render( tmp_path, ffmpeg, **kwargs ):
+    '''Renders a Window with Watermarks, and returns the ffmpeg commands
+    which rendered its watermark layer, and those which used it.'''
+    window = Window( watermarks=get_watermarks(), output_file=str( tmp_path / 'output.mp4' ), **kwargs )
+    window.render()
+    layer = window.get_watermark_layer_file( window.get_watermark_layer_hash() )
+    cmds = ffmpeg.ffmpeg_cmds()
+    return ( [ cmd for cmd in cmds if 'yuva420p' in cmd ], [ cmd for cmd in cmds if layer in cmd ] )
+
+
+def test_the_layer_is_overlaid_by_compositing_a_child_window( make_video, tmp_path, ffmpeg ):
+    child = Window( clips=[ Clip( make_video( 'b.mp4' ), 0, 5 ) ], width=320, height=180 )
+    ( renders, uses ) = render( tmp_path, ffmpeg, clips=[ Clip( make_video( 'a.mp4' ), 0, 5 ) ], windows=[ child ] )
+    assert len( renders ) == 1
+    assert len( uses ) == 1
+    assert '[v0] [v1] overlay' in uses[0]
+
+
+def test_the_layer_is_overlaid_by_compositing_the_clips( make_video, tmp_path, ffmpeg ):
+    ( renders, uses ) = render( tmp_path, ffmpeg, clips=[ Clip( make_video( 'a.mp4' ), 0, 5 ) ], encode_segment_duration=2 )
+    assert len( renders ) == 1
+    assert len( uses ) == 1
+    assert '[c] [2:v] overlay' in uses[0]
+    assert '-frames:v' not in uses[0]
+
+
+def test_the_layer_is_overlaid_by_each_segment( ffmpeg, tmp_path ):
+    ( renders, uses ) = render( tmp_path, ffmpeg, duration=10, encode_segment_duration=2 )
+    assert len( renders ) == 1
+    assert len( uses ) == 5
+    for cmd in uses:
+        assert cmd.count( '-ss' ) == 2
+        assert '[0:v] [1:v] overlay' in cmd
+
+
+def test_the_layer_is_rendered_once_for_identical_windows( make_video, tmp_path, ffmpeg ):
+    video = make_video( 'a.mp4' )
+    children = [ Window( clips=[ Clip( video, 0, 5 ) ], width=320, height=180, watermarks=get_watermarks(), duration=5, force=True ),
+                 Window( clips=[ Clip( video, 0, 5 ) ], width=320, height=180, watermarks=get_watermarks(), duration=5, force=True, y=200 ) ]
+    Window( clips=[ Clip( video, 0, 5 ) ], windows=children, output_file=str( tmp_path / 'output.mp4' ) ).render()
+    assert len( [ cmd for cmd in ffmpeg.ffmpeg_cmds() if 'yuva420p' in cmd ] ) == 1
+
+
+@pytest.mark.parametrize( 'windows, clips, segmented, layer, steps', [
+    ( 1, True, False, 'step', [ ( 'window', True ), ( 'volume', False ) ] ),
+    ( 2, True, True, 'step', [ ( 'window', False ), ( 'window', True ) ] ),
+    ( 0, True, False, 'step', [ ( 'volume', True ) ] ),
+    ( 0, True, True, 'clips', [] ),
+    ( 0, False, True, 'segments', [] ),
+    ( 0, False, False, 'step', [ ( 'volume', True ) ] ) ] )
+def test_where_watermarks_are_overlaid( ffmpeg, windows, clips, segmented, layer, steps ):
+    window = Window( duration=10 )
+    children = [ Window( duration=10 ) for idx in range( windows ) ]
+    result = window.get_composite_steps( children, False, segmented, False, True, clips )
+    assert [ ( step['kind'], step['watermarks'] ) for step in result[0] ] == steps
+    assert result[3] == layer
+
+
+def test_watermarks_get_a_step_of_their_own_as_a_last_resort( ffmpeg ):
+    window = Window( duration=10, audio_only_stages=True )
+    ( steps, audio_step, final, layer ) = window.get_composite_steps( [], True, False, False, True, False )
+    assert [ ( step['kind'], step['watermarks'] ) for step in steps ] == [ ( 'watermarks', True ) ]
+    assert layer == 'step'
+    assert audio_step is None
+    assert not final
+
+
+def test_without_watermarks_there_is_no_layer( ffmpeg ):
+    window = Window( duration=10 )
+    assert window.get_composite_steps( [], False, False, False, False, True )[3] is None
@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+from vedit.vedit import Clip, Window, Workspace
+
+
+def write( filename, size ):
+    f = open( filename, 'w' )
+    f.write( 'x' * size )
+    f.close()
+
+
+def test_usage_is_the_total_of_the_measured_files( tmp_path ):
+    workspace = Workspace()
+    ( a, b ) = ( str( tmp_path / 'a' ), str( tmp_path / 'b' ) )
+    workspace.add( a )
+    workspace.add( b )
+    write( a, 10 )
+    write( b, 20 )
+    assert workspace.usage == 0
+
+    Workspace.measure_output( a )
+    Workspace.measure_output( b )
+    assert ( workspace.usage, workspace.peak_usage ) == ( 30, 30 )
+
+    workspace.release( a )
+    assert not os.path.exists( a )
+    workspace.forget( b )
+    assert os.path.exists( b )
+    assert ( workspace.usage, workspace.peak_usage ) == ( 0, 30 )
+
+    # Files no Workspace tracks are not measured.
+    Workspace.measure_output( b )
+    assert workspace.usage == 0
+
+
+def test_files_are_not_statted_to_add_another( tmp_path, monkeypatch ):
+    workspace = Workspace( scratch_limit=1000 )
+    for idx in range( 10 ):
+        workspace.add( str( tmp_path / str( idx ) ) )
+
+    def stat( filename ):
+        raise AssertionError( "Statted %s" % ( filename ) )
+    monkeypatch.setattr( Window, 'get_file_size', staticmethod( stat ) )
+    workspace.add( str( tmp_path / 'another' ) )
+
+
+def test_the_scratch_limit_is_checked_once_output_is_written( tmp_path ):
+    workspace = Workspace( scratch_limit=15 )
+    ( a, b ) = ( str( tmp_path / 'a' ), str( tmp_path / 'b' ) )
+    workspace.add( a )
+    write( a, 10 )
+    workspace.measure( a )
+    workspace.add( b )
+    write( b, 10 )
+    with pytest.raises( Exception ):
+        workspace.measure( b )
+    with pytest.raises( Exception ):
+        workspace.add( str( tmp_path / 'c' ) )
+
+
+def get_window( make_video, tmp_path ):
+    return Window( clips=[ Clip( make_video( 'a.mp4' ), 0, 5 ), Clip( make_video( 'b.mp4' ), 0, 5 ) ], output_file=str( tmp_path / 'output.mp4' ) )
+
+
+def get_tracked():
+    return [ filename for filename in Workspace.owners if filename.startswith( Window.tmpdir ) ]
+
+
+def test_renders_track_nothing_once_finished( make_video, ffmpeg, tmp_path ):
+    get_window( make_video, tmp_path ).render()
+    assert get_tracked() == []
+
+
+def test_renders_stop_at_the_scratch_limit( make_video, ffmpeg, tmp_path, monkeypatch ):
+    # Each command of FakeFFmpeg writes 100 bytes.
+    monkeypatch.setattr( Window, 'scratch_limit', 150 )
+    with pytest.raises( Exception ) as error:
+        get_window( make_video, tmp_path ).render()
+    assert 'scratch_limit' in str( error.value )
+    assert get_tracked() == []
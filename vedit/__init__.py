@@ -8,7 +8,7 @@ __all__ = [
     'CROP',
     'PAD',
     'PAN',
-    'DISPLAY_STYLES,'
+    'DISPLAY_STYLES',
     'DOWN',
     'LEFT',
     'RIGHT',
@@ -16,6 +16,11 @@ __all__ = [
     'OVERLAY_DIRECTIONS',
     'ALTERNATE',
     'PAN_DIRECTIONS',
+    'DELIVERY',
+    'LOSSLESS',
+    'FFV1',
+    'RAWVIDEO',
+    'INTERMEDIATE_PROFILES',
     
     # Classes.
     'Display',
@@ -23,9 +28,13 @@ __all__ = [
     'Clip',
     'Window',
     'Watermark',
+    'FFmpegJob',
+    'RenderPlan',
+    'FarmQueue',
 
     # Utility functions.
     'distribute_clips',
+    'run_farm_worker',
     'gen_background_video'
 ]
 
@@ -43,10 +52,19 @@ from .vedit import UP
 from .vedit import OVERLAY_DIRECTIONS
 from .vedit import ALTERNATE
 from .vedit import PAN_DIRECTIONS
+from .vedit import DELIVERY
+from .vedit import LOSSLESS
+from .vedit import FFV1
+from .vedit import RAWVIDEO
+from .vedit import INTERMEDIATE_PROFILES
 from .vedit import Display
 from .vedit import Video
 from .vedit import Clip
 from .vedit import Window
 from .vedit import Watermark
+from .vedit import FFmpegJob
+from .vedit import RenderPlan
+from .vedit import FarmQueue
 from .vedit import distribute_clips
+from .vedit import run_farm_worker
 from .vedit import gen_background_video
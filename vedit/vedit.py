@@ -17,21 +17,40 @@ this configure command:
 '''
 
 import collections
+import functools
 import getpass
 import glob
 import hashlib
+import heapq
 import json
 import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
 import random
 import re
+import shlex
 import shutil
+import socket
+import sqlite3
 from future import standard_library
 standard_library.install_aliases()
 import subprocess
 import tempfile
+import threading
+import time
 import uuid
 
+try:
+    from collections.abc import Iterable
+except ImportError:
+    from collections import Iterable
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
 log = logging.getLogger(__name__)
 
 ################################################################################
@@ -151,6 +170,62 @@ OVERLAY_DIRECTIONS = [ DOWN, LEFT, RIGHT, UP ]
 ALTERNATE = "alternate"
 PAN_DIRECTIONS = [ ALTERNATE, DOWN, UP ]
 
+# "Constant" intermediate encoding profiles.
+#
+# Do not change these.
+#
+# Rendering a Window produces a series of intermediate video files,
+# each of which is decoded again by the next step of rendering.  The
+# intermediate profile, set with Window.set_intermediate_profile,
+# controls how these files (including cached Clips) are encoded.  The
+# final output_file is always encoded with the DELIVERY profile.
+#
+# * DELIVERY - H.264 with -crf 16 and AAC audio in MP4, the default.
+#
+# * LOSSLESS - Lossless H.264 with the ultrafast preset and PCM audio
+#              in NUT.  Much faster to encode than DELIVERY and
+#              avoids generational loss, at the cost of larger files.
+#
+# * FFV1 - Lossless FFV1 video and PCM audio in NUT.
+#
+# * RAWVIDEO - Uncompressed video and PCM audio in NUT.  The fastest
+#              option, but uses a great deal of disk space.
+DELIVERY  = "delivery"
+LOSSLESS  = "lossless"
+FFV1      = "ffv1"
+RAWVIDEO  = "rawvideo"
+INTERMEDIATE_PROFILES = {
+    DELIVERY : { 'extension' : 'mp4',
+                 'codec_name': 'h264',
+                 'video'     : '-crf 16 -c:v libx264',
+                 'audio'     : '-c:a libfdk_aac' },
+    LOSSLESS : { 'extension' : 'nut',
+                 'codec_name': 'h264',
+                 'video'     : '-qp 0 -preset ultrafast -c:v libx264',
+                 'audio'     : '-c:a pcm_s16le' },
+    FFV1     : { 'extension' : 'nut',
+                 'codec_name': 'ffv1',
+                 'video'     : '-c:v ffv1',
+                 'audio'     : '-c:a pcm_s16le' },
+    RAWVIDEO : { 'extension' : 'nut',
+                 'codec_name': 'rawvideo',
+                 'video'     : '-c:v rawvideo',
+                 'audio'     : '-c:a pcm_s16le' },
+}
+
+# The libx264 -profile:v names of the H.264 profiles ffprobe reports,
+# used to encode the ends of smart cut Clips with the same profile as
+# the video copied between them.
+X264_PROFILES = {
+    'Constrained Baseline'  : 'baseline',
+    'Baseline'              : 'baseline',
+    'Main'                  : 'main',
+    'High'                  : 'high',
+    'High 10'               : 'high10',
+    'High 4:2:2'            : 'high422',
+    'High 4:4:4 Predictive' : 'high444',
+}
+
 
 ################################################################################
 ################################################################################
@@ -280,6 +355,10 @@ class Video( object ):
 
     Inputs:
     * Filename - Full OS path to a video file.
+    * persist - Defaults to True, if False the metadata of the file is
+      probed without being kept in Video.videos or the metadata
+      database, which is what we want for intermediate files that will
+      soon be deleted.
 
     Outputs: None
 
@@ -294,8 +373,24 @@ class Video( object ):
     # contents at the same filename over the course of the program.
     videos = {}
 
+    # The metadata is also stored in this SQLite database in the
+    # Window.tmpdir, so it is shared by all the programs using the
+    # same tmpdir.  Entries are keyed by absolute path, and are only
+    # used if the size and modification time of the file match.
+    metadata_db_file = 'videodb'
+
+    # The version of the metadata we save, entries saved with any other
+    # version are probed again.
+    metadata_version = 3
+
+    # Content fingerprints are computed from this many blocks of this
+    # many bytes of the file.
+    fingerprint_blocks = 16
+    fingerprint_block_size = 64*1024
+
     def __init__( self, 
-                  filename ):
+                  filename,
+                  persist=True ):
 
         if not os.path.exists( filename ):
             raise Exception( "No video found at: %s" % ( filename ) )
@@ -305,54 +400,393 @@ class Video( object ):
         file_info = os.stat( filename )
 
         # Check out static cache of Video data to see if we know about
-        # this file already.
-        if filename in Video.videos and file_info.st_size == Video.videos[filename]['st_size'] and file_info.st_mtime == Video.videos[filename]['st_mtime']:
-            self.st_size = file_info.st_size
-            self.st_mtime = file_info.st_mtime
-            self.width = Video.videos[filename]['width']
-            self.height = Video.videos[filename]['height']
-            self.duration = Video.videos[filename]['duration']
-            self.sample_aspect_ratio = Video.videos[filename]['sample_aspect_ratio']
-            self.pix_fmt = Video.videos[filename]['pix_fmt']
-            self.channels = Video.videos[filename]['channels']
+        # this file already, and then the metadata database.
+        if not persist:
+            metadata = Video.probe( filename, file_info )
+        elif filename in Video.videos and file_info.st_size == Video.videos[filename]['st_size'] and file_info.st_mtime == Video.videos[filename]['st_mtime']:
+            metadata = Video.videos[filename]
+        else:
+            metadata = Video.load_metadata( filename, file_info )
+            if metadata is None:
+                metadata = Video.probe( filename, file_info )
+                Video.save_metadata( filename, metadata )
+            Video.videos[filename] = metadata
+
+        self.persist = persist
+        self.metadata = metadata
+
+        self.st_size = metadata['st_size']
+        self.st_mtime = metadata['st_mtime']
+        self.width = metadata['width']
+        self.height = metadata['height']
+        self.duration = metadata['duration']
+        self.sample_aspect_ratio = metadata['sample_aspect_ratio']
+        self.pix_fmt = metadata['pix_fmt']
+        self.codec_name = metadata['codec_name']
+        self.profile = metadata['profile']
+        self.level = metadata['level']
+        self.extradata_hash = metadata['extradata_hash']
+        self.frame_rate = metadata['frame_rate']
+        self.channels = metadata['channels']
+        self.audio_codec_name = metadata['audio_codec_name']
+        self.sample_rate = metadata['sample_rate']
+
+    @staticmethod
+    def probe_many( filenames, workers=None ):
+        '''Returns a list of Video objects for the list of filenames.
+
+        This is equivalent to calling Video on each filename, but it
+        is much faster for large numbers of files: the metadata
+        database is read and written once for all the files, and the
+        files which must be probed are probed by up to workers
+        ffprobe commands at once.  workers defaults to
+        Window.max_concurrency.
+        '''
+        if workers is None:
+            workers = Window.max_concurrency
+
+        file_infos = {}
+        for filename in filenames:
+            if not os.path.exists( filename ):
+                raise Exception( "No video found at: %s" % ( filename ) )
+            file_infos[filename] = os.stat( filename )
+
+        missing = [ filename for filename in file_infos if not ( filename in Video.videos and file_infos[filename].st_size == Video.videos[filename]['st_size'] and file_infos[filename].st_mtime == Video.videos[filename]['st_mtime'] ) ]
+
+        stored = Video.load_metadata_many( missing, file_infos )
+        Video.videos.update( stored )
+
+        unprobed = [ filename for filename in missing if filename not in stored ]
+
+        def probe( filename ):
+            return Video.probe( filename, file_infos[filename], throttle=False )
+
+        if len( unprobed ) > 1 and workers > 1:
+            pool = ThreadPool( min( len( unprobed ), workers ) )
+            try:
+                probed = pool.map( probe, unprobed )
+            finally:
+                pool.close()
+                pool.join()
         else:
-            # Collect file metadata with FFPROBE.
-            ( status, output ) = subprocess.getstatusoutput( "%s -v quiet -print_format json -show_streams %s" % ( FFPROBE, filename ) )
+            probed = [ probe( filename ) for filename in unprobed ]
+
+        probed = dict( zip( unprobed, probed ) )
+        Video.save_metadata_many( probed )
+        Video.videos.update( probed )
+
+        return [ Video( filename ) for filename in filenames ]
+
+    @staticmethod
+    def probe( filename, file_info, throttle=True ):
+        '''Collect the metadata of filename with FFPROBE, file_info is
+        the result of os.stat on filename.  Returns a dictionary of
+        metadata.
+
+        If throttle is False, the probe is run without waiting for
+        fewer than Window.max_concurrency commands to be running.
+        '''
+        # We only ask for what we use, which keeps ffprobe from
+        # inspecting things like the side data of each stream.  The
+        # hash of the extradata stands in for the parameter sets of
+        # the stream, such as the SPS and PPS of H.264.
+        cmd = [ FFPROBE, '-v', 'quiet', '-print_format', 'json', '-show_data_hash', 'MD5', '-show_entries', 'stream=codec_type,codec_name,profile,level,extradata_hash,duration,width,height,sample_aspect_ratio,pix_fmt,r_frame_rate,channels,sample_rate', filename ]
+        if throttle:
+            ( status, output ) = Window.run_command( cmd )
+        else:
+            job = FFmpegJob( cmd, timeout=Window.command_timeout, callback=Window.job_callback ).run()
+            ( status, output ) = ( job.status, job.output )
+        if status != 0:
+            raise Exception( "Error probing video %s, output was: %s" % ( filename, output ) )
+        info = json.loads( output )
+
+        metadata = { 'version'  : Video.metadata_version,
+                     'st_size'  : file_info.st_size,
+                     'st_mtime' : file_info.st_mtime }
+
+        for stream in info['streams']:
+            if stream['codec_type'] == 'video':
+                metadata['duration'] = float( stream['duration'] )
+                metadata['width'] = int( stream['width'] )
+                metadata['height'] = int( stream['height'] )
+                sample_aspect_ratio = stream.get( 'sample_aspect_ratio', '' )
+                if sample_aspect_ratio == '0:1':
+                    log.warn( "Nonsense SAR value of 0:1 detected, assuming SAR is 1:1." )
+                    sample_aspect_ratio = '1:1'
+                else:
+                    # Deal with weird files with rounding error SARs like 649:639.
+                    ( sarwidth, sarheight ) = sample_aspect_ratio.split( ':' )
+                    if ( sarwidth != sarheight ) and abs( ( float( sarwidth ) / float( sarheight ) ) - 1 ) < 0.1:
+                        log.warn( "Strange SAR value of %s:%s detected, setting SAR to 1:1." % ( sarwidth, sarheight ) )
+                        sample_aspect_ratio = '1:1'
+                metadata['sample_aspect_ratio'] = sample_aspect_ratio
+                metadata['pix_fmt'] = stream.get( 'pix_fmt', '' )
+                metadata['codec_name'] = stream.get( 'codec_name', '' )
+                metadata['profile'] = stream.get( 'profile', '' )
+                metadata['level'] = stream.get( 'level', None )
+                metadata['extradata_hash'] = stream.get( 'extradata_hash', None )
+                metadata['frame_rate'] = stream.get( 'r_frame_rate', '' )
+                break
+
+        if 'width' not in metadata:
+            raise Exception( "No video stream found in: %s, ffprobe output was: %s" % ( filename, output ) )
+
+        metadata['channels'] = None
+        metadata['audio_codec_name'] = None
+        metadata['sample_rate'] = None
+        for stream in info['streams']:
+            if stream['codec_type'] == 'audio':
+                metadata['channels'] = int( stream['channels'] )
+                metadata['audio_codec_name'] = stream.get( 'codec_name', '' )
+                metadata['sample_rate'] = stream.get( 'sample_rate', '' )
+
+        return metadata
+
+    @staticmethod
+    def get_metadata_db():
+        '''Returns a new connection to the metadata database, creating
+        it if needed.'''
+        if not os.path.isdir( Window.tmpdir ):
+            os.makedirs( Window.tmpdir )
+
+        db = sqlite3.connect( "%s/%s" % ( Window.tmpdir, Video.metadata_db_file ), timeout=60 )
+        db.execute( "PRAGMA journal_mode=WAL" )
+        db.execute( "CREATE TABLE IF NOT EXISTS videos ( filename TEXT PRIMARY KEY, st_size INTEGER, st_mtime REAL, metadata TEXT )" )
+        return db
+
+    @staticmethod
+    def load_metadata( filename, file_info ):
+        '''Returns the metadata of filename from the metadata database,
+        or None if it is not there or is out of date.'''
+        return Video.load_metadata_many( [ filename ], { filename : file_info } ).get( filename, None )
+
+    @staticmethod
+    def load_metadata_many( filenames, file_infos ):
+        '''Returns a dictionary of metadata from the metadata database
+        for those of filenames which are there and up to date, given
+        a dictionary of the result of os.stat for each filename.'''
+        result = {}
+        if len( filenames ) == 0:
+            return result
+
+        paths = {}
+        for filename in filenames:
+            paths.setdefault( os.path.abspath( filename ), [] ).append( filename )
+        abspaths = list( paths.keys() )
+
+        try:
+            db = Video.get_metadata_db()
+            try:
+                # SQLite limits how many parameters a query may have.
+                for idx in range( 0, len( abspaths ), 500 ):
+                    batch = abspaths[idx:idx+500]
+                    for ( abspath, st_size, st_mtime, metadata ) in db.execute( "SELECT filename, st_size, st_mtime, metadata FROM videos WHERE filename IN ( %s )" % ( ", ".join( [ "?" ] * len( batch ) ) ), batch ):
+                        for filename in paths[abspath]:
+                            if st_size == file_infos[filename].st_size and st_mtime == file_infos[filename].st_mtime:
+                                metadata = json.loads( metadata )
+                                if metadata.get( 'version', None ) == Video.metadata_version:
+                                    result[filename] = metadata
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            log.warn( "Error reading video metadata database in %s: %s" % ( Window.tmpdir, e ) )
+            return {}
+
+        return result
+
+    @staticmethod
+    def save_metadata( filename, metadata ):
+        '''Store the metadata of filename in the metadata database.'''
+        Video.save_metadata_many( { filename : metadata } )
+
+    @staticmethod
+    def save_metadata_many( metadatas ):
+        '''Store a dictionary of the metadata of many filenames in the
+        metadata database at once.'''
+        if len( metadatas ) == 0:
+            return
+
+        try:
+            db = Video.get_metadata_db()
+            try:
+                with db:
+                    db.executemany( "INSERT OR REPLACE INTO videos ( filename, st_size, st_mtime, metadata ) VALUES ( ?, ?, ?, ? )", [ ( os.path.abspath( filename ), metadata['st_size'], metadata['st_mtime'], json.dumps( metadata ) ) for ( filename, metadata ) in metadatas.items() ] )
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            log.warn( "Error writing video metadata database in %s: %s" % ( Window.tmpdir, e ) )
+
+    @staticmethod
+    def forget_metadata( filenames ):
+        '''Remove the metadata of filenames from Video.videos and the
+        metadata database, for instance because the files have been
+        deleted.'''
+        if len( filenames ) == 0:
+            return
+
+        for filename in filenames:
+            Video.videos.pop( filename, None )
+
+        try:
+            db = Video.get_metadata_db()
+            try:
+                with db:
+                    db.executemany( "DELETE FROM videos WHERE filename = ?", [ ( os.path.abspath( filename ), ) for filename in filenames ] )
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            log.warn( "Error writing video metadata database in %s: %s" % ( Window.tmpdir, e ) )
+
+    @staticmethod
+    def clear_metadata():
+        '''Remove all the metadata from Video.videos and the metadata
+        database.'''
+        Video.videos.clear()
+        try:
+            db = Video.get_metadata_db()
+            try:
+                with db:
+                    db.execute( "DELETE FROM videos" )
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            log.warn( "Error writing video metadata database in %s: %s" % ( Window.tmpdir, e ) )
+
+    @staticmethod
+    def prune_metadata():
+        '''Remove the entries of the metadata database for files which
+        no longer exist, or whose size or modification time have
+        changed so the entry would never be used again.  Returns the
+        number of entries removed.'''
+        try:
+            db = Video.get_metadata_db()
+            try:
+                stale = []
+                for ( filename, st_size, st_mtime ) in db.execute( "SELECT filename, st_size, st_mtime FROM videos" ).fetchall():
+                    try:
+                        file_info = os.stat( filename )
+                        if file_info.st_size != st_size or file_info.st_mtime != st_mtime:
+                            stale.append( filename )
+                    except OSError:
+                        stale.append( filename )
+                with db:
+                    db.executemany( "DELETE FROM videos WHERE filename = ?", [ ( filename, ) for filename in stale ] )
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            log.warn( "Error writing video metadata database in %s: %s" % ( Window.tmpdir, e ) )
+            return 0
+
+        return len( stale )
+
+    def get_video_params( self ):
+        '''Returns a tuple of the parameters of the video stream of this
+        Video which must be identical for streams to be concatenated
+        without re-encoding: the codec, its profile, level and
+        parameter sets, and the frame size, sample aspect ratio, pixel
+        format, and frame rate.'''
+        return ( self.codec_name,
+                 self.profile,
+                 self.level,
+                 self.extradata_hash,
+                 self.width,
+                 self.height,
+                 self.sample_aspect_ratio,
+                 self.pix_fmt,
+                 self.frame_rate )
+
+    def get_decoding_params( self ):
+        '''Returns the parameters of get_video_params other than the
+        hash of the parameter sets, which is all that must match for
+        streams which repeat their parameter sets in-band to be
+        concatenated without re-encoding.'''
+        return ( self.codec_name,
+                 self.profile,
+                 self.level,
+                 self.width,
+                 self.height,
+                 self.sample_aspect_ratio,
+                 self.pix_fmt,
+                 self.frame_rate )
+
+    def get_keyframes( self ):
+        '''Returns a sorted list of the times, in seconds, of the
+        keyframes in the video stream of this Video at which it can be
+        cut without re-encoding.
+
+        Keyframes which begin an open GOP, where frames that follow
+        the keyframe in decoding order are displayed before it and
+        may refer to the GOP before it, are left out.
+        '''
+        if 'keyframes' not in self.metadata:
+            ( status, output ) = Window.run_command( [ FFPROBE, '-v', 'quiet', '-print_format', 'json', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags', self.filename ] )
+            if status != 0:
+                raise Exception( "Error finding keyframes of video %s, output was: %s" % ( self.filename, output ) )
             info = json.loads( output )
-            for stream in info['streams']:
-                if stream['codec_type'] == 'video':
-                    self.duration = float( stream['duration'] )
-                    self.width = int( stream['width'] )
-                    self.height = int( stream['height'] )
-                    self.sample_aspect_ratio = stream.get( 'sample_aspect_ratio', '' )
-                    if self.sample_aspect_ratio == '0:1':
-                        log.warn( "Nonsense SAR value of 0:1 detected, assuming SAR is 1:1." )
-                        self.sample_aspect_ratio = '1:1'
-                    else:
-                        # Deal with weird files with rounding error SARs like 649:639.
-                        ( sarwidth, sarheight ) = self.sample_aspect_ratio.split( ':' )
-                        if ( sarwidth != sarheight ) and abs( ( float( sarwidth ) / float( sarheight ) ) - 1 ) < 0.1:
-                            log.warn( "Strange SAR value of %s:%s detected, setting SAR to 1:1." % ( sarwidth, sarheight ) )
-                            self.sample_aspect_ratio = '1:1'
-                    self.pix_fmt = stream.get( 'pix_fmt', '' )
-                    break
 
-            self.channels = None
-            for stream in info['streams']:
-                if stream['codec_type'] == 'audio':
-                    self.channels = int( stream['channels'] )
+            # Packets are listed in decoding order.
+            keyframes = []
+            open_gop = False
+            for packet in info.get( 'packets', [] ):
+                if packet.get( 'pts_time', 'N/A' ) == 'N/A':
+                    continue
+                pts = float( packet['pts_time'] )
+                if 'K' in packet.get( 'flags', '' ):
+                    if len( keyframes ) and open_gop:
+                        keyframes.pop()
+                    keyframes.append( pts )
+                    open_gop = False
+                elif len( keyframes ) and pts < keyframes[-1]:
+                    open_gop = True
+            if len( keyframes ) and open_gop:
+                keyframes.pop()
+
+            self.metadata['keyframes'] = sorted( keyframes )
+            if self.persist:
+                Video.save_metadata( self.filename, self.metadata )
+
+        return self.metadata['keyframes']
+
+    def get_fingerprint( self, peek=False ):
+        '''Returns a fingerprint of the contents of this Video, which is
+        computed once and kept with the metadata of the Video.  If
+        peek is True and the fingerprint has not been computed, the
+        file is not read, and Window.get_file_key( filename, peek=True )
+        is returned instead.'''
+        if 'fingerprint' not in self.metadata and peek:
+            return Window.get_file_key( self.filename, peek=True )
+        elif 'fingerprint' not in self.metadata:
+            self.metadata['fingerprint'] = Video.compute_fingerprint( self.filename )
+            if self.persist:
+                Video.save_metadata( self.filename, self.metadata )
+
+        return self.metadata['fingerprint']
+
+    @staticmethod
+    def compute_fingerprint( filename ):
+        '''Returns an md5 hex digest of the size of filename and a
+        sample of evenly spaced blocks of its contents, or all of its
+        contents if it is small.'''
+        size = os.path.getsize( filename )
+        block_size = Video.fingerprint_block_size
+        blocks = Video.fingerprint_blocks
 
-            self.st_size = file_info.st_size
-            self.st_mtime = file_info.st_mtime
+        md5 = hashlib.md5()
+        md5.update( str( size ).encode( 'utf-8' ) )
+        f = open( filename, 'rb' )
+        try:
+            if size <= block_size * blocks:
+                md5.update( f.read() )
+            else:
+                for block in range( blocks ):
+                    # Spread the blocks from the start to the end of
+                    # the file.
+                    f.seek( ( size - block_size ) * block // ( blocks - 1 ) )
+                    md5.update( f.read( block_size ) )
+        finally:
+            f.close()
 
-            Video.videos[filename] = { 'width'    : self.width,
-                                       'height'   : self.height,
-                                       'duration' : self.duration,
-                                       'sample_aspect_ratio' : self.sample_aspect_ratio,
-                                       'pix_fmt'  : self.pix_fmt,
-                                       'channels' : self.channels,
-                                       'st_size'  : self.st_size,
-                                       'st_mtime' : self.st_mtime }
+        return md5.hexdigest()
 
     def get_width( self ):
         return self.width
@@ -527,6 +961,66 @@ class Window( object ):
       increases rendering time.
     - force - Defaults to False, force regeneration of all video
       content, ignoring what is in the cache.
+    - single_pass - Defaults to False.  If True this Window, its
+      Clips, child Windows, Watermarks, and audio are compiled into a
+      single ffmpeg filter graph and encoded once, rather than
+      producing an intermediate video at each step of rendering.
+      This is much faster and avoids generational quality loss, but
+      does not use the Clip cache, and very large trees may exceed
+      the memory or open file limits of the machine as every input
+      is decoded at once.
+    - smart_cut - Defaults to False.  If True, Clips whose Video
+      already has the width, height, pixel format, frame rate, and
+      codec this Window renders with (or which are OVERLAY Clips) are
+      cut by re-encoding only from the start of the Clip to the next
+      keyframe and from the last keyframe to the end of the Clip, and
+      copying the video in between without re-encoding.  Only
+      keyframes which begin closed GOPs are cut at, and the ends are
+      encoded with the profile and level of the Video; if the
+      parameter sets of the pieces still differ, the Clip is
+      transcoded in full instead.  The audio of such Clips is still
+      re-encoded.
+    - seed - Optional.  OVERLAY Clips are sized and placed at random.
+      If seed is set, the random choices are made by a random number
+      generator seeded with it, so that each render of this Window
+      produces the same output, and can be reused from the cache.
+      Child Windows have their own seed.
+    - pipe_stages - Defaults to False.  If True, the steps of
+      rendering that follow rendering the Clips of this Window
+      (compositing child Windows, Watermarks, the audio_file, and
+      volume adjustment) are all run at once, each streaming
+      uncompressed video to the next over a pipe rather than writing
+      an intermediate file.  This overlaps the work of the steps and
+      avoids their temporary files.  Each step counts against
+      max_concurrency, and steps beyond it write a file for the rest.
+    - encode_segment_duration - Optional.  If set, and this Window is
+      longer than this many seconds, the final encode of the
+      output_file is split at frame boundaries into segments of about
+      this many seconds, which are encoded concurrently and joined
+      without re-encoding.  The audio is normalized in one piece
+      alongside them, so there are no artifacts at the joins.
+    - windowed_overlays - Defaults to False.  OVERLAY Clips are
+      applied overlay_batch_concurrency at a time, and ordinarily
+      each batch re-encodes the whole Window.  If True, each batch
+      re-encodes only the video from the keyframe before its first
+      OVERLAY Clip starts to the keyframe after its last one ends,
+      copying the rest without re-encoding.  If the re-encoded video
+      doesn't have the same stream parameters as the copied video the
+      batch re-encodes the whole Window after all.
+    - audio_only_stages - Defaults to False.  If True, mixing in the
+      audio_file and adjusting the volume are done in one step which
+      only processes the audio, and copies the video without
+      re-encoding it.  The volume of child Windows is not adjusted,
+      as it is adjusted when they are composited into the Window
+      which is rendered.  The audio_desc is still drawn onto the
+      video in a step of its own.
+    - separate_audio - Defaults to False.  If True, and this Window is
+      rendered other than in a single_pass, its audio and that of
+      all its child Windows is compiled into one filter graph, read
+      directly from the Videos of the Clips and the audio_files, and
+      rendered once alongside the video.  The video of this Window
+      and its child Windows is then rendered without audio, and the
+      audio is added once the video is done.
         
     NOTE: Window objects cache data both within and across program
     invocations.  Broadly this saves a ton of compute time by not
@@ -536,7 +1030,10 @@ class Window( object ):
     If two Clips have the same elements here, they are assumed to be
     the same in the Cache:
 
-    - Absolute path to the filename from the underlying Video object
+    - Absolute path to the filename from the underlying Video object,
+      its size, and its modification time (or a fingerprint of its
+      contents if Window.set_content_fingerprints( True ) has been
+      called)
     - Clip start time
     - Clip end time
     - The display_style of the Clip as being rendered in this Window.
@@ -546,6 +1043,10 @@ class Window( object ):
       pan_direction is ALTERNATE)
     - The pixel format of this Window
 
+    Window backgrounds are also cached, by their bgcolor, the contents
+    of their bgimage_file, size, SAR, pixel format, and number of
+    audio channels.
+
     If the Cache is incorrect (most likely because the underlying
     contents of an input filename have changed), the cache should be
     cleared by calling the static clear_cache method of the Window
@@ -553,6 +1054,38 @@ class Window( object ):
 
     Window.clear_cache()
 
+    The output of rendering each Window is also cached, by a hash of
+    all of the above for its Clips along with its own settings,
+    Watermarks, audio, and the hashes of its child Windows.  Windows
+    with OVERLAY Clips, which are placed at random, are only cached if
+    they have a seed.
+
+    The size of the cache may be limited by calling the static
+    set_cache_size_limit method of the Window class with a number of
+    bytes, after which the least recently used cached files are
+    deleted:
+
+    Window.set_cache_size_limit( 50*1024*1024*1024 )
+
+    NOTE: Rendering a Window and its child Windows is laid out as one
+    graph of tasks - transcoding each Clip that is not in the cache,
+    rendering each background, and compositing each Window - and each
+    task is started as soon as the tasks it needs have finished,
+    longest chain of remaining work first.  At most
+    Window.max_concurrency tasks and ffmpeg commands are run at once,
+    which defaults to the number of CPUs and may be changed by
+    calling the static set_max_concurrency method of the Window
+    class:
+
+    Window.set_max_concurrency( 4 )
+
+    NOTE: Intermediate files produced while rendering, including
+    cached Clips, are encoded according to the intermediate profile,
+    which defaults to DELIVERY.  Faster, lossless, but larger
+    intermediates can be selected with:
+
+    Window.set_intermediate_profile( LOSSLESS )
+
     '''
 
     # We use z-index to determine what Windows go on top of others.
@@ -561,9 +1094,72 @@ class Window( object ):
     z = 0
 
     tmpdir = "%s/%s/vedit/" % ( tempfile.gettempdir(), getpass.getuser() )
+
+    # The cache index is an SQLite database in the tmpdir which maps
+    # the hashes of cached Clips and backgrounds to their files.  Each
+    # thread keeps its own connection to it.
+    cache_db_file = 'cacheindex'
+    cache_db_local = threading.local()
+
+    # The number of bytes cached files may use, None for no limit.
+    cache_size_limit = None
+
+    # Whether Clips are cached by the contents of their Video file,
+    # rather than its path, size, and modification time.
+    content_fingerprints = False
+
+    # The fingerprints get_file_key has computed, by the path, size,
+    # and modification time of their file.
+    file_fingerprints = {}
+
+    # Whether the rendered output of each Window is cached, which
+    # costs a copy of each render in the tmpdir.
+    cache_renders = False
+
+    # The keys of cache entries used by renders in progress, which
+    # must not be evicted.
+    cache_pins = set()
+    cache_pin_holds = 0
+    cache_pin_lock = threading.Lock()
+
+    # Earlier versions kept the cache index in this JSON file, which
+    # is imported into the cache index when it is found.
     cache_dict_file = 'cachedb'
+
+    # Deprecated, a copy of the cache index as a dictionary of
+    # filenames by key, filled in by load_cache_dict.
     cache_dict = {}
 
+    # How intermediate files are encoded, see INTERMEDIATE_PROFILES.
+    intermediate_profile = DELIVERY
+
+    # Backgrounds are rendered and cached as segments of this many
+    # seconds, which are looped to the duration of each Window.
+    background_segment_duration = 10
+
+    # The maximum number of ffmpeg commands we will run at once.
+    max_concurrency = multiprocessing.cpu_count()
+    command_slots = threading.BoundedSemaphore( max_concurrency )
+
+    # Held while a pipeline gathers a command slot for each of its
+    # stages, so two pipelines can't each hold slots the other needs.
+    pipeline_lock = threading.Lock()
+
+    # The number of seconds after which commands are killed, None for
+    # no limit.
+    command_timeout = None
+
+    # Called with each FFmpegJob as it progresses and finishes.
+    job_callback = None
+
+    # The number of bytes the intermediate files of a render may use
+    # in the tmpdir, None for no limit.
+    scratch_limit = None
+
+    # Whether ffmpeg commands are handed to farm workers through a
+    # FarmQueue in the tmpdir, rather than run here.
+    render_farm = False
+
     @staticmethod
     def set_tmpdir( tmpdir ):
         if os.path.exists( tmpdir ):
@@ -576,42 +1172,440 @@ class Window( object ):
                 raise( "Error creating tmpdir: %s, error was: %s" % ( tmpdir, e ) )
 
     @staticmethod
-    def load_cache_dict():
+    def set_max_concurrency( max_concurrency ):
+        '''Set the maximum number of ffmpeg commands that will be run at
+        the same time while rendering.  This should not be called
+        while a render is in progress.
+        '''
+        if max_concurrency < 1:
+            raise Exception( "max_concurrency must be at least 1, was: %s" % ( max_concurrency ) )
+        Window.max_concurrency = max_concurrency
+        Window.command_slots = threading.BoundedSemaphore( max_concurrency )
+
+    @staticmethod
+    def set_intermediate_profile( profile ):
+        '''Set how intermediate files produced while rendering, including
+        cached Clips, are encoded.  Must be one of the keys of
+        INTERMEDIATE_PROFILES.
+        '''
+        if profile in INTERMEDIATE_PROFILES:
+            Window.intermediate_profile = profile
+        else:
+            raise Exception( "Invalid intermediate profile: %s, valid intermediate profiles are: %s" % ( profile, sorted( INTERMEDIATE_PROFILES.keys() ) ) )
+
+    @staticmethod
+    def get_codecs( final=False ):
+        '''Returns the INTERMEDIATE_PROFILES entry files should be encoded
+        with, if final is True this is the DELIVERY profile used for
+        output_file, otherwise it is the intermediate_profile.
+        '''
+        if final:
+            return INTERMEDIATE_PROFILES[DELIVERY]
+        else:
+            return INTERMEDIATE_PROFILES[Window.intermediate_profile]
+
+    @staticmethod
+    def set_command_timeout( command_timeout ):
+        '''Set the number of seconds after which a running ffmpeg or
+        ffprobe command is killed, which results in an Exception from
+        whatever was being rendered.  None, the default, means
+        commands may run forever.
+        '''
+        if command_timeout is not None and command_timeout <= 0:
+            raise Exception( "command_timeout must be positive, was: %s" % ( command_timeout ) )
+        Window.command_timeout = command_timeout
+
+    @staticmethod
+    def set_job_callback( job_callback ):
+        '''Set a function which is called with an FFmpegJob each time
+        one of the commands run while rendering reports its progress,
+        and when it finishes.  None, the default, disables the
+        callback.
+        '''
+        Window.job_callback = job_callback
+
+    @staticmethod
+    def set_render_farm( render_farm ):
+        '''If render_farm is True, the ffmpeg commands of renders are
+        not run by this program, but submitted to a FarmQueue in the
+        tmpdir, and run by worker processes started with
+        run_farm_worker, which may be on other machines sharing the
+        tmpdir.  At most max_concurrency commands are submitted at
+        once, so it should be set to the number of commands the
+        workers can run between them.
+        '''
+        Window.render_farm = render_farm
+
+    @staticmethod
+    def get_farm_queue():
+        '''Returns the FarmQueue in the tmpdir.'''
+        return FarmQueue( "%s/%s" % ( Window.tmpdir, FarmQueue.queue_dir ) )
+
+    @staticmethod
+    def run_command( cmd, timeout=None ):
+        '''Run cmd, a list of arguments or a string to split into
+        arguments, as an FFmpegJob, waiting until fewer than
+        max_concurrency commands are running.  timeout defaults to
+        command_timeout.  Returns a ( status, output ) tuple.
+
+        If render_farm is set, ffmpeg commands are run by a farm
+        worker instead, and take none of the command_slots while they
+        wait for it.
+
+        The output of the command, its last argument, is measured by
+        the Workspace which tracks it, if any, which raises an
+        Exception if that puts the Workspace over its scratch_limit.
+        '''
+        if timeout is None:
+            timeout = Window.command_timeout
+
+        job = FFmpegJob( cmd, timeout=timeout, callback=Window.job_callback )
+        if Window.render_farm and os.path.basename( job.argv[0] ) == os.path.basename( FFMPEG ):
+            ( job.status, job.output ) = Window.get_farm_queue().run( job.argv, timeout=timeout )
+        else:
+            with Window.command_slots:
+                job.run()
+        Workspace.measure_output( job.argv[-1] )
+        return ( job.status, job.output )
+
+    @staticmethod
+    def get_cache_db():
         '''If a given Clip is reused across several program invocations, we
         save time by not recreating it.  We store information about
-        what Clips we have around here.
+        what Clips we have around in the cache index.
+
+        Returns this thread's connection to the cache index, creating
+        the cache index if needed.
         '''
-        if os.path.exists( "%s/%s" % ( Window.tmpdir, Window.cache_dict_file ) ):
-            f = open( "%s/%s" % ( Window.tmpdir, Window.cache_dict_file ), 'r' )
-            Window.cache_dict = json.load( f )
-            f.close()
-        else:
+        cache_db_path = "%s/%s" % ( Window.tmpdir, Window.cache_db_file )
+
+        # Reconnect if the tmpdir has changed, or the cache index has
+        # been deleted.
+        db = getattr( Window.cache_db_local, 'db', None )
+        if db is not None and ( Window.cache_db_local.path != cache_db_path or not os.path.exists( cache_db_path ) ):
+            db.close()
+            db = None
+
+        if db is None:
             if not os.path.isdir( Window.tmpdir ):
                 os.makedirs( Window.tmpdir )
-            Window.cache_dict = {}
+            db = sqlite3.connect( cache_db_path, timeout=60 )
+            db.execute( "PRAGMA journal_mode=WAL" )
+            with db:
+                db.execute( "CREATE TABLE IF NOT EXISTS cache ( key TEXT PRIMARY KEY, filename TEXT, size INTEGER, last_access REAL )" )
+                db.execute( "CREATE TABLE IF NOT EXISTS cache_stats ( name TEXT PRIMARY KEY, value INTEGER )" )
+                columns = [ row[1] for row in db.execute( "PRAGMA table_info( cache )" ) ]
+                if 'size' not in columns:
+                    # Cache indices from before there was eviction.
+                    db.execute( "ALTER TABLE cache ADD COLUMN size INTEGER" )
+                    db.execute( "ALTER TABLE cache ADD COLUMN last_access REAL" )
+                    for ( key, filename ) in db.execute( "SELECT key, filename FROM cache" ).fetchall():
+                        db.execute( "UPDATE cache SET size = ?, last_access = ? WHERE key = ?", ( Window.get_file_size( filename ), time.time(), key ) )
+            Window.cache_db_local.db = db
+            Window.cache_db_local.path = cache_db_path
+            Window.import_cache_dict( db )
+
+        return db
+
+    @staticmethod
+    def import_cache_dict( db ):
+        '''Import the JSON cache index of earlier versions, if there is
+        one, into the cache index db and then remove it.
+        '''
+        cache_file = "%s/%s" % ( Window.tmpdir, Window.cache_dict_file )
+        if os.path.exists( cache_file ):
+            log.info( "Importing cache index from %s" % ( cache_file ) )
+            try:
+                f = open( cache_file, 'r' )
+                cache_dict = json.load( f )
+                f.close()
+            except ( IOError, ValueError ) as e:
+                log.warn( "Could not import cache index from %s: %s" % ( cache_file, e ) )
+                return
+            with db:
+                db.executemany( "INSERT OR IGNORE INTO cache ( key, filename, size, last_access ) VALUES ( ?, ?, ?, ? )", [ ( key, filename, Window.get_file_size( filename ), time.time() ) for ( key, filename ) in cache_dict.items() ] )
+            try:
+                os.remove( cache_file )
+            except OSError:
+                # Another process imported it first.
+                pass
+
+    @staticmethod
+    def load_cache_dict():
+        '''Deprecated, use get_cache_entry.
+
+        Copy the cache index into Window.cache_dict.
+        '''
+        log.warn( "Window.load_cache_dict is deprecated and will be removed, use Window.get_cache_entry." )
+        db = Window.get_cache_db()
+        Window.cache_dict = dict( db.execute( "SELECT key, filename FROM cache" ).fetchall() )
 
     @staticmethod
     def save_cache_dict():
-        '''If a given Clip is reused across several program invocations, we
-        save time by not recreating it.  We store information about
-        what Clips we have around here.
+        '''Deprecated, use add_cache_entry.
+
+        Add the entries of Window.cache_dict to the cache index.
         '''
-        if not os.path.isdir( Window.tmpdir ):
-            os.makedirs( Window.tmpdir )
+        log.warn( "Window.save_cache_dict is deprecated and will be removed, use Window.add_cache_entry." )
+        for ( key, filename ) in list( Window.cache_dict.items() ):
+            Window.add_cache_entry( key, filename )
 
-        f = open( "%s/%s" % ( Window.tmpdir, Window.cache_dict_file ), 'w' )
-        json.dump( Window.cache_dict, f )
-        f.close()
+    @staticmethod
+    def get_cache_entry( key, peek=False, filename=None ):
+        '''Returns the filename cached under key, or None if there is no
+        such file.  Records the access for the purposes of eviction,
+        unless peek is True, in which case the cache is left as it
+        was.
+
+        If filename is given, it is where the file for key is put in
+        the cache, and it is used if it exists even though the cache
+        index does not know about it, as when another program has
+        just published it.  A peek only answers from the cache index.
+        '''
+        db = Window.get_cache_db()
+        row = db.execute( "SELECT filename FROM cache WHERE key = ?", ( key, ) ).fetchone()
+        if row is None and filename is not None and not peek and os.path.exists( filename ):
+            log.info( "Found %s in the cache directory without a cache index entry." % ( filename ) )
+            Window.add_cache_entry( key, filename )
+            row = ( filename, )
+        if peek:
+            if row is not None and os.path.exists( row[0] ):
+                return row[0]
+            else:
+                return None
+        with db:
+            if row is not None and os.path.exists( row[0] ):
+                db.execute( "UPDATE cache SET last_access = ? WHERE key = ?", ( time.time(), key ) )
+                Window.add_cache_stat( db, 'hits', 1 )
+                Window.pin_cache_entry( key )
+                return row[0]
+            else:
+                if row is not None:
+                    db.execute( "DELETE FROM cache WHERE key = ?", ( key, ) )
+                Window.add_cache_stat( db, 'misses', 1 )
+                return None
+
+    @staticmethod
+    def add_cache_entry( key, filename ):
+        '''Record that filename is cached under key, and evict old
+        entries if the cache is now larger than cache_size_limit.'''
+        db = Window.get_cache_db()
+        with db:
+            db.execute( "INSERT OR REPLACE INTO cache ( key, filename, size, last_access ) VALUES ( ?, ?, ?, ? )", ( key, filename, Window.get_file_size( filename ), time.time() ) )
+        Window.pin_cache_entry( key )
+
+        if Window.cache_size_limit is not None:
+            Window.evict_cache( keep=[ key ] )
+
+    @staticmethod
+    def hold_cache_pins():
+        '''Note that a render has started.  Until every render that has
+        started has finished, the cache entries they use are pinned,
+        and will not be evicted.
+        '''
+        with Window.cache_pin_lock:
+            Window.cache_pin_holds += 1
+
+    @staticmethod
+    def release_cache_pins():
+        '''Note that a render has finished, and once no renders are in
+        progress evict anything that was pinned beyond the
+        cache_size_limit.'''
+        with Window.cache_pin_lock:
+            Window.cache_pin_holds -= 1
+            released = ( Window.cache_pin_holds == 0 )
+            if released:
+                Window.cache_pins.clear()
+
+        if released and Window.cache_size_limit is not None:
+            Window.evict_cache()
+
+    @staticmethod
+    def pin_cache_entry( key ):
+        with Window.cache_pin_lock:
+            if Window.cache_pin_holds > 0:
+                Window.cache_pins.add( key )
+
+    @staticmethod
+    def add_cache_stat( db, name, value ):
+        db.execute( "INSERT OR IGNORE INTO cache_stats ( name, value ) VALUES ( ?, 0 )", ( name, ) )
+        db.execute( "UPDATE cache_stats SET value = value + ? WHERE name = ?", ( value, name ) )
+
+    @staticmethod
+    def get_file_size( filename ):
+        if os.path.exists( filename ):
+            return os.path.getsize( filename )
+        else:
+            return 0
+
+    @staticmethod
+    def get_file_key( filename, peek=False ):
+        '''Returns a string which changes if the file at filename
+        changes, for use in cache keys, or None if filename is None.
+
+        If peek is True and the fingerprint of filename is needed but
+        has not been computed, the file is not read, and a key which
+        no cache entry is stored under is returned instead.
+        '''
+        if filename is None:
+            return None
+
+        filename = os.path.abspath( filename )
+        file_info = os.stat( filename )
+        file_key = "%s:%s:%s" % ( filename, file_info.st_size, file_info.st_mtime )
+        if Window.content_fingerprints:
+            # Each file is only read once while it is unchanged.
+            if file_key not in Window.file_fingerprints:
+                if peek:
+                    return "unfingerprinted:%s" % ( file_key )
+                Window.file_fingerprints[file_key] = Video.compute_fingerprint( filename )
+            return Window.file_fingerprints[file_key]
+        else:
+            return file_key
+
+    @staticmethod
+    def set_content_fingerprints( content_fingerprints ):
+        '''If content_fingerprints is True, Clips are cached by a
+        fingerprint of the contents of their Video file rather than its
+        path, size, and modification time.  Cached Clips then survive
+        their Video files being copied, moved, or touched, and are
+        shared between identical files at different paths.  Changing
+        this setting does not invalidate the cache, but Clips cached
+        under one setting are not found under the other.
+        '''
+        Window.content_fingerprints = content_fingerprints
+
+    @staticmethod
+    def set_cache_renders( cache_renders ):
+        '''If cache_renders is True, the rendered output of each Window
+        and child Window is kept in the cache, so rendering an
+        unchanged Window again reuses it.  This costs the disk space
+        of a copy of every render, so is off by default, in which case
+        only Clips and backgrounds are cached.
+        '''
+        Window.cache_renders = cache_renders
+
+    @staticmethod
+    def set_scratch_limit( scratch_limit ):
+        '''Set the number of bytes the intermediate files of a render
+        may use in the tmpdir, not counting files in the cache.  A
+        render which exceeds this raises an Exception before starting
+        its next command.  None, the default, means there is no limit.
+        '''
+        if scratch_limit is not None and scratch_limit < 0:
+            raise Exception( "scratch_limit must not be negative, was: %s" % ( scratch_limit ) )
+        Window.scratch_limit = scratch_limit
+
+    @staticmethod
+    def set_cache_size_limit( cache_size_limit ):
+        '''Set the number of bytes the files in the cache may use,
+        beyond which the least recently used files are deleted.  None,
+        the default, means there is no limit.
+        '''
+        if cache_size_limit is not None and cache_size_limit < 0:
+            raise Exception( "cache_size_limit must not be negative, was: %s" % ( cache_size_limit ) )
+        Window.cache_size_limit = cache_size_limit
+
+    @staticmethod
+    def evict_cache( cache_size_limit=None, keep=None ):
+        '''Delete the least recently used files in the cache until the
+        cache uses no more than cache_size_limit bytes, which defaults
+        to Window.cache_size_limit.  Returns the number of files
+        deleted.
+
+        Files in use by renders in progress in this program, and those
+        cached under the keys in the optional keep list, are not
+        deleted, so the cache may remain larger than
+        cache_size_limit.
+        '''
+        if keep is None:
+            keep = []
+        with Window.cache_pin_lock:
+            keep = set( keep ) | Window.cache_pins
+
+        if cache_size_limit is None:
+            cache_size_limit = Window.cache_size_limit
+        if cache_size_limit is None:
+            return 0
+
+        db = Window.get_cache_db()
+        with db:
+            total = db.execute( "SELECT COALESCE( SUM( size ), 0 ) FROM cache" ).fetchone()[0]
+            if total <= cache_size_limit:
+                return 0
+
+            evicted = []
+            for ( key, filename, size ) in db.execute( "SELECT key, filename, size FROM cache ORDER BY last_access" ).fetchall():
+                if total <= cache_size_limit:
+                    break
+                if key in keep:
+                    continue
+                evicted.append( ( key, filename, size ) )
+                total -= size
+
+            db.executemany( "DELETE FROM cache WHERE key = ?", [ ( key, ) for ( key, filename, size ) in evicted ] )
+            Window.add_cache_stat( db, 'evictions', len( evicted ) )
+            Window.add_cache_stat( db, 'evicted_bytes', sum( [ size for ( key, filename, size ) in evicted ] ) )
+
+        for ( key, filename, size ) in evicted:
+            log.info( "Evicting %s from the cache." % ( filename ) )
+            try:
+                os.remove( filename )
+            except OSError as e:
+                log.warn( "Error while evicting file %s from the cache: %s" % ( filename, e ) )
+        Video.forget_metadata( [ filename for ( key, filename, size ) in evicted ] )
+
+        return len( evicted )
+
+    @staticmethod
+    def get_cache_stats():
+        '''Returns a dictionary of statistics about the cache: the number
+        of entries and bytes in it, its size limit, and the number of
+        hits, misses, evictions, and evicted_bytes since it was
+        created.
+        '''
+        db = Window.get_cache_db()
+        ( entries, total ) = db.execute( "SELECT COUNT(*), COALESCE( SUM( size ), 0 ) FROM cache" ).fetchone()
+        stats = { 'entries'          : entries,
+                  'bytes'            : total,
+                  'cache_size_limit' : Window.cache_size_limit,
+                  'hits'             : 0,
+                  'misses'           : 0,
+                  'evictions'        : 0,
+                  'evicted_bytes'    : 0 }
+        for ( name, value ) in db.execute( "SELECT name, value FROM cache_stats" ):
+            stats[name] = value
+        return stats
     
     @staticmethod
     def clear_cache():
         '''Try to remove all the files in the tmpdir.  This is necessary if,
         for example, an input Video filename has new contents.
+
+        The cache index and metadata database may be open in this and
+        other programs, so rather than being deleted they are emptied.
         '''
         if os.path.isdir( Window.tmpdir ):
+            db = Window.get_cache_db()
+            with db:
+                db.execute( "DELETE FROM cache" )
+                db.execute( "DELETE FROM cache_stats" )
+            Video.clear_metadata()
+
+            databases = set()
+            for db_file in [ Window.cache_db_file, Video.metadata_db_file ]:
+                for suffix in [ '', '-wal', '-shm', '-journal' ]:
+                    databases.add( "%s%s" % ( db_file, suffix ) )
+
             for cache_file in glob.glob( "%s/*" % ( Window.tmpdir ) ):
+                if os.path.basename( cache_file ) in databases:
+                    continue
                 try:
-                    os.remove( cache_file )
+                    if os.path.isdir( cache_file ):
+                        # Such as the FarmQueue directory.
+                        shutil.rmtree( cache_file )
+                    else:
+                        os.remove( cache_file )
                 except Exception as e:
                     raise Exception( "Error while deleting file %s: %s" % ( cache_file, e ) )
 
@@ -679,9 +1673,45 @@ class Window( object ):
                                                   # setting it lower
                                                   # increases rendering
                                                   # time.
-                  force = False # If true then we disregard the cache
-                                # and regenerate clips each time we
-                                # encounter them.
+                  force = False, # If true then we disregard the cache
+                                 # and regenerate clips each time we
+                                 # encounter them.
+                  single_pass = False, # If true then this Window and
+                                       # all its child Windows are
+                                       # compiled into a single ffmpeg
+                                       # command and encoded once.
+                  smart_cut = False, # If true then Clips which need
+                                     # no scaling are cut from their
+                                     # Video by copying rather than
+                                     # re-encoding where possible.
+                  pipe_stages = False, # If true then the rendering
+                                       # steps after the Clips are
+                                       # rendered are connected by
+                                       # pipes rather than files.
+                  seed = None, # If set, the random placement of
+                               # OVERLAY Clips is the same each time
+                               # this Window is rendered.
+                  encode_segment_duration = None, # If set, the final
+                                                  # encode of the
+                                                  # output_file is split
+                                                  # into segments of
+                                                  # about this many
+                                                  # seconds which are
+                                                  # encoded at once.
+                  windowed_overlays = False, # If true then each batch
+                                             # of OVERLAY Clips only
+                                             # re-encodes the part of
+                                             # the video it covers.
+                  audio_only_stages = False, # If true then mixing in
+                                             # the audio_file and
+                                             # adjusting the volume
+                                             # copy the video rather
+                                             # than re-encoding it.
+                  separate_audio = False # If true then the audio of
+                                         # this Window and all its
+                                         # child Windows is rendered
+                                         # once on its own, and the
+                                         # video without audio.
                   ):
 
         if windows is not None:
@@ -730,7 +1760,7 @@ class Window( object ):
                 raise Exception( "No audio found at: %s" % ( audio_file ) )
             else:
                 self.audio_file = audio_file
-                ( status, output ) = subprocess.getstatusoutput( "%s -v quiet -print_format json -show_streams %s" % ( FFPROBE, audio_file ) )
+                ( status, output ) = Window.run_command( [ FFPROBE, '-v', 'quiet', '-print_format', 'json', '-show_streams', audio_file ] )
                 audio_info = json.loads( output )
                 for stream in audio_info['streams']:
                     if stream['codec_type'] == 'audio':
@@ -763,14 +1793,37 @@ class Window( object ):
         else:
             self.display = Display()
 
-        if Window.cache_dict == {}:
-            Window.load_cache_dict()
-
         self.output_file = output_file
         
         self.overlay_batch_concurrency = overlay_batch_concurrency
 
         self.force = force               
+
+        self.single_pass = single_pass
+
+        self.smart_cut = smart_cut
+
+        self.pipe_stages = pipe_stages
+
+        self.seed = seed
+        self.reset_rng()
+
+        if encode_segment_duration is not None and encode_segment_duration <= 0:
+            raise Exception( "encode_segment_duration must be positive, was: %s" % ( encode_segment_duration ) )
+        self.encode_segment_duration = encode_segment_duration
+
+        self.windowed_overlays = windowed_overlays
+
+        self.audio_only_stages = audio_only_stages
+
+        self.separate_audio = separate_audio
+
+        # The Workspace of the render in progress, if any.
+        self.workspace = None
+
+        # True if the render in progress renders the video of this
+        # Window without audio, as it has a separate_audio ancestor.
+        self.video_only = False
     
 
     ### Window method ########################################
@@ -792,45 +1845,106 @@ class Window( object ):
 
 
     ### Window method ########################################
-    def get_next_renderfile( self ):
+    def get_next_renderfile( self, final=False ):
         '''Internal utility function, we need to generate a bunch of
         intermediate files, this generates unique names for them.
 
+        If final is True the name is for a file which will be encoded
+        for delivery, rather than with the intermediate_profile.
+
         '''
-        return "%s/%s.mp4" % ( Window.tmpdir, str( uuid.uuid4() ) )
+        return self.add_scratch_file( "%s/%s.%s" % ( Window.tmpdir, str( uuid.uuid4() ), Window.get_codecs( final )['extension'] ) )
 
 
     ### Window method ########################################
-    def render( self, helper=False, audio_channels=None ):
-        '''If helper is true we're rendering a sub-window, the result of which
-        is an intermediate file stored in the tmpdir somewhere.  If
-        helper is False then we are rendering user output, and it will
-        go in the path specified by self.output_file.
+    def write_scratch_file( self, contents, prefix="" ):
+        '''Internal utility function which writes contents to a
+        uniquely named text file in the tmpdir, and returns its path.
+        '''
+        filename = self.add_scratch_file( "%s/%s%s.txt" % ( Window.tmpdir, prefix, str( uuid.uuid4() ) ) )
+        f = open( filename, 'w' )
+        f.write( contents )
+        f.close()
+        Workspace.measure_output( filename )
+        return filename
+
+
+    ### Window method ########################################
+    def add_scratch_file( self, filename ):
+        '''Internal utility function which adds filename to the
+        Workspace of the render in progress, if any, so it is deleted
+        once it has been used.
 
+        Returns filename.
         '''
+        if self.workspace is not None:
+            self.workspace.add( filename )
+        return filename
 
-        # File to accumulate things in.
-        tmpfile = None
+
+    ### Window method ########################################
+    def release_scratch_file( self, filename ):
+        '''Internal utility function which deletes filename if it is
+        an intermediate file of the render in progress.  Files in the
+        cache, and files of the user, are left alone.
+        '''
+        if self.workspace is not None:
+            self.workspace.release( filename )
+
+
+    ### Window method ########################################
+    def resolve_render_settings( self, audio_channels=None ):
+        '''Internal utility function which sets the sample aspect ratio,
+        pixel format, and duration this Window will be rendered with,
+        as determined by get_render_settings, given the audio_channels
+        of its parent Window (None if this is the base Window).
+
+        Returns a ( audio_channels, sar_clause ) tuple where
+        sar_clause is a filter clause which sets the SAR of a video
+        stream.
+
+        '''
+
+        ( audio_channels, self.sample_aspect_ratio, self.pix_fmt, self.duration ) = self.get_render_settings( audio_channels, warn=True )
+
+        sar_clause = ""
+        if self.sample_aspect_ratio is not None:
+            # FFMPEG has deprecated the W:H notation in favor of W/H...
+            ( sarwidth, sarheight ) = self.sample_aspect_ratio.split( ':' )
+            sar_clause = ",setsar=sar=%s/%s" % ( sarwidth, sarheight )
+
+        return ( audio_channels, sar_clause )
+
+
+    ### Window method ########################################
+    def get_render_settings( self, audio_channels=None, pix_fmt=None, warn=False ):
+        '''Internal utility function which determines the audio
+        channels, sample aspect ratio, pixel format, and duration this
+        Window will be rendered with, given the audio_channels of its
+        parent Window (None if this is the base Window), without
+        changing this Window.  pix_fmt is used if this Window has no
+        pix_fmt of its own, as for a child Window which takes that of
+        its parent.  If warn is true, settings which were filled in or
+        look like mistakes are logged.
+
+        Returns a ( audio_channels, sample_aspect_ratio, pix_fmt,
+        duration ) tuple.
+
+        '''
 
         child_windows = [ w for w in self.get_child_windows() ]
         all_windows = [ self ] + child_windows
 
+        own_pix_fmt = self.pix_fmt
+        if own_pix_fmt is None:
+            own_pix_fmt = pix_fmt
+
         ###### Audio Channel stuff ###########################
-        # Determine the audio channel configuration of this set of clips.
-        #
         # If audio_channels is None then this is a base window and we
         # need to calculate the correct number of channels for this
         # and all child windows.
         if audio_channels is None:
-            clip_channels = set( [ clip.get_channels() for window in all_windows for clip in window.clips if clip.get_channels() is not None ] )
-            if len( clip_channels ) > 1:
-                log.warn( "Different clips have different numbers of audio channels: %s, converting all clips to mono." % ( clip_channels ) )
-                audio_channels = 1
-            elif len( clip_channels ) == 0:
-                log.info( "No input audio channels, will add silent mono channel to output." )
-                audio_channels = 1
-            else:
-                audio_channels = clip_channels.pop()
+            audio_channels = self.get_audio_channels()
 
         ###### SAR stuff #####################################
         # Determine the output SAR for this video, or raise an
@@ -841,236 +1955,1780 @@ class Window( object ):
             raise Exception( "Multiple different sample aspect ratios present in input videos: %s.  Please preprocess your inputs to all have the same SARs." % ( sars ) )
         elif len( sars ) == 1:
             computed_sar = sars.pop()
-            
-        if self.sample_aspect_ratio is None:
-            if computed_sar is not None:
-                self.sample_aspect_ratio = computed_sar
-        else:
-            if computed_sar is not None and computed_sar != self.sample_aspect_ratio:
-                # It's OK to mismatch these things, but usually it
-                # will be an error that stretches the video by the
-                # ratio of the input over the output SAR.
-                log.warn( "input videos/child windows have SAR of %s, but the output SAR of %s has been specified, this may result in distorted output." % ( computed_sar, self.sample_aspect_ratio ) )
 
-        sar_clause = ""
-        if self.sample_aspect_ratio is not None:
-            # FFMPEG has deprecated the W:H notation in favor of W/H...
-            ( sarwidth, sarheight ) = self.sample_aspect_ratio.split( ':' )
-            sar_clause = ",setsar=sar=%s/%s" % ( sarwidth, sarheight )
+        sample_aspect_ratio = self.sample_aspect_ratio
+        if sample_aspect_ratio is None:
+            sample_aspect_ratio = computed_sar
+        elif warn and computed_sar is not None and computed_sar != sample_aspect_ratio:
+            # It's OK to mismatch these things, but usually it
+            # will be an error that stretches the video by the
+            # ratio of the input over the output SAR.
+            log.warn( "input videos/child windows have SAR of %s, but the output SAR of %s has been specified, this may result in distorted output." % ( computed_sar, sample_aspect_ratio ) )
 
         ###### Pixel Format stuff #############################
-        pix_fmts = set( [ w.pix_fmt for w in all_windows if w.pix_fmt is not None ] )
+        pix_fmts = set( [ own_pix_fmt ] + [ w.pix_fmt for w in child_windows ] )
+        pix_fmts.discard( None )
 
         computed_pix_fmt = None
         if len( pix_fmts ) > 1:
             raise Exception( "Multiple different color space / pixel format arguments for output windows: %s.  All output windows must have the same pixel format." % ( pix_fmts ) )
         elif len( pix_fmts ) == 1:
             computed_pix_fmt = pix_fmts.pop()
-            
-        if self.pix_fmt is None and computed_pix_fmt is not None:
-            self.pix_fmt = computed_pix_fmt
+
+        if own_pix_fmt is None and computed_pix_fmt is not None:
+            own_pix_fmt = computed_pix_fmt
         else:
-            self.pix_fmt = 'yuv420p'
-        
+            own_pix_fmt = 'yuv420p'
+
         ###### Duration stuff ################################
-        if self.duration is None:
-            my_duration = max( [ w.compute_duration( w.clips ) for w in all_windows ] )
-            if my_duration == 0:
+        duration = self.duration
+        if duration is None:
+            duration = max( [ w.compute_duration( w.clips ) for w in all_windows ] )
+            if duration == 0:
                 raise Exception( "Could not determine duration for window." )
-            else:
-                log.warn( "No duration specified for window, set duration to %s, the longest duration of clips in this or any of its child windows." % ( my_duration ) )
-                self.duration = my_duration
+            elif warn:
+                log.warn( "No duration specified for window, set duration to %s, the longest duration of clips in this or any of its child windows." % ( duration ) )
 
+        return ( audio_channels, sample_aspect_ratio, own_pix_fmt, duration )
 
-        ###### Background stuff ##############################
-        background_file = self.get_next_renderfile()
-        if self.bgimage_file is not None:
-            # Lay down a background with silent audio if requested to.
-            cmd = '%s -y -loop 1 -i %s -f lavfi -i aevalsrc=0 -ac %d -c:a libfdk_aac -pix_fmt %s -r 30000/1001 -crf 16 -c:v libx264 -filter_complex " color=%s:size=%dx%d,setpts=PTS-STARTPTS/TB [base] ; [0] setpts=PTS-STARTPTS/TB [image]; [base] [image] overlay%s " -t %f %s' % ( FFMPEG, self.bgimage_file, audio_channels, self.pix_fmt, self.bgcolor, self.width, self.height, sar_clause, self.duration, background_file )
-            log.info( "Running: %s" % ( cmd ) )
-            ( status, output ) = subprocess.getstatusoutput( cmd )
-            log.debug( "Output was: %s" % ( output ) )
-            if status != 0 or not os.path.exists( background_file ):
-                raise Exception( "Error producing background image video file %s with command: %s\n\nOutput was: %s" % ( background_file, cmd, output ) )
+
+    ### Window method ########################################
+    def get_audio_channels( self ):
+        '''Internal utility function that determines the audio channel
+        configuration of the clips of this Window and all its child
+        Windows, which a base Window is rendered with.
+        '''
+        all_windows = self.get_child_windows( include_self=True )
+        clip_channels = set( [ clip.get_channels() for window in all_windows for clip in window.clips if clip.get_channels() is not None ] )
+        if len( clip_channels ) > 1:
+            log.warn( "Different clips have different numbers of audio channels: %s, converting all clips to mono." % ( clip_channels ) )
+            return 1
+        elif len( clip_channels ) == 0:
+            log.info( "No input audio channels, will add silent mono channel to output." )
+            return 1
+        else:
+            return clip_channels.pop()
+
+
+    ### Window method ########################################
+    def render( self, helper=False, audio_channels=None ):
+        '''If helper is true we're rendering a sub-window, the result of which
+        is an intermediate file stored in the tmpdir somewhere.  If
+        helper is False then we are rendering user output, and it will
+        go in the path specified by self.output_file.
+
+        Returns the path of the rendered file, which is in the cache
+        where the render could be cached, or else is an intermediate
+        file for a helper, or self.output_file for user output.  All
+        other intermediate files are deleted once they are used.
+
+        '''
+
+        # Intermediate files are deleted as soon as they have been
+        # used, and anything left over when we are done, other than
+        # the file we return, is deleted then.  Child Windows share
+        # the Workspace of the Window which renders them.
+        owner = self.workspace is None
+        if owner:
+            self.workspace = Workspace( Window.scratch_limit )
+
+        # Files we take from the cache must not be evicted until we
+        # are done with them.
+        Window.hold_cache_pins()
+        result = None
+        try:
+            # The work of rendering this Window and all of its child
+            # Windows is laid out as one graph of tasks, which is then
+            # run with up to max_concurrency tasks at a time.
+            scheduler = Scheduler( Window.max_concurrency )
+            task = self.schedule_window( scheduler, helper=helper, audio_channels=audio_channels )
+            scheduler.run()
+            result = task['result']
+            if owner and not helper and result in self.workspace.files:
+                # The result was not cached, and output_file is a copy
+                # of it, so there is no need to keep it.
+                result = self.output_file
+            return result
+        finally:
+            Window.release_cache_pins()
+            if owner:
+                self.workspace.cleanup( keep=[ result ] )
+                log.info( "Render used at most %d bytes of scratch space." % ( self.workspace.peak_usage ) )
+                for window in self.get_child_windows( include_self=True ):
+                    window.workspace = None
+                    window.video_only = False
+
+
+    ### Window method ########################################
+    def schedule_window( self, scheduler, helper=False, audio_channels=None ):
+        '''Internal utility function which adds the work of render to
+        scheduler, reusing the output of an earlier render of an
+        identical Window from the cache where possible.
+
+        Renders are only cached if Window.cache_renders is set.  If
+        scheduler is a dry run, as for plan, the cache is consulted
+        without recording the access.
+
+        Returns the task whose result is the path of the rendered
+        file.
+        '''
+        ( audio_channels, sar_clause ) = self.resolve_render_settings( audio_channels )
+
+        if not helper:
+            self.set_video_only()
+
+        self.reset_rng()
+
+        render_hash = None
+        if Window.cache_renders:
+            render_hash = self.get_render_hash( audio_channels, final=not helper, peek=scheduler.dry_run )
+        if render_hash is not None and not self.force:
+            cached_file = Window.get_cache_entry( render_hash, peek=scheduler.dry_run, filename=self.get_render_cache_file( render_hash, helper ) )
+            if cached_file is not None:
+                log.info( "Using cached render of window: %s" % ( cached_file ) )
+                self.advance_pans()
+
+                def use_cached():
+                    if not helper:
+                        shutil.copyfile( cached_file, self.output_file )
+                    return cached_file
+
+                return scheduler.add( use_cached, name="using cached render of window %s" % ( render_hash ), cached=True )
+
+        if self.single_pass:
+            task = scheduler.add( functools.partial( self.render_single_pass, helper=helper, audio_channels=audio_channels ),
+                                  cost=self.width * self.height * self.duration,
+                                  name="rendering window in a single pass" )
+        else:
+            task = self.schedule_multi_pass( scheduler, helper, audio_channels, sar_clause )
+
+        if render_hash is None:
+            return task
+
+        def cache_render():
+            tmpfile = task['result']
+            cached_file = self.get_render_cache_file( render_hash, helper )
+            if self.workspace is not None:
+                self.workspace.forget( tmpfile )
+            os.rename( tmpfile, cached_file )
+            Window.add_cache_entry( render_hash, cached_file )
+            return cached_file
+
+        return scheduler.add( cache_render, depends=[ task ], name="caching render of window %s" % ( render_hash ) )
+
+
+    ### Window method ########################################
+    def set_video_only( self ):
+        '''Internal utility function which marks whether this Window
+        and its child Windows are to be rendered without audio,
+        because this Window has separate_audio set.
+        '''
+        video_only = self.separate_audio and not self.single_pass
+        for window in self.get_child_windows( include_self=True ):
+            window.video_only = video_only
+
+
+    ### Window method ########################################
+    def get_render_cache_file( self, render_hash, helper ):
+        '''Internal utility function that returns the path in the cache
+        of the render of this Window under render_hash.'''
+        return "%s/%s.%s" % ( Window.tmpdir, render_hash, Window.get_codecs( final=not helper )['extension'] )
+
+
+    ### Window method ########################################
+    def plan( self ):
+        '''Work out what rendering this Window would do, without running
+        any ffmpeg commands.
+
+        The plan is the graph of tasks render would run, laid out by
+        the same code, so it shows which would be satisfied from the
+        cache, which each waits on, an estimate of the work each
+        would do, and the settings each Window would be rendered
+        with.  Files which have not been fingerprinted are not read,
+        so what is cached under their fingerprints is planned as not
+        cached.  Returns a RenderPlan.
+
+        The duration, sample_aspect_ratio, pix_fmt, and pan
+        directions which render determines are put back as they were
+        afterwards, so planning does not change what a later render
+        does.
+        '''
+        windows = list( self.get_child_windows( include_self=True ) )
+        settings = [ ( window, window.duration, window.sample_aspect_ratio, window.pix_fmt ) for window in windows ]
+        displays = set( [ window.get_display( clip ) for window in windows for clip in window.clips ] )
+        pans = [ ( display, display.prior_pan ) for display in displays ]
+
+        plan = RenderPlan()
+        try:
+            audio_channels = self.get_audio_channels()
+            scheduler = Scheduler( dry_run=True )
+            self.schedule_window( scheduler, audio_channels=audio_channels )
+            plan.add_tasks( scheduler.tasks )
+            for window in windows:
+                plan.add_window( window, audio_channels )
+        finally:
+            for ( window, duration, sample_aspect_ratio, pix_fmt ) in settings:
+                window.duration = duration
+                window.sample_aspect_ratio = sample_aspect_ratio
+                window.pix_fmt = pix_fmt
+            for ( display, prior_pan ) in pans:
+                display.prior_pan = prior_pan
+            for window in windows:
+                window.video_only = False
+
+        return plan
+
+
+    ### Window method ########################################
+    def reset_rng( self ):
+        '''Internal utility function that sets up the random number
+        generator used to place OVERLAY Clips in this Window, so a
+        Window with a seed makes the same random choices each time it
+        is rendered.'''
+        if self.seed is not None:
+            self.rng = random.Random( self.seed )
+        else:
+            self.rng = random
+
+
+    ### Window method ########################################
+    def get_render_hash( self, audio_channels, final=False, settings=None, peek=False ):
+        '''Internal utility function that returns a hash of everything
+        which determines the output of rendering this Window, including
+        the hashes of its child Windows, so that identical Windows can
+        reuse earlier renders from the cache.
+
+        The sample aspect ratio, pixel format, and duration are those
+        this Window has been resolved to, or are given in settings as
+        a ( sample_aspect_ratio, pix_fmt, duration ) tuple for a
+        Window which has not been resolved yet, as for child Windows,
+        whose settings are worked out here without changing them.
+
+        output_file, force, and Window.max_concurrency are left out
+        because they don't change what is rendered, and the x, y, and
+        z_index of child Windows are in the record of their parent.
+
+        If peek is True, as for plan, files whose fingerprints have not
+        been computed are not read, see get_file_key.
+
+        Returns None if the output of this Window can't be reused,
+        because it or a child Window has OVERLAY Clips, which are
+        placed at random, and no seed.
+        '''
+        if final:
+            profile = DELIVERY
+        else:
+            profile = Window.intermediate_profile
+
+        if settings is None:
+            settings = ( self.sample_aspect_ratio, self.pix_fmt, self.duration )
+        ( sample_aspect_ratio, pix_fmt, duration ) = settings
+
+        record = [ 'window',
+                   self.width,
+                   self.height,
+                   self.bgcolor,
+                   Window.get_file_key( self.bgimage_file, peek ),
+                   duration,
+                   sample_aspect_ratio,
+                   pix_fmt,
+                   audio_channels,
+                   profile,
+                   Window.get_file_key( self.audio_file, peek ),
+                   self.audio_desc,
+                   self.single_pass,
+                   self.smart_cut,
+                   self.pipe_stages,
+                   self.overlay_batch_concurrency,
+                   Window.background_segment_duration,
+                   self.seed ]
+
+        # Segmented encoding only changes the encode of output_file.
+        if final and self.encode_segment_duration is not None:
+            record.append( self.encode_segment_duration )
+
+        if self.windowed_overlays:
+            record.append( 'windowed_overlays' )
+
+        if self.audio_only_stages:
+            record.append( 'audio_only_stages' )
+
+        if self.video_only:
+            record.append( 'separate_audio' )
+
+        for clip in self.clips:
+            display = self.get_display( clip )
+            if display.display_style == OVERLAY and self.seed is None:
+                return None
+
+            if Window.content_fingerprints:
+                source = clip.video.get_fingerprint( peek )
+            else:
+                source = Window.get_file_key( clip.video.filename )
+
+            record.append( [ source,
+                             clip.start,
+                             clip.end,
+                             display.display_style,
+                             display.pad_bgcolor,
+                             display.overlay_concurrency,
+                             display.overlay_direction,
+                             display.overlay_min_gap,
+                             display.pan_direction,
+                             display.prior_pan,
+                             display.include_audio ] )
+
+        for watermark in self.watermarks:
+            record.append( self.get_watermark_record( watermark, peek ) )
+
+        for window in sorted( self.windows, key=lambda x: x.z_index ):
+            window_settings = window.get_render_settings( audio_channels, pix_fmt=pix_fmt )[1:]
+            window_hash = window.get_render_hash( audio_channels, settings=window_settings, peek=peek )
+            if window_hash is None:
+                return None
+            record.append( [ window.x, window.y, window_hash ] )
+
+        md5 = hashlib.md5()
+        md5.update( json.dumps( record ).encode( 'utf-8' ) )
+        return md5.hexdigest()
+
+
+    ### Window method ########################################
+    def advance_pans( self ):
+        '''Internal utility function which advances the pan direction of
+        the Displays of the Clips of this and all child Windows as
+        rendering them would have.'''
+        for window in self.get_child_windows( include_self=True ):
+            for clip in window.clips:
+                display = window.get_display( clip )
+                if display.display_style == PAN:
+                    ( scale, ow, oh ) = window.get_output_dimensions( clip.video.width, clip.video.height, window.width, window.height, max )
+                    if ow > window.width or oh > window.height:
+                        display.get_pan_direction()
+
+
+    ### Window method ########################################
+    def schedule_multi_pass( self, scheduler, helper, audio_channels, sar_clause ):
+        '''Internal utility function which adds the work of rendering
+        this Window a step at a time, producing an intermediate file
+        at each step, to scheduler.
+
+        Returns the task whose result is the path of the rendered
+        file.
+        '''
+
+        ###### Render This Window's Clips and Child Windows #
+        # The background and clips of this Window and each of its
+        # child Windows don't depend on one another, so they are all
+        # scheduled at once, and then the child Windows are
+        # composited on top in z_index order.
+        windows = sorted( self.windows, key=lambda x: x.z_index )
+        for window in windows:
+            if window.pix_fmt is None:
+                window.pix_fmt = self.pix_fmt
+            window.workspace = self.workspace
+
+        # The final encode of a long Window may be split into
+        # segments, in which case the last stage, which normalizes
+        # the volume, is done by the segment tasks.
+        segments = None
+        if not helper:
+            segments = self.get_encode_segments()
+
+        # With separate_audio, the audio of this Window and all its
+        # child Windows is rendered on its own while the video is,
+        # and added to the video at the end.
+        audio = None
+        if self.video_only and not helper:
+            graph = FilterGraph()
+            audio_label = self.compile_audio( graph, audio_channels )
+            audio = scheduler.add( functools.partial( self.render_audio, graph, audio_label, audio_channels ),
+                                   name="rendering audio" )
+
+        audio_track = None
+        if segments is None:
+            audio_track = audio
+
+        # The Watermarks are rendered into a layer on their own, which
+        # Windows with the same size, duration, and Watermarks share.
+        watermarks = None
+        if len( self.watermarks ) > 0:
+            layer_hash = self.get_watermark_layer_hash( peek=scheduler.dry_run )
+            watermarks = self.schedule_cached( scheduler, layer_hash, self.get_watermark_layer_file( layer_hash ),
+                                               self.render_watermark_layer,
+                                               cost=self.width * self.height * self.duration,
+                                               name="watermark layer" )
+
+        # Every step re-encodes the whole Window, other than the one
+        # which only processes the audio, unless it has to encode the
+        # video for delivery.  The watermark layer is overlaid by one
+        # of the steps, or else by the last step of compositing the
+        # clips, or by each segment of the final encode.
+        ( steps, audio_step, final, layer ) = self.get_composite_steps( windows, helper, segments is not None, audio_track is not None, watermarks is not None, len( self.clips ) > 0 )
+        passes = len( steps )
+        if audio_step is not None and not audio_step['copy_video']:
+            passes += 1
+
+        background = self.schedule_background( scheduler, audio_channels, sar_clause )
+        clips = self.schedule_clips( scheduler, self.clips, background, audio_channels, watermarks=watermarks if layer == 'clips' else None )
+        children = [ window.schedule_window( scheduler, helper=True, audio_channels=audio_channels ) for window in windows ]
+
+        # The audio_file is converted once to the number of channels
+        # we render, and the conversion cached.
+        converted = None
+        if self.audio_file and not self.video_only and self.audio_file_channels != audio_channels:
+            audio_hash = self.get_audio_file_hash( audio_channels )
+            converted = self.schedule_cached( scheduler, audio_hash, "%s/%s.%s" % ( Window.tmpdir, audio_hash, Window.get_codecs()['extension'] ),
+                                              functools.partial( self.convert_audio_file, audio_channels ),
+                                              cost=0,
+                                              name="conversion of audio file %s to %d channels" % ( self.audio_file, audio_channels ) )
+
+        def composite():
+            audio_file = None
+            if audio_track is not None:
+                audio_file = audio_track['result']
+            watermark_layer = None
+            if layer == 'step':
+                watermark_layer = watermarks['result']
+            audio_tmpfile = self.audio_file
+            if converted is not None:
+                audio_tmpfile = converted['result']
+            return self.composite_window( windows, clips['result'], [ child['result'] for child in children ], helper, audio_channels, sar_clause, segmented=segments is not None, audio_track=audio_file, watermark_layer=watermark_layer, audio_tmpfile=audio_tmpfile )
+
+        name = "compositing window"
+        if len( steps ):
+            name = "compositing window: %s" % ( ", ".join( [ step['name'] for step in steps ] ) )
+
+        composited = scheduler.add( composite,
+                                    depends=[ clips ] + children + [ task for task in [ audio_track, watermarks if layer == 'step' else None, converted ] if task is not None ],
+                                    cost=self.width * self.height * self.duration * passes,
+                                    name=name )
+        if segments is None:
+            return composited
+
+        if audio is None:
+            audio = scheduler.add( lambda: self.normalize_audio( composited['result'], audio_channels ),
+                                   depends=[ composited ],
+                                   name="normalizing audio" )
+
+        # The segments are split where the intermediate file has
+        # keyframes, which are only known once it has been rendered.
+        bounds = scheduler.add( lambda: self.align_encode_segments( composited['result'], segments ),
+                                depends=[ composited ],
+                                name="finding segment boundaries" )
+
+        segment_layer = None
+        if layer == 'segments':
+            segment_layer = watermarks
+
+        def encode( idx ):
+            ( start_frame, frames ) = bounds['result'][idx]
+            watermark_layer = None
+            if segment_layer is not None:
+                watermark_layer = segment_layer['result']
+            return self.encode_segment( composited['result'], start_frame, frames, watermark_layer=watermark_layer )
+
+        encoded = []
+        for idx, ( start_frame, frames ) in enumerate( segments ):
+            if frames is None:
+                duration = self.duration - start_frame * 1001 / 30000.0
+            else:
+                duration = frames * 1001 / 30000.0
+            encoded.append( scheduler.add( functools.partial( encode, idx ),
+                                           depends=[ task for task in [ bounds, segment_layer ] if task is not None ],
+                                           cost=self.width * self.height * duration,
+                                           name="encoding segment %d" % ( idx + 1 ) ) )
+
+        return scheduler.add( lambda: self.join_segments( composited['result'], [ segment['result'] for segment in encoded ], audio['result'] ),
+                              depends=[ audio ] + encoded,
+                              name="joining segments" )
+
+
+    ### Window method ########################################
+    def get_encode_segments( self ):
+        '''Internal utility function that splits the final encode of this
+        Window into segments of about encode_segment_duration seconds,
+        each a whole number of frames.
+
+        Frames are counted at 30000/1001 frames per second, the rate
+        every Window is rendered and encoded at, whatever the rate of
+        its Clips.
+
+        Returns a list of ( start_frame, frames ) tuples, where frames
+        is None for the last segment which runs to the end, or None
+        if the encode should not be split.
+        '''
+        if self.encode_segment_duration is None or self.duration <= self.encode_segment_duration:
+            return None
+
+        # Our output is always 30000/1001 frames per second.
+        total_frames = int( round( self.duration * 30000 / 1001.0 ) )
+        segment_frames = max( 1, int( round( self.encode_segment_duration * 30000 / 1001.0 ) ) )
+
+        segments = []
+        for start_frame in range( 0, total_frames, segment_frames ):
+            segments.append( ( start_frame, segment_frames ) )
+        segments[-1] = ( segments[-1][0], None )
+
+        return segments
+
+
+    ### Window method ########################################
+    def align_encode_segments( self, current, segments ):
+        '''Internal utility function which moves each boundary between
+        the segments, as returned by get_encode_segments, to the
+        nearest keyframe of current, the intermediate file to be
+        encoded, if there is one within a quarter of a segment.  A
+        segment which starts on a keyframe decodes only the frames it
+        encodes, where otherwise seeking to its start decodes and
+        throws away the frames since the keyframe before it.
+
+        Returns a list of ( start_frame, frames ) tuples like
+        segments.
+        '''
+        segment_frames = segments[0][1]
+        tolerance = segment_frames // 4
+        keyframes = [ int( round( keyframe * 30000 / 1001.0 ) ) for keyframe in Video( current, persist=False ).get_keyframes() ]
+
+        starts = [ 0 ]
+        for ( start_frame, frames ) in segments[1:]:
+            nearby = [ keyframe for keyframe in keyframes if abs( keyframe - start_frame ) <= tolerance and keyframe > starts[-1] ]
+            if len( nearby ):
+                start_frame = min( nearby, key=lambda x: abs( x - start_frame ) )
+            starts.append( start_frame )
+
+        aligned = []
+        for idx, start_frame in enumerate( starts ):
+            if idx == len( starts ) - 1:
+                aligned.append( ( start_frame, None ) )
+            else:
+                aligned.append( ( start_frame, starts[idx + 1] - start_frame ) )
+
+        log.debug( "Segment boundaries of %s aligned to keyframes: %s" % ( current, aligned ) )
+        return aligned
+
+
+    ### Window method ########################################
+    def normalize_audio( self, current, audio_channels ):
+        '''Internal utility function which normalizes the volume of the
+        audio of current, as get_volume_cmd does, into an audio only
+        file encoded for delivery.
+
+        Returns the path of the file it generated.
+        '''
+        codecs = Window.get_codecs( final=True )
+        tmpfile = self.get_next_renderfile( final=True )
+        cmd = [ FFMPEG, '-y', '-i', current, '-vn' ] + codecs['audio'].split() + [ '-ac', '%d' % ( audio_channels ), '-af', '[0:a] dynaudnorm=g=3', tmpfile ]
+        log.info( "Running: %s" % ( FFmpegJob.quote_cmd( cmd ) ) )
+        ( status, output ) = Window.run_command( cmd )
+        log.debug( "Output was: %s" % ( output ) )
+        if status != 0 or not os.path.exists( tmpfile ):
+            raise Exception( "Error normalizing audio of file %s with command: %s\n\nOutput was: %s" % ( current, FFmpegJob.quote_cmd( cmd ), output ) )
+
+        return tmpfile
+
+
+    ### Window method ########################################
+    def encode_segment( self, current, start_frame, frames, watermark_layer=None ):
+        '''Internal utility function which encodes the video of current
+        for delivery, starting at start_frame, for frames frames or to
+        the end if frames is None.  Each segment begins with a
+        keyframe, so the segments can be joined without re-encoding.
+        If watermark_layer is given the same part of it is overlaid on
+        the video.
+
+        Seeking the input of a transcode decodes and drops the frames
+        before the time sought, so the segments hold exactly the
+        frames a single encode of current would, each in one segment.
+        The only frames which can differ are those past duration,
+        which the join drops with -t just as the single encode does.
+
+        Returns the path of the file it generated.
+        '''
+        codecs = Window.get_codecs( final=True )
+        tmpfile = self.get_next_renderfile( final=True )
+        # Seek half a frame early, so rounding the time to
+        # microseconds can't skip start_frame.
+        start = max( 0, ( start_frame - 0.5 ) * 1001 / 30000.0 )
+
+        frames_args = []
+        if frames is not None:
+            frames_args = [ '-frames:v', '%d' % ( frames ) ]
+
+        if watermark_layer is not None:
+            cmd = [ FFMPEG, '-y', '-ss', '%f' % ( start ), '-i', current, '-ss', '%f' % ( start ), '-i', watermark_layer, '-an', '-pix_fmt', self.pix_fmt, '-r', '30000/1001' ] + codecs['video'].split() + [ '-filter_complex', '%s [outv]' % ( self.get_watermark_layer_clause( '0:v', 1 ) ), '-map', '[outv]' ] + frames_args + [ tmpfile ]
+        else:
+            cmd = [ FFMPEG, '-y', '-ss', '%f' % ( start ), '-i', current, '-an', '-pix_fmt', self.pix_fmt, '-r', '30000/1001' ] + codecs['video'].split() + frames_args + [ tmpfile ]
+        log.info( "Running: %s" % ( FFmpegJob.quote_cmd( cmd ) ) )
+        ( status, output ) = Window.run_command( cmd )
+        log.debug( "Output was: %s" % ( output ) )
+        if status != 0 or not os.path.exists( tmpfile ):
+            raise Exception( "Error encoding segment at frame %d of file %s with command: %s\n\nOutput was: %s" % ( start_frame, current, FFmpegJob.quote_cmd( cmd ), output ) )
+
+        return tmpfile
+
+
+    ### Window method ########################################
+    def join_segments( self, current, segment_files, audio_file ):
+        '''Internal utility function which joins the encoded
+        segment_files of current without re-encoding them, adds
+        audio_file, and copies the result to the output_file.
+
+        Returns the path of the file it generated.
+        '''
+        concat_file = self.write_scratch_file( "".join( [ "file '%s'\n" % ( segment_file ) for segment_file in segment_files ] ), prefix="concat-" )
+        tmpfile = self.get_next_renderfile( final=True )
+        cmd = [ FFMPEG, '-y', '-f', 'concat', '-safe', '0', '-i', concat_file, '-i', audio_file, '-map', '0:v', '-map', '1:a', '-c', 'copy', '-t', '%f' % ( self.duration ), tmpfile ]
+        log.info( "Running: %s" % ( FFmpegJob.quote_cmd( cmd ) ) )
+        ( status, output ) = Window.run_command( cmd )
+        log.debug( "Output was: %s" % ( output ) )
+        if status != 0 or not os.path.exists( tmpfile ):
+            raise Exception( "Error joining segments of file %s with command: %s\n\nOutput was: %s" % ( current, FFmpegJob.quote_cmd( cmd ), output ) )
+
+        for filename in [ current, concat_file, audio_file ] + segment_files:
+            self.release_scratch_file( filename )
+
+        shutil.copyfile( tmpfile, self.output_file )
+
+        return tmpfile
+
+
+    ### Window method ########################################
+    def composite_window( self, windows, tmpfile, window_files, helper, audio_channels, sar_clause, segmented=False, audio_track=None, watermark_layer=None, audio_tmpfile=None ):
+        '''Internal utility function which composites the rendered child
+        Windows in window_files, Watermarks, and audio onto tmpfile,
+        the rendered Clips of this Window, in the steps given by
+        get_composite_steps.
+
+        If segmented is True the volume is not adjusted, and the
+        result is left as an intermediate file for the segmented
+        final encode.
+
+        If this Window is rendered without audio, as for
+        separate_audio, the audio steps are skipped, and audio_track,
+        if given, is added as the audio of the result.
+
+        watermark_layer is the output of render_watermark_layer if
+        this Window has Watermarks and one of these steps overlays
+        it, and audio_tmpfile is the
+        audio_file of this Window, converted to audio_channels
+        channels, if it has one.
+
+        Returns the path of the file it generated.
+        '''
+
+        ###### Composite Child Windows, Watermarks, and Audio #
+        #
+        # Each of these stages reads the output of the prior stage,
+        # so we gather them up and run them one after the other, or
+        # all at once connected by pipes if pipe_stages is set.
+        ( steps, audio_step, final, layer ) = self.get_composite_steps( windows, helper, segmented, audio_track is not None, watermark_layer is not None, len( self.clips ) > 0 )
+
+        stages = []
+        for step in steps:
+            layer = None
+            layer_inputs = []
+            if step['watermarks']:
+                layer = watermark_layer
+                layer_inputs = [ watermark_layer ]
+
+            if step['kind'] == 'window':
+                window = windows[step['index']]
+                window_file = window_files[step['index']]
+                cmd = functools.partial( self.get_composite_cmd, window, window_file, audio_channels, sar_clause, watermark_layer=layer )
+                inputs = [ window_file ] + layer_inputs
+            elif step['kind'] == 'audio_desc':
+                cmd = functools.partial( self.get_audio_desc_cmd, sar_clause, watermark_layer=layer )
+                inputs = layer_inputs
+            elif step['kind'] == 'audio':
+                cmd = functools.partial( self.get_audio_cmd, audio_tmpfile, audio_channels, sar_clause, watermark_layer=layer )
+                inputs = [ audio_tmpfile ] + layer_inputs
+            elif step['kind'] == 'volume':
+                cmd = functools.partial( self.get_volume_cmd, audio_channels, watermark_layer=layer )
+                inputs = layer_inputs
+            else:
+                cmd = functools.partial( self.get_watermark_layer_cmd, watermark_layer )
+                inputs = [ watermark_layer ]
+
+            stages.append( { 'name'   : step['name'],
+                             'cmd'    : cmd,
+                             'inputs' : inputs } )
+
+        audio_stage = None
+        if audio_step is None:
+            pass
+        elif audio_step['kind'] == 'mux':
+            audio_stage = { 'name'   : audio_step['name'],
+                            'cmd'    : functools.partial( self.get_mux_cmd, audio_track, audio_step['copy_video'] ),
+                            'inputs' : [ audio_track ] }
+        else:
+            mix_file = None
+            if audio_step['mix']:
+                mix_file = audio_tmpfile
+            audio_stage = { 'name'   : audio_step['name'],
+                            'cmd'    : functools.partial( self.get_audio_only_cmd, mix_file, audio_channels, audio_step['normalize'], audio_step['copy_video'] ),
+                            'inputs' : [ filename for filename in [ mix_file ] if filename is not None ] }
+
+        if len( stages ) == 0:
+            pass
+        elif self.pipe_stages:
+            tmpfile = self.run_piped_stages( stages, tmpfile, final=final )
+        else:
+            tmpfile = self.run_stages( stages, tmpfile, final=final )
+
+        if audio_stage is not None:
+            tmpfile = self.run_stages( [ audio_stage ], tmpfile, final=final )
+
+        if final:
+            shutil.copyfile( tmpfile, self.output_file )
+
+        # Render returns the path of the file it generated.
+        return tmpfile
+
+
+    ### Window method ########################################
+    def get_composite_steps( self, windows, helper, segmented, audio_track, watermarks, clips ):
+        '''Internal utility function which works out the steps
+        composite_window takes to composite the child Windows in
+        windows, Watermarks, and audio onto the rendered Clips of this
+        Window, so that schedule_multi_pass can estimate their work
+        from the same steps.  audio_track and watermarks are True if
+        there is a separately rendered audio track to add, and a
+        watermark layer to overlay, and clips is True if this Window
+        has Clips.
+
+        Returns a ( steps, audio_step, final, layer ) tuple.  steps is the
+        list of steps which re-encode the video, each a dictionary
+        with the kind of step, its name, the index in windows of the
+        child Window it composites, and whether it overlays the
+        watermark layer.  audio_step is None, or the step run after
+        them which only processes the audio, with its kind, name,
+        whether it mixes in the audio_file and normalizes the volume,
+        and whether it copies the video.  final is True if the last
+        step encodes for delivery.  layer says what overlays the
+        watermark layer: 'step' for one of steps, 'clips' for the last
+        step of composite_clips, 'segments' for each encode_segment of
+        a segmented final encode, or None if there are no Watermarks.
+        '''
+        steps = []
+
+        def add_step( kind, name, index=None ):
+            steps.append( { 'kind'       : kind,
+                            'name'       : name,
+                            'index'      : index,
+                            'watermarks' : False } )
+
+        for idx in range( len( windows ) ):
+            add_step( 'window', "applying overlay window %d" % ( idx + 1 ), idx )
+
+        ###### Add Audio and Description #####################
+        mix = False
+        if self.audio_file and self.video_only:
+            # The audio_file is part of the separately rendered audio.
+            if self.audio_desc:
+                add_step( 'audio_desc', "adding audio description" )
+        elif self.audio_file:
+            if self.audio_only_stages and not self.audio_desc:
+                # Mixed in along with the volume adjustment below.
+                mix = True
+            else:
+                add_step( 'audio', "adding audio" )
+
+        ###### Fix overall volume issues.
+        normalize = not segmented and not self.video_only
+        if self.audio_only_stages:
+            # The volume of a child Window is adjusted along with
+            # that of the Window it is composited into.
+            normalize = normalize and not helper
+
+        # This is the last step, so unless we are a helper, or the
+        # final encode is segmented, we encode for delivery.
+        final = not helper and not segmented
+
+        # With audio_only_stages the audio_file and volume adjustment
+        # are done by one step which processes only the audio.
+        audio_only = not audio_track and self.audio_only_stages and ( mix or normalize )
+
+        if normalize and not audio_only:
+            add_step( 'volume', "adjusting volume" )
+
+        ###### Render Watermarks #############################
+        # The Watermarks go on top of the child Windows, and are
+        # overlaid from their pre-rendered layer by the step which
+        # composites the last child Window, or else the next step
+        # which re-encodes the video.  Without any such step, they
+        # are overlaid by the last step of compositing the Clips, or
+        # by each segment of the final encode, which re-encode the
+        # video anyway, and only failing that by a step of their own.
+        layer = None
+        if watermarks:
+            layer = 'step'
+            if len( steps ) == 0:
+                if clips:
+                    layer = 'clips'
+                elif segmented:
+                    layer = 'segments'
+                else:
+                    add_step( 'watermarks', "adding watermarks" )
+
+            if layer == 'step':
+                idx = 0
+                if len( windows ):
+                    idx = len( windows ) - 1
+                steps[idx]['watermarks'] = True
+
+        # The video is copied by audio steps, unless this is the final
+        # encode and there is no other step to encode it for delivery.
+        copy_video = len( steps ) > 0 or not final or Window.intermediate_profile == DELIVERY
+
+        audio_step = None
+        if audio_track:
+            audio_step = { 'kind'       : 'mux',
+                           'name'       : "adding audio track",
+                           'mix'        : False,
+                           'normalize'  : False,
+                           'copy_video' : copy_video }
+        elif audio_only:
+            audio_step = { 'kind'       : 'audio_only',
+                           'name'       : "processing audio",
+                           'mix'        : mix,
+                           'normalize'  : normalize,
+                           'copy_video' : copy_video }
+
+        return ( steps, audio_step, final, layer )
+
+
+    ### Window method ########################################
+    def get_composite_cmd( self, window, window_file, audio_channels, sar_clause, current, codecs, output, watermark_layer=None ):
+        '''Internal utility function that returns the ffmpeg command
+        which overlays window_file, the rendered child Window window,
+        on current, encoding with codecs and writing the result to
+        output.  If watermark_layer is given it is overlaid on top.
+        '''
+        layer_args = []
+        video_clause = "[v0] [v1] overlay=x=%s:y=%s:eof_action=pass%s [outv]" % ( window.x, window.y, sar_clause )
+        if watermark_layer is not None:
+            layer_args = [ '-i', watermark_layer ]
+            video_clause = "[v0] [v1] overlay=x=%s:y=%s:eof_action=pass%s [c] ; %s [outv]" % ( window.x, window.y, sar_clause, self.get_watermark_layer_clause( 'c', 2 ) )
+
+        if self.video_only:
+            return [ FFMPEG, '-y', '-i', current, '-i', window_file ] + layer_args + [ '-an', '-pix_fmt', window.pix_fmt, '-r', '30000/1001' ] + codecs['video'].split() + [ '-filter_complex', '[0:v] fifo [v0] ; [1:v] fifo [v1] ; %s' % ( video_clause ), '-map', '[outv]', '-t', '%f' % ( self.duration ), output ]
+
+        return [ FFMPEG, '-y', '-i', current, '-i', window_file ] + layer_args + [ '-pix_fmt', window.pix_fmt, '-r', '30000/1001' ] + codecs['video'].split() + [ '-ac', '%d' % ( audio_channels ) ] + codecs['audio'].split() + [ '-filter_complex', '[0:v] fifo [v0] ; [1:v] fifo [v1] ; %s ; [0:a] afifo [a0] ; [1:a] afifo [a1] ; [a0] [a1] amix=inputs=2:duration=longest:dropout_transition=5 [outa]' % ( video_clause ), '-map', '[outv]', '-map', '[outa]', '-t', '%f' % ( self.duration ), output ]
+
+
+    ### Window method ########################################
+    def get_audio_cmd( self, audio_tmpfile, audio_channels, sar_clause, current, codecs, output, watermark_layer=None ):
+        '''Internal utility function that returns the ffmpeg command
+        which mixes audio_tmpfile into current and displays the
+        audio_desc, encoding with codecs and writing the result to
+        output.  If watermark_layer is given it is overlaid beneath
+        the audio_desc.
+        '''
+        ( audio_fade_start, audio_fade_duration ) = self.get_audio_fade()
+        afade_args = codecs['audio'].split() + [ '-filter_complex', '[1:a] afade=t=out:st=%f:d=%f [a1] ; [0:a] [a1] amix=inputs=2:duration=longest:dropout_transition=5' % ( audio_fade_start, audio_fade_duration ) ]
+
+        layer_args = []
+        video_filters = []
+        if watermark_layer is not None:
+            layer_args = [ '-i', watermark_layer ]
+            video_filters.append( self.get_watermark_layer_clause( '0:v', 2 ) )
+
+        if self.audio_desc:
+            audio_desc_file = self.write_scratch_file( self.audio_desc )
+            video_filters.append( "drawtext=fontcolor=white:fontsize=24:borderw=1:textfile=%s:x=10:y=h-th-10:enable=gt(t\,%f)%s" % ( audio_desc_file, max( 0, self.duration - 5 ), sar_clause ) )
+
+        filter_args = [ '-vf', 'copy' ]
+        if len( video_filters ):
+            filter_args = [ '-filter_complex', ",".join( video_filters ) ]
+
+        return [ FFMPEG, '-y', '-i', current, '-i', audio_tmpfile ] + layer_args + [ '-ac', '%d' % ( audio_channels ), '-pix_fmt', self.pix_fmt ] + codecs['video'].split() + afade_args + filter_args + [ '-t', '%f' % ( self.duration ), output ]
+
+
+    ### Window method ########################################
+    def get_audio_desc_cmd( self, sar_clause, current, codecs, output, watermark_layer=None ):
+        '''Internal utility function that returns the ffmpeg command
+        which displays the audio_desc on current, which has no audio,
+        encoding with codecs and writing the result to output.  If
+        watermark_layer is given it is overlaid beneath the
+        audio_desc.
+        '''
+        audio_desc_file = self.write_scratch_file( self.audio_desc )
+
+        layer_args = []
+        video_filters = []
+        if watermark_layer is not None:
+            layer_args = [ '-i', watermark_layer ]
+            video_filters.append( self.get_watermark_layer_clause( '0:v', 1 ) )
+        video_filters.append( "drawtext=fontcolor=white:fontsize=24:borderw=1:textfile=%s:x=10:y=h-th-10:enable=gt(t\,%f)%s" % ( audio_desc_file, max( 0, self.duration - 5 ), sar_clause ) )
+
+        return [ FFMPEG, '-y', '-i', current ] + layer_args + [ '-an', '-pix_fmt', self.pix_fmt ] + codecs['video'].split() + [ '-filter_complex', ",".join( video_filters ), '-t', '%f' % ( self.duration ), output ]
+
+
+    ### Window method ########################################
+    def get_mux_cmd( self, audio_track, copy_video, current, codecs, output ):
+        '''Internal utility function that returns the ffmpeg command
+        which adds audio_track, already encoded with codecs, as the
+        audio of current, writing the result to output.  If copy_video
+        is True the video of current is copied rather than re-encoded
+        with codecs.
+        '''
+        if copy_video:
+            video_args = [ '-c:v', 'copy' ]
         else:
-            # There was no background image, lay down a solid color with silent audio.
-            cmd = '%s -y -f lavfi -i aevalsrc=0 -ac %d -c:a libfdk_aac -pix_fmt %s -r 30000/1001 -crf 16 -c:v libx264  -filter_complex " color=%s:size=%dx%d%s,setpts=PTS-STARTPTS/TB " -t %f %s' % ( FFMPEG, audio_channels, self.pix_fmt, self.bgcolor, self.width, self.height, sar_clause, self.duration, background_file )
-            log.info( "Running: %s" % ( cmd ) )
-            ( status, output ) = subprocess.getstatusoutput( cmd )
+            video_args = [ '-pix_fmt', self.pix_fmt ] + codecs['video'].split()
+
+        return [ FFMPEG, '-y', '-i', current, '-i', audio_track, '-map', '0:v', '-map', '1:a' ] + video_args + [ '-c:a', 'copy', '-t', '%f' % ( self.duration ), output ]
+
+
+    ### Window method ########################################
+    def render_audio( self, graph, audio, audio_channels ):
+        '''Internal utility function which renders the output labeled
+        audio of the FilterGraph graph, as built by compile_audio, to
+        an audio only file encoded for delivery.
+
+        Returns the path of the file it generated.
+        '''
+        graph_file = self.write_scratch_file( graph.get_filter_complex(), prefix="filter-" )
+
+        codecs = Window.get_codecs( final=True )
+        tmpfile = self.get_next_renderfile( final=True )
+        cmd = [ FFMPEG, '-y' ] + graph.get_input_args() + [ '-filter_complex_script', graph_file, '-map', '[%s]' % ( audio ), '-vn' ] + codecs['audio'].split() + [ '-ac', '%d' % ( audio_channels ), '-t', '%f' % ( self.duration ), tmpfile ]
+        log.info( "Running: %s" % ( FFmpegJob.quote_cmd( cmd ) ) )
+        log.debug( "Filter graph was: %s" % ( graph.get_filter_complex() ) )
+        ( status, output ) = Window.run_command( cmd )
+        log.debug( "Output was: %s" % ( output ) )
+        if status != 0 or not os.path.exists( tmpfile ):
+            raise Exception( "Error rendering audio with command: %s\n\nFilter graph was: %s\n\nOutput was: %s" % ( FFmpegJob.quote_cmd( cmd ), graph.get_filter_complex(), output ) )
+        self.release_scratch_file( graph_file )
+
+        return tmpfile
+
+
+    ### Window method ########################################
+    def get_audio_only_cmd( self, audio_tmpfile, audio_channels, normalize, copy_video, current, codecs, output ):
+        '''Internal utility function that returns the ffmpeg command
+        which mixes audio_tmpfile into current, if it is not None, and
+        normalizes the volume of the result if normalize is True,
+        encoding with codecs and writing the result to output.  If
+        copy_video is True the video of current is copied rather than
+        re-encoded.
+        '''
+        inputs = [ '-i', current ]
+        filters = []
+        sources = "[0:a]"
+        chain = []
+        if audio_tmpfile is not None:
+            inputs += [ '-i', audio_tmpfile ]
+            ( audio_fade_start, audio_fade_duration ) = self.get_audio_fade()
+            filters.append( "[1:a] afade=t=out:st=%f:d=%f [a1]" % ( audio_fade_start, audio_fade_duration ) )
+            sources = "[0:a] [a1]"
+            chain.append( "amix=inputs=2:duration=longest:dropout_transition=5" )
+        if normalize:
+            chain.append( "dynaudnorm=g=3" )
+        filters.append( "%s %s [outa]" % ( sources, ",".join( chain ) ) )
+
+        if copy_video:
+            video_args = [ '-c:v', 'copy' ]
+        else:
+            video_args = [ '-pix_fmt', self.pix_fmt ] + codecs['video'].split()
+
+        return [ FFMPEG, '-y' ] + inputs + [ '-map', '0:v', '-map', '[outa]' ] + video_args + [ '-ac', '%d' % ( audio_channels ) ] + codecs['audio'].split() + [ '-filter_complex', " ; ".join( filters ), '-t', '%f' % ( self.duration ), output ]
+
+
+    ### Window method ########################################
+    def convert_audio_file( self, audio_channels ):
+        '''Internal utility function which converts the audio_file of
+        this Window to have audio_channels channels.  The conversion
+        is cached by schedule_multi_pass, so other renders of the same
+        audio_file can reuse it.
+
+        Returns the path of the file it generated.
+        '''
+        # Convert the input audio file to the right number of channels.
+        codecs = Window.get_codecs()
+        tmpfile = self.get_next_renderfile()
+        cmd = [ FFMPEG, '-y', '-i', self.audio_file, '-ac', '%d' % ( audio_channels ) ] + codecs['audio'].split() + [ '-vn', tmpfile ]
+        log.info( "Running: %s" % ( FFmpegJob.quote_cmd( cmd ) ) )
+        ( status, output ) = Window.run_command( cmd )
+        log.debug( "Output was: %s" % ( output ) )
+        if status != 0 or not os.path.exists( tmpfile ):
+            raise Exception( "Error converting audio file %s to have %d channels with command: %s\n\nOutput was: %s" % ( self.audio_file, audio_channels, FFmpegJob.quote_cmd( cmd ), output ) )
+
+        return tmpfile
+
+
+    ### Window method ########################################
+    def get_audio_file_hash( self, audio_channels ):
+        '''Internal utility function that returns the key the
+        audio_file of this Window converted to audio_channels channels
+        is cached under.
+        '''
+        audio_name = "audio_file%s%s%s" % ( Window.get_file_key( self.audio_file ),
+                                            audio_channels,
+                                            Window.intermediate_profile )
+
+        md5 = hashlib.md5()
+        md5.update( audio_name.encode( 'utf-8' ) )
+        return md5.hexdigest()
+
+
+    ### Window method ########################################
+    def get_volume_cmd( self, audio_channels, current, codecs, output, watermark_layer=None ):
+        '''Internal utility function that returns the ffmpeg command
+        which normalizes the volume of current, encoding with codecs
+        and writing the result to output.  If watermark_layer is given
+        it is overlaid on the video.
+        '''
+        if watermark_layer is not None:
+            return [ FFMPEG, '-y', '-i', current, '-i', watermark_layer, '-pix_fmt', self.pix_fmt ] + codecs['video'].split() + codecs['audio'].split() + [ '-ac', '%d' % ( audio_channels ), '-filter_complex', '%s [outv] ; [0:a] dynaudnorm=g=3 [outa]' % ( self.get_watermark_layer_clause( '0:v', 1 ) ), '-map', '[outv]', '-map', '[outa]', output ]
+
+        return [ FFMPEG, '-y', '-i', current, '-pix_fmt', self.pix_fmt ] + codecs['video'].split() + codecs['audio'].split() + [ '-ac', '%d' % ( audio_channels ), '-vf', 'copy', '-af', '[0:a] dynaudnorm=g=3', output ]
+
+
+    ### Window method ########################################
+    def run_stages( self, stages, current, final=False ):
+        '''Internal utility function which runs each of stages in turn,
+        each stage reading the file written by the prior stage, the
+        first reading current.
+
+        stages is a list of dictionaries with a 'name' describing the
+        stage, a 'cmd' function which is called with ( input, codecs,
+        output ) and returns an ffmpeg command as a list of arguments
+        ending with output, and optionally a list
+        of other 'inputs' the command reads.  If final is True the
+        last stage is encoded for delivery.
+
+        The inputs of each stage are released once it has run.
+
+        Returns the path of the file written by the last stage.
+        '''
+        for idx, stage in enumerate( stages ):
+            last = ( idx == len( stages ) - 1 )
+            tmpfile = self.get_next_renderfile( final=final and last )
+            cmd = stage['cmd']( current, Window.get_codecs( final=final and last ), tmpfile )
+            log.info( "Running: %s" % ( FFmpegJob.quote_cmd( cmd ) ) )
+            ( status, output ) = Window.run_command( cmd )
             log.debug( "Output was: %s" % ( output ) )
-            if status != 0 or not os.path.exists( background_file ):
-                raise Exception( "Error producing solid background file %s with command: %s\n\nOutput was: %s" % ( background_file, cmd, output ) )
+            if status != 0 or not os.path.exists( tmpfile ):
+                raise Exception( "Error %s for file %s with command: %s\n\nOutput was: %s" % ( stage['name'], current, FFmpegJob.quote_cmd( cmd ), output ) )
+            for filename in [ current ] + stage.get( 'inputs', [] ):
+                self.release_scratch_file( filename )
+            current = tmpfile
+
+        return current
+
+
+    ### Window method ########################################
+    def run_piped_stages( self, stages, current, final=False ):
+        '''Internal utility function which runs stages as for
+        run_stages, except that all the stages are started at once,
+        each one reading uncompressed NUT from the standard output of
+        the prior stage, so only the last stage writes a file.
+
+        Each stage takes a command slot while it runs.  More stages
+        than max_concurrency are run as several pipelines, each of
+        which writes a file for the next.
+
+        Returns the path of the file written by the last stage.
+        '''
+        width = Window.max_concurrency
+        if len( stages ) > width:
+            for start in range( 0, len( stages ), width ):
+                current = self.run_piped_stages( stages[start:start + width], current, final=final and start + width >= len( stages ) )
+            return current
+
+        tmpfile = self.get_next_renderfile( final=final )
+
+        cmds = []
+        stage_input = current
+        for idx, stage in enumerate( stages ):
+            if idx == len( stages ) - 1:
+                cmds.append( stage['cmd']( stage_input, Window.get_codecs( final=final ), tmpfile ) )
+            else:
+                cmd = stage['cmd']( stage_input, INTERMEDIATE_PROFILES[RAWVIDEO], 'pipe:1' )
+                cmds.append( cmd[:-1] + [ '-f', 'nut', cmd[-1] ] )
+            stage_input = 'pipe:0'
+
+        slots = Window.command_slots
+        with Window.pipeline_lock:
+            for cmd in cmds:
+                slots.acquire()
+        try:
+            jobs = []
+            for idx, cmd in enumerate( cmds ):
+                log.info( "Running: %s" % ( FFmpegJob.quote_cmd( cmd ) ) )
+                job = FFmpegJob( cmd, timeout=Window.command_timeout, callback=Window.job_callback )
+                stdin = None
+                if len( jobs ):
+                    stdin = jobs[-1].process.stdout
+                if idx == len( cmds ) - 1:
+                    job.start( stdin=stdin )
+                else:
+                    job.start( stdin=stdin, stdout=subprocess.PIPE )
+                if stdin is not None:
+                    # Let the prior stage see a broken pipe if this one
+                    # exits early.
+                    stdin.close()
+                jobs.append( job )
+
+            failures = []
+            for stage, job in zip( stages, jobs ):
+                job.wait()
+                log.debug( "Output was: %s" % ( job.output ) )
+                if job.status != 0:
+                    failures.append( "Error %s with command: %s\n\nOutput was: %s" % ( stage['name'], job.get_cmd(), job.output ) )
+        finally:
+            for cmd in cmds:
+                slots.release()
+
+        Workspace.measure_output( tmpfile )
+        if len( failures ) or not os.path.exists( tmpfile ):
+            raise Exception( "Error running piped stages for file %s:\n\n%s" % ( current, "\n\n".join( failures ) ) )
+
+        self.release_scratch_file( current )
+        for stage in stages:
+            for filename in stage.get( 'inputs', [] ):
+                self.release_scratch_file( filename )
+
+        return tmpfile
+
+
+    ### Window method ########################################
+    def get_audio_fade( self ):
+        '''Internal utility function that returns a ( start, duration )
+        tuple for fading out the audio_file of this Window.
+        '''
+        if self.audio_duration is not None and self.audio_duration == self.duration:
+            return ( self.duration, 0 )
+        else:
+            audio_fade_start = max( 0, self.duration - 5 )
+            return ( audio_fade_start, self.duration - audio_fade_start )
+
+
+    ### Window method ########################################
+    def render_single_pass( self, helper=False, audio_channels=None ):
+        '''Render this Window by compiling it, and all of its child
+        Windows, into one ffmpeg filter_complex which is encoded once.
+
+        The helper argument and return value are as for render.
+        '''
+        ( audio_channels, sar_clause ) = self.resolve_render_settings( audio_channels )
+
+        graph = FilterGraph()
+        ( video, audio ) = self.compile_window( graph, audio_channels )
+
+        # The filter graph can be very long for large trees, so we
+        # hand it to ffmpeg in a file rather than on the command line.
+        graph_file = self.write_scratch_file( graph.get_filter_complex(), prefix="filter-" )
+
+        codecs = Window.get_codecs( final=not helper )
+        tmpfile = self.get_next_renderfile( final=not helper )
+        cmd = [ FFMPEG, '-y' ] + graph.get_input_args() + [ '-filter_complex_script', graph_file, '-map', '[%s]' % ( video ), '-map', '[%s]' % ( audio ), '-pix_fmt', self.pix_fmt, '-r', '30000/1001' ] + codecs['video'].split() + codecs['audio'].split() + [ '-ac', '%d' % ( audio_channels ), '-t', '%f' % ( self.duration ), tmpfile ]
+        log.info( "Running: %s" % ( FFmpegJob.quote_cmd( cmd ) ) )
+        log.debug( "Filter graph was: %s" % ( graph.get_filter_complex() ) )
+        ( status, output ) = Window.run_command( cmd )
+        log.debug( "Output was: %s" % ( output ) )
+        if status != 0 or not os.path.exists( tmpfile ):
+            raise Exception( "Error rendering window in a single pass with command: %s\n\nFilter graph was: %s\n\nOutput was: %s" % ( FFmpegJob.quote_cmd( cmd ), graph.get_filter_complex(), output ) )
+        self.release_scratch_file( graph_file )
+
+        if not helper:
+            shutil.copyfile( tmpfile, self.output_file )
+
+        return tmpfile
+
+
+    ### Window method ########################################
+    def compile_window( self, graph, audio_channels ):
+        '''Internal utility function which adds everything that goes
+        into rendering this Window to the FilterGraph graph, in the
+        same order that render would produce them: background, Clips,
+        child Windows, Watermarks, audio_file, and volume adjustment.
+
+        Returns a ( video_label, audio_label ) tuple naming the
+        outputs in graph that hold this rendered Window.
+        '''
+        ( audio_channels, sar_clause ) = self.resolve_render_settings( audio_channels )
+        layout = graph.get_channel_layout( audio_channels )
+
+        self.reset_rng()
+
+        # The audio streams to be mixed together for this Window.
+        mix = []
+
+        ###### Background stuff ##############################
+        video = graph.get_label( 'v' )
+        graph.add_filter( "color=%s:size=%dx%d:rate=30000/1001:duration=%f%s,format=%s [%s]" % ( self.bgcolor, self.width, self.height, self.duration, sar_clause, self.pix_fmt, video ) )
+        if self.bgimage_file is not None:
+            image_idx = graph.add_input( [ '-loop', '1', '-framerate', '30000/1001', '-t', '%f' % ( self.duration ), '-i', self.bgimage_file ] )
+            base = video
+            video = graph.get_label( 'v' )
+            graph.add_filter( "[%s] [%d:v] overlay%s [%s]" % ( base, image_idx, sar_clause, video ) )
+
+        audio = graph.get_label( 'a' )
+        graph.add_filter( "aevalsrc=0:c=%s:s=48000:d=%f [%s]" % ( layout, self.duration, audio ) )
+        mix.append( audio )
+
+        ###### Render This Window's Clips ####################
+        segments = []
+        overlays = []
+        for clip in self.clips:
+            display = self.get_display( clip )
+            ( clip_video, clip_audio ) = self.compile_clip( graph, clip, display, layout, sar_clause )
+            if display.display_style == OVERLAY:
+                overlays.append( { 'clip' : clip,
+                                   'display' : display,
+                                   'video' : clip_video,
+                                   'audio' : clip_audio } )
+            else:
+                segments.append( ( clip_video, clip_audio ) )
 
-        ###### Render This Window's Clips ####################
-        tmpfile = self.render_clips( self.clips, background_file, audio_channels )
+        if len( segments ):
+            if len( segments ) > 1:
+                clip_video = graph.get_label( 'v' )
+                clip_audio = graph.get_label( 'a' )
+                graph.add_filter( "%s concat=n=%d:v=1:a=1 [%s] [%s]" % ( " ".join( [ "[%s] [%s]" % x for x in segments ] ), len( segments ), clip_video, clip_audio ) )
+            else:
+                ( clip_video, clip_audio ) = segments[0]
+
+            base = video
+            video = graph.get_label( 'v' )
+            graph.add_filter( "[%s] [%s] overlay=x=0:y=0:eof_action=pass [%s]" % ( base, clip_video, video ) )
+            mix.append( clip_audio )
+
+        ( duration, overlay_timing ) = self.compute_duration( self.clips, include_overlay_timing=True )
+        for overlay_idx, overlay in enumerate( overlays ):
+            overlay_start = overlay_timing[overlay_idx][0]
+            ( ow, oh, x, y ) = self.get_overlay_geometry( overlay['clip'], overlay['display'], overlay_start )
+
+            scaled = graph.get_label( 'o' )
+            graph.add_filter( "[%s] scale=width=%d:height=%d,setpts=PTS-STARTPTS+%f/TB [%s]" % ( overlay['video'], ow, oh, overlay_start, scaled ) )
+            base = video
+            video = graph.get_label( 'v' )
+            graph.add_filter( "[%s] [%s] overlay=x=%s:y=%s:eof_action=pass [%s]" % ( base, scaled, x, y, video ) )
+
+            if overlay['audio'] is not None:
+                if overlay_start > 0:
+                    delayed = graph.get_label( 'a' )
+                    graph.add_filter( "[%s] adelay=%s [%s]" % ( overlay['audio'], "|".join( [ str( overlay_start*1000 ) for x in range( audio_channels ) ] ), delayed ) )
+                    mix.append( delayed )
+                else:
+                    mix.append( overlay['audio'] )
 
         ###### Render All Child Windows ######################
         for window in sorted( self.windows, key=lambda x: x.z_index ):
             if window.pix_fmt is None:
                 window.pix_fmt = self.pix_fmt
 
-            current = tmpfile
-            window_file = window.render( helper=True, audio_channels=audio_channels )
-            tmpfile = self.get_next_renderfile()
-            
-            cmd = '%s -y -i %s -i %s -pix_fmt %s -r 30000/1001 -crf 16 -c:v libx264 -ac %d -c:a libfdk_aac -filter_complex " [0:v] fifo [v0] ; [1:v] fifo [v1] ; [v0] [v1] overlay=x=%s:y=%s:eof_action=pass%s [outv] ; [0:a] afifo [a0] ; [1:a] afifo [a1] ; [a0] [a1] amix=inputs=2:duration=longest:dropout_transition=5 [outa] " -map "[outv]" -map "[outa]" -t %f %s' % ( FFMPEG, current, window_file, window.pix_fmt, audio_channels, window.x, window.y, sar_clause, self.duration, tmpfile )
+            # Any files the child Window writes belong to our render.
+            window.workspace = self.workspace
+            try:
+                ( window_video, window_audio ) = window.compile_window( graph, audio_channels )
+            finally:
+                window.workspace = None
+            base = video
+            video = graph.get_label( 'v' )
+            graph.add_filter( "[%s] [%s] overlay=x=%s:y=%s:eof_action=pass%s [%s]" % ( base, window_video, window.x, window.y, sar_clause, video ) )
+            mix.append( window_audio )
 
+        audio = self.compile_mix( graph, mix, layout )
 
-            log.info( "Running: %s" % ( cmd ) )
-            ( status, output ) = subprocess.getstatusoutput( cmd )
-            log.debug( "Output was: %s" % ( output ) )
-            if status != 0 or not os.path.exists( tmpfile ):
-                raise Exception( "Error applying overlay window %s to file %s with command: %s\n\nOutput was: %s" % ( window_file, current, cmd, output ) )
-                
         ###### Render Watermarks #############################
-        if len( self.watermarks ) > 0:
-            tmpfile = self.add_watermarks( self.watermarks, tmpfile )
+        video = self.compile_watermarks( graph, video )
 
-        ###### Add Audio and Description #####################
-        if self.audio_file:
-            audio_tmpfile = None
-            if self.audio_file_channels != audio_channels:
-                # Convert the input audio file to the right number of channels.
-                audio_tmpfile = self.get_next_renderfile()
-                cmd = '%s -i %s -ac %d -c:a libfdk_aac -vn %s' % ( FFMPEG, self.audio_file, audio_channels, audio_tmpfile )
-                log.info( "Running: %s" % ( cmd ) )
-                ( status, output ) = subprocess.getstatusoutput( cmd )
-                log.debug( "Output was: %s" % ( output ) )
-                if status != 0 or not os.path.exists( audio_tmpfile ):
-                    raise Exception( "Error converting audio file %s to have %d channels with command: %s\n\nOutput was: %s" % ( audio_tmpfile, audio_channels, cmd, output ) )
+        ###### Add Description ##############################
+        if self.audio_file and self.audio_desc:
+            audio_desc_file = self.write_scratch_file( self.audio_desc )
+            base = video
+            video = graph.get_label( 'v' )
+            graph.add_filter( "[%s] drawtext=fontcolor=white:fontsize=24:borderw=1:textfile=%s:x=10:y=h-th-10:enable=gt(t\,%f)%s [%s]" % ( base, audio_desc_file, max( 0, self.duration - 5 ), sar_clause, video ) )
 
-            if audio_tmpfile is None:
-                audio_tmpfile = self.audio_file
+        return ( video, audio )
 
-            if self.audio_duration is not None and self.audio_duration == self.duration:
-                audio_fade_start = self.duration
-                audio_fade_duration = 0
+
+    ### Window method ########################################
+    def compile_watermarks( self, graph, video ):
+        '''Internal utility function which adds filters to the
+        FilterGraph graph that overlay the Watermarks of this Window on
+        the output labeled video.
+
+        Returns the label of the output in graph with the Watermarks.
+        '''
+        for watermark in self.watermarks:
+            if watermark.filename is not None:
+                mark_idx = graph.add_input( [ '-loop', '1', '-framerate', '30000/1001', '-t', '%f' % ( self.duration ), '-i', watermark.filename ] )
+                mark_source = "[%d:v] " % ( mark_idx )
             else:
-                audio_fade_start = max( 0, self.duration - 5 )
-                audio_fade_duration = self.duration - audio_fade_start
-            afade_clause = ' -c:a libfdk_aac -filter_complex " [1:a] afade=t=out:st=%f:d=%f [a1] ; [0:a] [a1] amix=inputs=2:duration=longest:dropout_transition=5 " ' % ( audio_fade_start, audio_fade_duration )
+                mark_source = "color=%s:size=%dx%d:rate=30000/1001:duration=%f," % ( watermark.bgcolor, watermark.width, watermark.height, self.duration )
 
-            current = tmpfile
-            tmpfile = self.get_next_renderfile()
+            mark = graph.get_label( 'w' )
+            graph.add_filter( "%s%s [%s]" % ( mark_source, self.get_watermark_clause( watermark ), mark ) )
+            base = video
+            video = graph.get_label( 'v' )
+            graph.add_filter( "[%s] [%s] overlay=x=%s:y=%s:eof_action=pass [%s]" % ( base, mark, watermark.x, watermark.y, video ) )
 
-            filter_clause = ' -vf copy '
+        return video
 
-            if self.audio_desc:
-                audio_desc_file = '%s/%s.txt' % ( Window.tmpdir, str( uuid.uuid4() ) )
-                f = open( audio_desc_file, 'w' )
-                f.write( self.audio_desc )
-                f.close()
-                filter_clause = " -filter_complex 'drawtext=fontcolor=white:fontsize=24:borderw=1:textfile=%s:x=10:y=h-th-10:enable=gt(t\,%f)'%s" % ( audio_desc_file, max( 0, self.duration - 5 ), sar_clause )
 
-            cmd = '%s -y -i %s -i %s -ac %d -pix_fmt %s %s %s -t %f %s' % ( FFMPEG, current, audio_tmpfile, audio_channels, self.pix_fmt, afade_clause, filter_clause, self.duration, tmpfile )
-            log.info( "Running: %s" % ( cmd ) )
-            ( status, output ) = subprocess.getstatusoutput( cmd )
-            log.debug( "Output was: %s" % ( output ) )
-            if status != 0 or not os.path.exists( tmpfile ):
-                raise Exception( "Error adding audio %s to file %s with command: %s\n\nOutput was: %s" % ( audio_tmpfile, current, cmd, output ) )
+    ### Window method ########################################
+    def compile_audio( self, graph, audio_channels ):
+        '''Internal utility function which adds the audio of this Window
+        and all of its child Windows to the FilterGraph graph, as
+        compile_window would, but without any of their video: the
+        audio of each Clip read from its Video and placed where the
+        Clip is shown, the audio of the child Windows, and the
+        audio_file, with the volume adjusted.
+
+        Returns the label of the output in graph that holds the audio.
+        '''
+        if self.duration is None:
+            # Windows whose renders are taken from the cache may not
+            # have had their duration worked out.
+            self.resolve_render_settings( audio_channels )
+
+        layout = graph.get_channel_layout( audio_channels )
+
+        audio = graph.get_label( 'a' )
+        graph.add_filter( "aevalsrc=0:c=%s:s=48000:d=%f [%s]" % ( layout, self.duration, audio ) )
+        mix = [ audio ]
+
+        ( duration, overlay_timing ) = self.compute_duration( self.clips, include_overlay_timing=True )
+
+        segments = []
+        overlay_idx = 0
+        for clip in self.clips:
+            display = self.get_display( clip )
+            if display.display_style == OVERLAY:
+                overlay_start = overlay_timing[overlay_idx][0]
+                overlay_idx += 1
+                if clip.get_channels() is None or not display.include_audio:
+                    continue
+                clip_idx = graph.add_input( [ '-ss', '%f' % ( clip.start ), '-t', '%f' % ( clip.get_duration() ), '-i', clip.video.filename ] )
+                clip_audio = self.compile_clip_audio( graph, clip, display, layout, clip_idx )
+                if overlay_start > 0:
+                    delayed = graph.get_label( 'a' )
+                    graph.add_filter( "[%s] adelay=%s [%s]" % ( clip_audio, "|".join( [ str( overlay_start*1000 ) for x in range( audio_channels ) ] ), delayed ) )
+                    clip_audio = delayed
+                mix.append( clip_audio )
+            else:
+                clip_idx = None
+                if clip.get_channels() is not None and display.include_audio:
+                    clip_idx = graph.add_input( [ '-ss', '%f' % ( clip.start ), '-t', '%f' % ( clip.get_duration() ), '-i', clip.video.filename ] )
+                segments.append( self.compile_clip_audio( graph, clip, display, layout, clip_idx ) )
+
+        if len( segments ) > 1:
+            clip_audio = graph.get_label( 'a' )
+            graph.add_filter( "%s concat=n=%d:v=0:a=1 [%s]" % ( " ".join( [ "[%s]" % ( x ) for x in segments ] ), len( segments ), clip_audio ) )
+            mix.append( clip_audio )
+        elif len( segments ) == 1:
+            mix.append( segments[0] )
+
+        for window in sorted( self.windows, key=lambda x: x.z_index ):
+            mix.append( window.compile_audio( graph, audio_channels ) )
+
+        return self.compile_mix( graph, mix, layout )
+
+
+    ### Window method ########################################
+    def compile_mix( self, graph, mix, layout ):
+        '''Internal utility function which adds filters to the
+        FilterGraph graph that mix the audio outputs in the list mix
+        together, mix in the audio_file, and adjust the volume, as
+        render does for this Window.
+
+        Returns the label of the output in graph that holds the audio.
+        '''
+        audio = mix[0]
+        if len( mix ) > 1:
+            audio = graph.get_label( 'a' )
+            graph.add_filter( "%s amix=inputs=%d:duration=longest:dropout_transition=5 [%s]" % ( " ".join( [ "[%s]" % ( x ) for x in mix ] ), len( mix ), audio ) )
+
+        ###### Add Audio #####################################
+        if self.audio_file:
+            ( audio_fade_start, audio_fade_duration ) = self.get_audio_fade()
+            audio_idx = graph.add_input( [ '-i', self.audio_file ] )
+            faded = graph.get_label( 'a' )
+            graph.add_filter( "[%d:a] aformat=sample_rates=48000:channel_layouts=%s,afade=t=out:st=%f:d=%f [%s]" % ( audio_idx, layout, audio_fade_start, audio_fade_duration, faded ) )
+            base = audio
+            audio = graph.get_label( 'a' )
+            graph.add_filter( "[%s] [%s] amix=inputs=2:duration=longest:dropout_transition=5 [%s]" % ( base, faded, audio ) )
 
         ###### Fix overall volume issues.
-        current = tmpfile
-        tmpfile = self.get_next_renderfile()
-        cmd = '%s -y -i %s -pix_fmt %s -c:a libfdk_aac -ac %d -vf copy -af " [0:a] dynaudnorm=g=3 " %s' % ( FFMPEG, current, self.pix_fmt, audio_channels, tmpfile )
-        log.info( "Running: %s" % ( cmd ) )
-        ( status, output ) = subprocess.getstatusoutput( cmd )
-        log.debug( "Output was: %s" % ( output ) )
-        if status != 0 or not os.path.exists( tmpfile ):
-            raise Exception( "Error adjusting volume of file %s with command: %s\n\nOutput was: %s" % ( current, cmd, output ) )
+        base = audio
+        audio = graph.get_label( 'a' )
+        graph.add_filter( "[%s] dynaudnorm=g=3,atrim=duration=%f [%s]" % ( base, self.duration, audio ) )
 
-        if not helper:
-            shutil.copyfile( tmpfile, self.output_file )
+        return audio
+
+
+    ### Window method ########################################
+    def compile_clip( self, graph, clip, display, layout, sar_clause ):
+        '''Internal utility function which adds a Clip to the
+        FilterGraph graph, as get_clip_job would have it transcoded.
+
+        Returns a ( video_label, audio_label ) tuple.  The audio_label
+        is a silent track for non-OVERLAY Clips without audio, so they
+        can be concatenated, and None for OVERLAY Clips without audio.
+        '''
+        clip_idx = graph.add_input( [ '-ss', '%f' % ( clip.start ), '-t', '%f' % ( clip.get_duration() ), '-i', clip.video.filename ] )
+
+        scale_clause = self.get_scale_clause( clip, display )
+        if display.display_style != OVERLAY:
+            scale_clause += sar_clause
+        if scale_clause != "" and not scale_clause.startswith( "," ):
+            scale_clause = "," + scale_clause
+
+        video = graph.get_label( 'c' )
+        graph.add_filter( "[%d:v] setpts=PTS-STARTPTS,fps=30000/1001,trim=duration=%f%s,format=%s [%s]" % ( clip_idx, clip.get_duration(), scale_clause, self.pix_fmt, video ) )
+
+        audio = self.compile_clip_audio( graph, clip, display, layout, clip_idx )
+
+        return ( video, audio )
+
+
+    ### Window method ########################################
+    def compile_clip_audio( self, graph, clip, display, layout, clip_idx ):
+        '''Internal utility function which adds the audio of a Clip,
+        read from input clip_idx of the FilterGraph graph, to graph.
+
+        Returns the label of the audio, a silent track for non-OVERLAY
+        Clips without audio, or None for OVERLAY Clips without audio.
+        '''
+        audio = None
+        if clip.get_channels() is not None and display.include_audio:
+            audio = graph.get_label( 'a' )
+            graph.add_filter( "[%d:a] asetpts=PTS-STARTPTS,aformat=sample_rates=48000:channel_layouts=%s,apad,atrim=duration=%f [%s]" % ( clip_idx, layout, clip.get_duration(), audio ) )
+        elif display.display_style != OVERLAY:
+            audio = graph.get_label( 'a' )
+            graph.add_filter( "aevalsrc=0:c=%s:s=48000:d=%f [%s]" % ( layout, clip.get_duration(), audio ) )
+
+        return audio
+
+
+    ### Window method ########################################
+    def render_background( self, audio_channels, sar_clause, final=False ):
+        '''Render the background of this Window, its bgcolor and optional
+        bgimage_file, with silent audio for the duration of the
+        Window.
+
+        A short segment of the background video is rendered once and
+        cached, and then looped without re-encoding to the duration
+        of the Window.  If final is True the background is encoded for
+        delivery.
+
+        Returns the path of the file it generated.
+        '''
+        codecs = Window.get_codecs( final )
+        background_hash = self.get_background_hash( audio_channels, sar_clause, final )
+
+        segment_file = None
+        if not self.force:
+            segment_file = Window.get_cache_entry( background_hash, filename="%s/%s.%s" % ( Window.tmpdir, background_hash, codecs['extension'] ) )
+
+        if segment_file is None:
+            segment_file = "%s/%s.%s" % ( Window.tmpdir, background_hash, codecs['extension'] )
+            os.rename( self.render_background_segment( sar_clause, final ), segment_file )
+            Window.add_cache_entry( background_hash, segment_file )
+
+        return self.loop_background( segment_file, audio_channels, final )
+
+
+    ### Window method ########################################
+    def schedule_background( self, scheduler, audio_channels, sar_clause ):
+        '''Internal utility function which adds the work of
+        render_background to scheduler, with the segment of the
+        background cached by a task of its own, which Windows with the
+        same background share.
+
+        Returns the task whose result is the path of the background
+        file.
+        '''
+        background_hash = self.get_background_hash( audio_channels, sar_clause )
+        segment = self.schedule_cached( scheduler, background_hash, "%s/%s.%s" % ( Window.tmpdir, background_hash, Window.get_codecs()['extension'] ),
+                                        functools.partial( self.render_background_segment, sar_clause ),
+                                        cost=self.width * self.height * Window.background_segment_duration,
+                                        name="background segment" )
+
+        # Looping the segment copies its video, so costs next to
+        # nothing.
+        return scheduler.add( lambda: self.loop_background( segment['result'], audio_channels ),
+                              depends=[ segment ],
+                              name="looping background" )
+
+
+    ### Window method ########################################
+    def render_background_segment( self, sar_clause, final=False ):
+        '''Internal utility function which renders a segment
+        background_segment_duration seconds long of the background of
+        this Window, for render_background to loop.  If final is True
+        the segment is encoded for delivery.
+
+        Returns the path of the file it generated.
+        '''
+        codecs = Window.get_codecs( final )
+        segment_duration = Window.background_segment_duration
+        tmpfile = self.get_next_renderfile( final )
+
+        # The segment has no audio, so it loops seamlessly, and
+        # every frame is a keyframe, so it can be cut anywhere
+        # without re-encoding.
+        if self.bgimage_file is not None:
+            # Lay down a background image.
+            cmd = [ FFMPEG, '-y', '-loop', '1', '-i', self.bgimage_file, '-pix_fmt', self.pix_fmt, '-r', '30000/1001' ] + codecs['video'].split() + [ '-g', '1', '-filter_complex', 'color=%s:size=%dx%d,setpts=PTS-STARTPTS/TB [base] ; [0] setpts=PTS-STARTPTS/TB [image]; [base] [image] overlay%s' % ( self.bgcolor, self.width, self.height, sar_clause ), '-t', '%f' % ( segment_duration ), tmpfile ]
+            log.info( "Running: %s" % ( FFmpegJob.quote_cmd( cmd ) ) )
+            ( status, output ) = Window.run_command( cmd )
+            log.debug( "Output was: %s" % ( output ) )
+            if status != 0 or not os.path.exists( tmpfile ):
+                raise Exception( "Error producing background image video file %s with command: %s\n\nOutput was: %s" % ( tmpfile, FFmpegJob.quote_cmd( cmd ), output ) )
+        else:
+            # There was no background image, lay down a solid color.
+            cmd = [ FFMPEG, '-y', '-pix_fmt', self.pix_fmt, '-r', '30000/1001' ] + codecs['video'].split() + [ '-g', '1', '-filter_complex', 'color=%s:size=%dx%d%s,setpts=PTS-STARTPTS/TB' % ( self.bgcolor, self.width, self.height, sar_clause ), '-t', '%f' % ( segment_duration ), tmpfile ]
+            log.info( "Running: %s" % ( FFmpegJob.quote_cmd( cmd ) ) )
+            ( status, output ) = Window.run_command( cmd )
+            log.debug( "Output was: %s" % ( output ) )
+            if status != 0 or not os.path.exists( tmpfile ):
+                raise Exception( "Error producing solid background file %s with command: %s\n\nOutput was: %s" % ( tmpfile, FFmpegJob.quote_cmd( cmd ), output ) )
 
-        # Render returns the path of the file it generated.
         return tmpfile
 
 
     ### Window method ########################################
-    def add_watermarks( self, watermarks, current ):
-        cmd = '%s -y -i %s ' % ( FFMPEG, current )
+    def loop_background( self, segment_file, audio_channels, final=False ):
+        '''Internal utility function which loops segment_file, a
+        segment of the background of this Window, out to the duration
+        of the Window without re-encoding it, and adds silent audio.
 
-        tmpfile = self.get_next_renderfile()
+        Returns the path of the file it generated.
+        '''
+        codecs = Window.get_codecs( final )
+        background_file = self.get_next_renderfile( final )
+        if self.video_only:
+            cmd = [ FFMPEG, '-y', '-stream_loop', '-1', '-i', segment_file, '-map', '0:v', '-c:v', 'copy', '-t', '%f' % ( self.duration ), background_file ]
+        else:
+            cmd = [ FFMPEG, '-y', '-stream_loop', '-1', '-i', segment_file, '-f', 'lavfi', '-i', 'aevalsrc=0', '-map', '0:v', '-map', '1:a', '-c:v', 'copy', '-ac', '%d' % ( audio_channels ) ] + codecs['audio'].split() + [ '-t', '%f' % ( self.duration ), background_file ]
+        log.info( "Running: %s" % ( FFmpegJob.quote_cmd( cmd ) ) )
+        ( status, output ) = Window.run_command( cmd )
+        log.debug( "Output was: %s" % ( output ) )
+        if status != 0 or not os.path.exists( background_file ):
+            raise Exception( "Error producing background file %s from %s with command: %s\n\nOutput was: %s" % ( background_file, segment_file, FFmpegJob.quote_cmd( cmd ), output ) )
 
-        file_idx = 0
+        return background_file
 
-        for watermark in watermarks:
-            if watermark.filename is not None:
-                file_idx += 1
-                cmd += " -loop 1 -i %s " % ( watermark.filename )
-
-        cmd += ' -acodec copy '
-
-        cmd += ' -pix_fmt %s -filter_complex " ' % ( self.pix_fmt )
-
-        filter_idx = 0
-
-        for watermark in watermarks:
-            if watermark.bgcolor is not None:
-                cmd += ' color=%s:size=%dx%d [b%d] ; ' % ( watermark.bgcolor, watermark.width, watermark.height, file_idx + filter_idx )
-            filter_idx += 1
-
-        for idx, watermark in enumerate( watermarks ):
-            fade_clause = ""
-            if watermark.fade_in_start is not None:
-                in_start = watermark.fade_in_start
-                if in_start < 0:
-                    in_start = self.duration + in_start
-                in_duration = min( watermark.fade_in_duration, self.duration - in_start )
-                fade_clause = "fade=t=in:alpha=1:st=%f:d=%f" % ( in_start, in_duration )
-            if watermark.fade_out_start is not None:
-                out_start = watermark.fade_out_start
-                if out_start < 0:
-                    out_start = self.duration + out_start
-                out_duration = min( watermark.fade_out_duration, self.duration - out_start )
-                if fade_clause == "":
-                    fade_clause = "fade="
-                else:
-                    fade_clause += ":"
-                fade_clause += "t=out:alpha=1:st=%f:d=%f" % ( out_start, out_duration )
 
-            mark_clause = fade_clause
-            if mark_clause == "":
-                mark_clause = "copy"
+    ### Window method ########################################
+    def schedule_cached( self, scheduler, key, filename, func, cost, name ):
+        '''Internal utility function which adds a task to scheduler
+        whose result is the file cached under key at filename.  If it
+        is not in the cache, the task calls func to render it, and
+        moves the file func returns into the cache.  The task is
+        shared by everything scheduled which needs the same file, and
+        name describes the file.
+
+        If scheduler is a dry run, as for plan, the cache is consulted
+        without recording the access.
+
+        Returns the task.
+        '''
+        task = scheduler.get( key )
+        if task is not None:
+            return task
+
+        if not self.force:
+            cached_file = Window.get_cache_entry( key, peek=scheduler.dry_run, filename=filename )
+            if cached_file is not None:
+                log.info( "Using cached %s: %s" % ( name, cached_file ) )
+                return scheduler.add( lambda: cached_file, name="using cached %s" % ( name ), key=key, cached=True )
+
+        def render():
+            os.rename( func(), filename )
+            Window.add_cache_entry( key, filename )
+            return filename
+
+        return scheduler.add( render, cost=cost, name="rendering %s" % ( name ), key=key )
+
+
+    ### Window method ########################################
+    def get_background_hash( self, audio_channels, sar_clause, final=False ):
+        '''Internal utility function that returns the key a segment of
+        this Window's background is cached under.
+        '''
+        image_hash = ""
+        if self.bgimage_file is not None:
+            # Images are small, so we identify them by their contents.
+            md5 = hashlib.md5()
+            f = open( self.bgimage_file, 'rb' )
+            md5.update( f.read() )
+            f.close()
+            image_hash = md5.hexdigest()
+
+        if final:
+            profile = DELIVERY
+        else:
+            profile = Window.intermediate_profile
+
+        background_name = "background%s%s%s%s%s%s%s%s%s" % ( self.bgcolor,
+                                                           image_hash,
+                                                           self.width,
+                                                           self.height,
+                                                           sar_clause,
+                                                           self.pix_fmt,
+                                                           audio_channels,
+                                                           profile,
+                                                           Window.background_segment_duration )
+
+        md5 = hashlib.md5()
+        md5.update( background_name.encode( 'utf-8' ) )
+        return md5.hexdigest()
+
 
-            input_idx = idx+1
-            if watermark.filename is None:
-                cmd += " [b%d] %s [w%d] ; " % ( input_idx + file_idx - 1, mark_clause, idx )
+    ### Window method ########################################
+    def get_watermark_clause( self, watermark ):
+        '''Internal utility function that returns the ffmpeg filter
+        clause which fades a Watermark in and out over the duration of
+        this Window.
+        '''
+        fade_clause = ""
+        if watermark.fade_in_start is not None:
+            in_start = watermark.fade_in_start
+            if in_start < 0:
+                in_start = self.duration + in_start
+            in_duration = min( watermark.fade_in_duration, self.duration - in_start )
+            fade_clause = "fade=t=in:alpha=1:st=%f:d=%f" % ( in_start, in_duration )
+        if watermark.fade_out_start is not None:
+            out_start = watermark.fade_out_start
+            if out_start < 0:
+                out_start = self.duration + out_start
+            out_duration = min( watermark.fade_out_duration, self.duration - out_start )
+            if fade_clause == "":
+                fade_clause = "fade="
             else:
-                cmd += " [%d] %s [w%d] ; " % ( input_idx, mark_clause, idx )
-
-        # Overlay them onto one another
-        prior_overlay = '0'
-        for idx, watermark in enumerate( watermarks ):
-            cmd += ' [%s] [w%d] overlay=x=%s:y=%s:eof_action=pass [o%s] ; ' % ( prior_overlay, idx, watermark.x, watermark.y, idx )
-            prior_overlay = "o%s" % idx
-
-        # Stip off training [o##] ;
-        cmd = cmd[:-(6+len( str( idx-1 ) ) )]
-        cmd += ' " %s' % ( tmpfile )
-        log.info( "Running: %s" % ( cmd ) )
-        ( status, output ) = subprocess.getstatusoutput( cmd )
+                fade_clause += ":"
+            fade_clause += "t=out:alpha=1:st=%f:d=%f" % ( out_start, out_duration )
+
+        if fade_clause == "":
+            return "copy"
+        else:
+            return fade_clause
+
+
+    ### Window method ########################################
+    def get_watermark_record( self, watermark, peek=False ):
+        '''Internal utility function that returns a list of everything
+        which determines how watermark looks, for use in cache keys.
+        peek is as for get_file_key.
+        '''
+        return [ Window.get_file_key( watermark.filename, peek ),
+                 watermark.bgcolor,
+                 watermark.width,
+                 watermark.height,
+                 watermark.x,
+                 watermark.y,
+                 watermark.fade_in_start,
+                 watermark.fade_in_duration,
+                 watermark.fade_out_start,
+                 watermark.fade_out_duration ]
+
+
+    ### Window method ########################################
+    def render_watermark_layer( self ):
+        '''Render the Watermarks of this Window, with their fades, onto a
+        transparent video of the size and duration of this Window.
+        The layer is overlaid on this Window by a step of rendering
+        which re-encodes its video anyway, rather than by a step of
+        its own.
+
+        The layer is cached by schedule_multi_pass, so every Window of
+        the same size and duration with the same Watermarks reuses
+        it.
+
+        Returns the path of the file it generated.
+        '''
+        graph = FilterGraph()
+        base = graph.get_label( 'v' )
+        graph.add_filter( "color=black@0:size=%dx%d:rate=30000/1001:duration=%f,format=yuva420p [%s]" % ( self.width, self.height, self.duration, base ) )
+        video = self.compile_watermarks( graph, base )
+        graph_file = self.write_scratch_file( graph.get_filter_complex(), prefix="filter-" )
+
+        # FFV1 keeps the alpha channel, and compresses the mostly
+        # transparent and unchanging layer well.
+        codecs = INTERMEDIATE_PROFILES[FFV1]
+        tmpfile = self.add_scratch_file( "%s/%s.%s" % ( Window.tmpdir, str( uuid.uuid4() ), codecs['extension'] ) )
+        cmd = [ FFMPEG, '-y' ] + graph.get_input_args() + [ '-filter_complex_script', graph_file, '-map', '[%s]' % ( video ), '-pix_fmt', 'yuva420p' ] + codecs['video'].split() + [ '-t', '%f' % ( self.duration ), tmpfile ]
+        log.info( "Running: %s" % ( FFmpegJob.quote_cmd( cmd ) ) )
+        ( status, output ) = Window.run_command( cmd )
         log.debug( "Output was: %s" % ( output ) )
         if status != 0 or not os.path.exists( tmpfile ):
-            raise Exception( "Error adding watermarks to file %s with command: %s\n\nOutput was: %s" % ( current, cmd, output ) )
+            raise Exception( "Error rendering watermark layer with command: %s\n\nFilter graph was: %s\n\nOutput was: %s" % ( FFmpegJob.quote_cmd( cmd ), graph.get_filter_complex(), output ) )
+        self.release_scratch_file( graph_file )
 
         return tmpfile
 
 
     ### Window method ########################################
-    def get_clip_hash( self, clip, width, height, pan_direction="", pix_fmt="yuv420p", include_audio=True ):
+    def get_watermark_layer_hash( self, peek=False ):
+        '''Internal utility function that returns the key the watermark
+        layer of this Window is cached under.  peek is as for
+        get_file_key.
+        '''
+        record = [ 'watermarks', self.width, self.height, self.duration ]
+        for watermark in self.watermarks:
+            record.append( self.get_watermark_record( watermark, peek ) )
+
+        md5 = hashlib.md5()
+        md5.update( json.dumps( record ).encode( 'utf-8' ) )
+        return md5.hexdigest()
+
+
+    ### Window method ########################################
+    def get_watermark_layer_file( self, layer_hash ):
+        '''Internal utility function that returns the path in the cache
+        of the watermark layer cached under layer_hash.'''
+        return "%s/%s.%s" % ( Window.tmpdir, layer_hash, INTERMEDIATE_PROFILES[FFV1]['extension'] )
+
+
+    ### Window method ########################################
+    def get_watermark_layer_clause( self, video, layer_idx ):
+        '''Internal utility function that returns the ffmpeg filter
+        clause which overlays input layer_idx, a watermark layer, on
+        the stream labeled video.
+        '''
+        return "[%s] [%d:v] overlay=x=0:y=0:eof_action=pass" % ( video, layer_idx )
+
+
+    ### Window method ########################################
+    def get_watermark_layer_cmd( self, watermark_layer, current, codecs, output ):
+        '''Internal utility function that returns the ffmpeg command
+        which overlays watermark_layer on current, encoding with codecs
+        and writing the result to output.
+        '''
+        return [ FFMPEG, '-y', '-i', current, '-i', watermark_layer, '-pix_fmt', self.pix_fmt ] + codecs['video'].split() + codecs['audio'].split() + [ '-filter_complex', '%s [outv]' % ( self.get_watermark_layer_clause( '0:v', 1 ) ), '-map', '[outv]', '-map', '0:a?', output ]
+
+
+    ### Window method ########################################
+    def get_clip_hash( self, clip, width, height, pan_direction="", pix_fmt="yuv420p", include_audio=True, smart_cut=False, peek=False ):
         '''It can be very time consuming to produce a clip from a video, we
         endeavor here to not do the same work over and over if it's
         not needed.
 
+        If peek is True, as for plan, a Video whose fingerprint has
+        not been computed is not read, see Video.get_fingerprint.
+
         '''
 
-        filename = os.path.abspath( clip.video.filename )
+        if Window.content_fingerprints:
+            # Identify the underlying file by its contents, so copies
+            # of it share cached clips.
+            filename = clip.video.get_fingerprint( peek )
+            file_size = ""
+            file_mtime = ""
+        else:
+            filename = os.path.abspath( clip.video.filename )
 
-        # Check if the underlying file has changed for a given path.
-        file_info = os.stat( filename )
-        file_size = file_info.st_size
-        file_mtime = file_info.st_mtime
+            # Check if the underlying file has changed for a given path.
+            file_info = os.stat( filename )
+            file_size = file_info.st_size
+            file_mtime = file_info.st_mtime
 
         display = self.get_display( clip )
         clip_name = "%s%s%s%s%s%s%s%s%s%s%s" % ( filename,
@@ -1084,223 +3742,726 @@ class Window( object ):
                                              include_audio,
                                              file_size,
                                              file_mtime )
+
+        # Clips encoded with different intermediate profiles are
+        # different files.  The DELIVERY profile is left out so that
+        # caches from before there were profiles remain valid.
+        if Window.intermediate_profile != DELIVERY:
+            clip_name += Window.intermediate_profile
+
+        # Smart cut Clips are mostly stream copies of their Video, not
+        # re-encodes of it, so they don't share cached files with
+        # those that are transcoded.
+        if smart_cut:
+            clip_name += "smart_cut"
+
         md5 = hashlib.md5()
         md5.update( clip_name.encode( 'utf-8') )
         return md5.hexdigest()
 
 
-    ### Window method ########################################
-    def render_clips( self, clips, background_file, audio_channels ):
-        '''Render the clips for the current window.
+    ### Window method ########################################
+    def schedule_clips( self, scheduler, clips, background, audio_channels, watermarks=None ):
+        '''Internal utility function which adds the rendering of the
+        clips of this Window to scheduler, where background is the
+        task whose result is the background_file any OVERLAY clips
+        are rendered onto if there are no other clips, and watermarks,
+        if given, is the task whose result is a watermark layer to
+        overlay on top.
+
+        Each clip which is not in the cache is transcoded at this
+        Window's resolution by its own task and then cached, and
+        identical clips anywhere in the graph share one task.  A
+        final task composites them with composite_clips.
+
+        Returns the task whose result is the path of the rendered
+        file.
+        '''
+        if len( clips ) == 0:
+            return background
+
+        jobs = [ self.get_clip_job( clip, audio_channels, peek=scheduler.dry_run ) for clip in clips ]
+
+        tasks = []
+        for clip, job in zip( clips, jobs ):
+            if job['cached']:
+                tasks.append( scheduler.add( functools.partial( lambda filename: filename, job['filename'] ),
+                                             name="using cached clip %s" % ( job['clip_hash'] ),
+                                             key=job['clip_hash'],
+                                             cached=True ) )
+            else:
+                display = self.get_display( clip )
+                if display.display_style == OVERLAY:
+                    cost = clip.video.width * clip.video.height * clip.get_duration()
+                else:
+                    cost = self.width * self.height * clip.get_duration()
+                tasks.append( scheduler.add( functools.partial( self.run_clip_job, job ),
+                                             cost=cost,
+                                             name="transcoding clip %s" % ( job['clip_hash'] ),
+                                             key=job['clip_hash'] ) )
+
+        def composite():
+            watermark_layer = None
+            if watermarks is not None:
+                watermark_layer = watermarks['result']
+            return self.composite_clips( clips, jobs, background['result'], audio_channels, watermark_layer=watermark_layer )
+
+        # The clips are overlaid on the background, and then each
+        # batch of overlays re-encodes the whole Window.
+        overlay_count = len( [ clip for clip in clips if self.get_display( clip ).display_style == OVERLAY ] )
+        passes = 1 + ( overlay_count + self.overlay_batch_concurrency - 1 ) // self.overlay_batch_concurrency
+
+        return scheduler.add( composite,
+                              depends=[ background ] + tasks + [ task for task in [ watermarks ] if task is not None ],
+                              cost=self.width * self.height * self.duration * passes,
+                              name="compositing clips" )
+
+
+    ### Window method ########################################
+    def composite_clips( self, clips, jobs, background_file, audio_channels, watermark_layer=None ):
+        '''Internal utility function which concatenates and overlays the
+        rendered clips, as described by the output of get_clip_job for
+        each of clips, onto background_file.  The non-OVERLAY clips are
+        concatenated in order, and then the OVERLAY clips are overlaid
+        on top, starting at the beginning.  If watermark_layer is given
+        it is overlaid on top of everything by the last step, which
+        then re-encodes the whole video.
+
+        Returns the path of the file it generated.
+        '''
+        tmpfile = None
+
+        codecs = Window.get_codecs()
+
+        clip_files = []
+        overlays = []
+
+        for clip, job in zip( clips, jobs ):
+            filename = job['filename']
+
+            display = self.get_display( clip )
+            if display.display_style == OVERLAY:
+                overlays.append( { 'clip' : clip,
+                                   'filename' : filename } )
+            else:
+                clip_files.append( filename )
+        
+        # Handle the non-overlays.
+        if len( clip_files ):
+            if len( clip_files ) > 1:
+                # There is concatenation to be done.
+                concat_vid = self.get_next_renderfile()
+                concat_file = self.write_scratch_file( "".join( [ "file '%s'\n" % ( clip_file ) for clip_file in clip_files ] ), prefix="concat-" )
+                    
+                if self.can_stream_copy( clip_files ):
+                    # Our clips all have identical stream parameters,
+                    # so we can concatenate without re-encoding.
+                    cmd = [ FFMPEG, '-y', '-f', 'concat', '-safe', '0', '-i', concat_file, '-c', 'copy', concat_vid ]
+                elif self.video_only:
+                    cmd = [ FFMPEG, '-y', '-f', 'concat', '-safe', '0', '-i', concat_file, '-an', '-pix_fmt', self.pix_fmt, '-r', '30000/1001' ] + codecs['video'].split() + [ concat_vid ]
+                else:
+                    cmd = [ FFMPEG, '-y', '-f', 'concat', '-safe', '0', '-i', concat_file, '-pix_fmt', self.pix_fmt, '-r', '30000/1001' ] + codecs['video'].split() + codecs['audio'].split() + [ '-ac', '%d' % ( audio_channels ), concat_vid ]
+
+                log.info( "Running: %s" % ( FFmpegJob.quote_cmd( cmd ) ) )
+                ( status, output ) = Window.run_command( cmd )
+                log.debug( "Output was: %s" % ( output ) )
+                if status != 0 or not os.path.exists( concat_vid ):
+                    raise Exception( "Error producing concatenated file %s with command: %s\n\nOutput was: %s" % ( concat_vid, FFmpegJob.quote_cmd( cmd ), output ) )
+                self.release_scratch_file( concat_file )
+
+                overlay_video = Video( concat_vid, persist=False )
+            else:
+                # There is just one non-overlay.
+                overlay_video = Video( clip_files[0], persist=False )
+                concat_vid = clip_files[0]
+
+            audio_clause = ""
+            if overlay_video.channels is None:
+                audio_clause = "[0:a] afifo"
+            else:
+                audio_clause = "[0:a] afifo [a0] ; [1:a] afifo [a1] ; [a0] [a1] amix=inputs=2:duration=longest:dropout_transition=5"
+
+            # Put the result on top of the background_file, and the
+            # watermark layer on top of that if there are no overlays
+            # to be added after.
+            layer_args = []
+            video_clause = "[a] [b] overlay=x=0:y=0:eof_action=pass"
+            if watermark_layer is not None and len( overlays ) == 0:
+                layer_args = [ '-i', watermark_layer ]
+                video_clause = "[a] [b] overlay=x=0:y=0:eof_action=pass [c] ; %s" % ( self.get_watermark_layer_clause( 'c', 2 ) )
+
+            tmpfile = self.get_next_renderfile()
+            if self.video_only:
+                cmd = [ FFMPEG, '-y', '-i', background_file, '-i', concat_vid ] + layer_args + [ '-an', '-pix_fmt', self.pix_fmt, '-r', '30000/1001' ] + codecs['video'].split() + [ '-filter_complex', '[0:v] fifo,setpts=PTS-STARTPTS/TB [a] ; [1:v] fifo,setpts=PTS-STARTPTS/TB [b] ; %s' % ( video_clause ), '-t', '%f' % ( self.duration ), tmpfile ]
+            else:
+                cmd = [ FFMPEG, '-y', '-i', background_file, '-i', concat_vid ] + layer_args + [ '-pix_fmt', self.pix_fmt, '-r', '30000/1001' ] + codecs['video'].split() + codecs['audio'].split() + [ '-ac', '%d' % ( audio_channels ), '-filter_complex', '[0:v] fifo,setpts=PTS-STARTPTS/TB [a] ; [1:v] fifo,setpts=PTS-STARTPTS/TB [b] ; %s ; %s' % ( video_clause, audio_clause ), '-t', '%f' % ( self.duration ), tmpfile ]
+
+            log.info( "Running: %s" % ( FFmpegJob.quote_cmd( cmd ) ) )
+            ( status, output ) = Window.run_command( cmd )
+            log.debug( "Output was: %s" % ( output ) )
+            if status != 0 or not os.path.exists( tmpfile ):
+                raise Exception( "Error producing concatenated clip file %s with command: %s\n\nOutput was: %s" % ( tmpfile, FFmpegJob.quote_cmd( cmd ), output ) )
+            self.release_scratch_file( background_file )
+            self.release_scratch_file( concat_vid )
+        else:
+            tmpfile = background_file
+
+
+        # Add our overlays.
+        ( duration, overlay_timing ) = self.compute_duration( clips, include_overlay_timing=True )
+
+        # Goofy nested for loops here because ffmpeg has problems if
+        # the command line gets too long with too many overlays, so we
+        # do it a bit at a time.
+        for overlay_group in range( 0, len( overlays ), self.overlay_batch_concurrency ):
+            prior_file = tmpfile
+            batch = list( range( overlay_group, min( len( overlays ), overlay_group + self.overlay_batch_concurrency ) ) )
+
+            # The last batch overlays the watermark layer as well, so
+            # has to re-encode all of prior_file.
+            last = overlay_group + self.overlay_batch_concurrency >= len( overlays )
+            layer = None
+            if last:
+                layer = watermark_layer
+
+            span = None
+            if self.windowed_overlays and layer is None:
+                span = self.get_overlay_span( tmpfile, [ overlay_timing[overlay_idx] for overlay_idx in batch ] )
+
+            if span is not None:
+                # The overlays are placed the same way if we have to
+                # fall back to re-encoding all of prior_file.
+                rng_state = self.rng.getstate()
+                tmpfile = self.apply_overlay_span( prior_file, overlays, overlay_timing, batch, span, audio_channels )
+                if tmpfile is None:
+                    self.rng.setstate( rng_state )
+
+            if span is None or tmpfile is None:
+                if layer is None:
+                    ( include_args, video_filters, audio_clips ) = self.get_overlay_filters( overlays, overlay_timing, batch )
+                else:
+                    ( include_args, video_filters, audio_clips ) = self.get_overlay_filters( overlays, overlay_timing, batch, output='w' )
+                    include_args += [ '-i', layer ]
+                    video_filters.append( "%s [outv]" % ( self.get_watermark_layer_clause( 'w', len( batch ) + 1 ) ) )
+                audio_clause = self.get_overlay_audio_clause( audio_clips )
+
+                tmpfile = self.get_next_renderfile()
+                if self.video_only:
+                    cmd = [ FFMPEG, '-y', '-i', prior_file ] + include_args + [ '-an', '-pix_fmt', self.pix_fmt, '-r', '30000/1001' ] + codecs['video'].split() + [ '-filter_complex', " ; ".join( video_filters ), '-map', '[outv]', tmpfile ]
+                else:
+                    cmd = [ FFMPEG, '-y', '-i', prior_file ] + include_args + [ '-pix_fmt', self.pix_fmt, '-r', '30000/1001' ] + codecs['video'].split() + codecs['audio'].split() + [ '-ac', '%d' % ( audio_channels ), '-filter_complex', '%s ; %s' % ( " ; ".join( video_filters ), audio_clause ), '-map', '[outv]', '-map', '[outa]', tmpfile ]
+                log.info( "Running: %s" % ( FFmpegJob.quote_cmd( cmd ) ) )
+                ( status, output ) = Window.run_command( cmd )
+                log.debug( "Output was: %s" % ( output ) )
+                if status != 0 or not os.path.exists( tmpfile ):
+                    raise Exception( "Error producing clip file by %s at: %s\n\nOutput was: %s" % ( FFmpegJob.quote_cmd( cmd ), tmpfile, output ) )
+
+            self.release_scratch_file( prior_file )
+
+        return tmpfile
+
+
+    ### Window method ########################################
+    def get_overlay_filters( self, overlays, overlay_timing, batch, offset=0, output='outv' ):
+        '''Internal utility function that builds the ffmpeg inputs and
+        filters which overlay the overlays whose indices are in batch
+        onto input 0, with their start times moved offset seconds
+        earlier.
+
+        Returns a ( include_args, video_filters, audio_clips ) tuple,
+        where include_args is a list of the ffmpeg arguments for the
+        inputs, video_filters is a list of filter chains the last of
+        which is labeled output, and audio_clips lists the inputs whose
+        audio is to be mixed in, with their delays in milliseconds
+        from the start of input 0 (not moved by offset).
+        '''
+        include_args = []
+        video_filters = []
+        audio_clips = []
+
+        prior_overlay = '0:v'
+        for ilabel, overlay_idx in enumerate( batch, 1 ):
+            overlay_start = overlay_timing[overlay_idx][0]
+            overlay = overlays[overlay_idx]['clip']
+            display = self.get_display( overlay )
+
+            include_args += [ '-i', overlays[overlay_idx]['filename'] ]
+
+            ( ow, oh, x, y ) = self.get_overlay_geometry( overlay, display, overlay_start - offset )
+            video_filters.append( "[%d:v] fifo,scale=width=%d:height=%d,setpts=PTS-STARTPTS+%f/TB [o%d]" % ( ilabel, ow, oh, overlay_start - offset, overlay_idx ) )
+
+            # Only include audio for this clip if the display says to include it.
+            if display.include_audio:
+                audio_clips.append( {
+                    "ilabel" : ilabel,
+                    "start" : overlay_start*1000,
+                    "channels" : overlay.get_channels(),
+                } )
+
+            if ilabel == len( batch ):
+                label = output
+            else:
+                label = 't%d' % ( overlay_idx )
+            video_filters.append( "[%s] [o%d] overlay=x=%s:y=%s:eof_action=pass [%s]" % ( prior_overlay, overlay_idx, x, y, label ) )
+            prior_overlay = label
+
+        return ( include_args, video_filters, audio_clips )
+
+
+    ### Window method ########################################
+    def get_overlay_audio_clause( self, audio_clips ):
+        '''Internal utility function that returns the ffmpeg filter
+        clause which mixes the audio of the audio_clips returned by
+        get_overlay_filters into the audio of input 0, labeled outa.
+        '''
+        audio_offsets = ""
+        audio_mix = " [0:a] "
+        aindex = 1
+        for aclip in audio_clips:
+            adelay_clause = ""
+            if aclip['start'] > 0:
+                adelay_clause = ",adelay=" + "|".join( [ str( aclip['start'] ) for x in range( aclip['channels'] ) ] )
+            audio_offsets += " [%d:a] afifo%s [a%d] ; " % ( aclip['ilabel'], adelay_clause, aindex )
+            audio_mix += " [a%d] " % ( aindex )
+            aindex += 1
+        if aindex > 1:
+            return audio_offsets + audio_mix + " amix=inputs=%d:duration=longest:dropout_transition=5 [outa] " % ( aindex )
+        else:
+            return audio_offsets + audio_mix + " afifo [outa] "
+
+
+    ### Window method ########################################
+    def get_overlay_span( self, current, timings ):
+        '''Internal utility function that finds the part of current that
+        a batch of overlays with the ( start, end ) timings covers,
+        widened to the keyframes of current so the rest of it can be
+        copied without re-encoding.
+
+        Returns a ( start, end ) tuple of times in seconds, or None if
+        the overlays cover all of current.
+        '''
+        video = Video( current, persist=False )
+        keyframes = video.get_keyframes()
+
+        span_start = min( [ timing[0] for timing in timings ] )
+        span_end = max( [ timing[1] for timing in timings ] )
+
+        start = max( [ 0 ] + [ k for k in keyframes if k <= span_start ] )
+        end = min( [ video.duration ] + [ k for k in keyframes if k >= span_end ] )
+
+        if start <= 0 and end >= video.duration:
+            return None
+        else:
+            return ( start, end )
+
+
+    ### Window method ########################################
+    def apply_overlay_span( self, current, overlays, overlay_timing, batch, span, audio_channels ):
+        '''Internal utility function which applies the overlays whose
+        indices are in batch to current by re-encoding only the video
+        between the start and end times of span.  The video before and
+        after span is copied without re-encoding, and the audio of the
+        overlays is mixed in over the whole of current in a separate
+        audio only command, so there are no artifacts where the
+        re-encoded video is joined.
+
+        The re-encoded video is only joined with the copied video if
+        their codecs, profiles, levels, parameter sets and formats are
+        identical.
+
+        Returns the path of the file it generated, or None if the
+        re-encoded video can't be joined with current and the whole
+        of current must be re-encoded instead.
+        '''
+        codecs = Window.get_codecs()
+        ( start, end ) = span
+
+        ( include_args, video_filters, audio_clips ) = self.get_overlay_filters( overlays, overlay_timing, batch, offset=start )
+
+        log.info( "Re-encoding %f to %f of %s to apply overlays." % ( start, end, current ) )
+
+        middle = self.get_next_renderfile()
+        cmd = [ FFMPEG, '-y', '-ss', '%f' % ( start ), '-t', '%f' % ( end - start ), '-i', current ] + include_args + [ '-an', '-pix_fmt', self.pix_fmt, '-r', '30000/1001' ] + codecs['video'].split() + [ '-filter_complex', " ; ".join( video_filters ), '-map', '[outv]', '-t', '%f' % ( end - start ), middle ]
+        log.info( "Running: %s" % ( FFmpegJob.quote_cmd( cmd ) ) )
+        ( status, output ) = Window.run_command( cmd )
+        log.debug( "Output was: %s" % ( output ) )
+        if status != 0 or not os.path.exists( middle ):
+            raise Exception( "Error applying overlays to %f to %f of file %s with command: %s\n\nOutput was: %s" % ( start, end, current, FFmpegJob.quote_cmd( cmd ), output ) )
+
+        current_video = Video( current, persist=False )
+        if Video( middle, persist=False ).get_video_params() != current_video.get_video_params():
+            log.info( "Overlays re-encoded with differing stream parameters than %s, re-encoding all of it instead." % ( current ) )
+            self.release_scratch_file( middle )
+            return None
+
+        cmds = []
+        segments = []
+
+        if start > 0:
+            before = self.get_next_renderfile()
+            cmds.append( [ FFMPEG, '-y', '-i', current, '-an', '-c:v', 'copy', '-t', '%f' % ( start ), before ] )
+            segments.append( before )
 
-        Inputs:
+        segments.append( middle )
 
-        self - The current Window
+        if end < current_video.duration:
+            after = self.get_next_renderfile()
+            cmds.append( [ FFMPEG, '-y', '-ss', '%f' % ( end ), '-i', current, '-an', '-c:v', 'copy', '-avoid_negative_ts', 'make_zero', after ] )
+            segments.append( after )
 
-        clips - a list of clips to render
+        audio_file = current
+        if len( audio_clips ) and not self.video_only:
+            audio_file = self.get_next_renderfile()
+            cmds.append( [ FFMPEG, '-y', '-i', current ] + include_args + [ '-vn', '-ac', '%d' % ( audio_channels ) ] + codecs['audio'].split() + [ '-filter_complex', self.get_overlay_audio_clause( audio_clips ), '-map', '[outa]', audio_file ] )
 
-        background_file - Path to a video file with a background for
-        any OVERLAY clips to be rendered onto, this is returned if the
-        clips argument is the empty list
+        concat_file = self.write_scratch_file( "".join( [ "file '%s'\n" % ( segment ) for segment in segments ] ), prefix="concat-" )
+        tmpfile = self.get_next_renderfile()
+        if self.video_only:
+            cmds.append( [ FFMPEG, '-y', '-f', 'concat', '-safe', '0', '-i', concat_file, '-c', 'copy', tmpfile ] )
+        else:
+            cmds.append( [ FFMPEG, '-y', '-f', 'concat', '-safe', '0', '-i', concat_file, '-i', audio_file, '-map', '0:v', '-map', '1:a', '-c', 'copy', tmpfile ] )
 
-        For each clip we:
-        
-        1. Check in our cache to see if we already have a version of
-        this clip in the appropriate resolution.
-        
-        2. If there is a cache miss, produce a clip of the appropriate
-        resolution and cache it.
-        
-        3. Concatenate and overlay the following clips according to
-        this procedure:
+        for cmd in cmds:
+            log.info( "Running: %s" % ( FFmpegJob.quote_cmd( cmd ) ) )
+            ( status, output ) = Window.run_command( cmd )
+            log.debug( "Output was: %s" % ( output ) )
+            if status != 0:
+                raise Exception( "Error applying overlays to %f to %f of file %s with command: %s\n\nOutput was: %s" % ( start, end, current, FFmpegJob.quote_cmd( cmd ), output ) )
 
-        We process the Clips in order in self.clips, and concatenate
-        all the non-OVERLAY clips to one another.
+        if not os.path.exists( tmpfile ):
+            raise Exception( "Error applying overlays to %f to %f of file %s, no output was produced." % ( start, end, current ) )
 
-        Then we overlay the OVERLAY clips on top, starting at the
-        beginning.
+        for filename in segments + [ concat_file, audio_file ]:
+            if filename != current:
+                self.release_scratch_file( filename )
 
-        The return value is a file of rendered video, either that
-        containing the clips, or just the background_file itself if
-        there were no clips.
+        return tmpfile
+
+
+    ### Window method ########################################
+    def get_overlay_geometry( self, overlay, display, overlay_start ):
+        '''Internal utility function that randomly sizes and places an
+        OVERLAY Clip which begins cascading across this Window at
+        overlay_start.
 
+        Returns a ( width, height, x, y ) tuple, where x and y are
+        expressions for the ffmpeg overlay filter.
         '''
+        scale = self.rng.uniform( 1.0/3, 2.0/3 )
+        # Set the width to be randomly between 2/3 and 1/3th
+        # of the window width, and the height so the aspect
+        # ratio is retained.
+        ow = 2*int( self.width*scale // 2 )
+        oh = 2*int( overlay.video.height * ow // int( overlay.video.width * 2 ) )
+
+        direction = display.overlay_direction
+
+        if direction in [ UP, DOWN ]:
+            x = self.rng.randint( 0, self.width - ow )
+            if direction == UP:
+                y = "'if( gte(t,%f), H-(t-%f)*%f, NAN)'" % ( overlay_start, overlay_start, float( self.height+oh ) / overlay.get_duration() )
+            elif direction == DOWN:
+                y = "'if( gte(t,%f), -h+(t-%f)*%f, NAN)'" % ( overlay_start, overlay_start, float( self.height+oh ) / overlay.get_duration() )
+        else:
+            y = self.rng.randint( 0, self.height - oh )
+            if direction == LEFT:
+                x = "'if( gte(t,%f), -w+(t-%f)*%f, NAN)'" % ( overlay_start, overlay_start, float( self.width+ow ) / overlay.get_duration() )
+            elif direction == RIGHT:
+                x = "'if( gte(t,%f), W-(t-%f)*%f, NAN)'" % ( overlay_start, overlay_start, float( self.width+ow ) / overlay.get_duration() )
 
-        if len( clips ) == 0:
-            # Nothing to do.
-            return background_file
+        return ( ow, oh, x, y )
 
-        tmpfile = None
 
-        clip_files = []
-        overlays = []
-        
-        # Build up our library of clips.
-        for clip in self.clips:
-            filename = self.clip_render( clip, audio_channels )
+    ### Window method ########################################
+    def can_stream_copy( self, filenames ):
+        '''Internal utility function which returns True if all the video
+        files in filenames have identical video and audio stream
+        parameters, so they can be concatenated without re-encoding.
+        '''
+        params = set()
+        for filename in filenames:
+            video = Video( filename, persist=False )
+            params.add( video.get_video_params() + ( video.audio_codec_name,
+                                                     video.channels,
+                                                     video.sample_rate ) )
+
+        if len( params ) == 1:
+            return True
+        else:
+            log.info( "Clips have differing stream parameters, re-encoding to concatenate them: %s" % ( params ) )
+            return False
 
-            display = self.get_display( clip )
-            if display.display_style == OVERLAY:
-                overlays.append( { 'clip' : clip,
-                                   'filename' : filename } )
-            else:
-                clip_files.append( filename )
-        
-        # Handle the non-overlays.
-        if len( clip_files ):
-            if len( clip_files ) > 1:
-                # There is concatenation to be done.
-                concat_vid = self.get_next_renderfile()
-                concat_file = "%s/concat-%s.txt" % ( Window.tmpdir, str( uuid.uuid4() ) )
-                f = open( concat_file, 'w' )
-                for clip_file in clip_files:
-                    f.write( "file '%s'\n" % ( clip_file ))
-                f.close()
-                    
-                cmd = "%s -y -f concat -safe 0 -i %s -pix_fmt %s -r 30000/1001 -crf 16 -c:v libx264 -c:a libfdk_aac -ac %d %s" % ( FFMPEG, concat_file, self.pix_fmt, audio_channels, concat_vid )
 
-                log.info( "Running: %s" % ( cmd ) )
-                ( status, output ) = subprocess.getstatusoutput( cmd )
-                log.debug( "Output was: %s" % ( output ) )
-                if status != 0 or not os.path.exists( concat_vid ):
-                    raise Exception( "Error producing concatenated file %s with command: %s\n\nOutput was: %s" % ( concat_vid, cmd, output ) )
+    ### Window method ########################################
+    def get_clip_job( self, clip, channels, peek=False ):
+        '''Determine how a single clip should be rendered into the tmpdir
+        according to the rules defined by the appropriate Display
+        object, without rendering it.
+
+        This must be called for the clips of a Window in order, as
+        PAN Displays may alternate their direction from one Clip to
+        the next.
+
+        Returns a dictionary with the clip_hash and filename of the
+        rendered clip, whether it is already cached, and otherwise the
+        list of cmds which would render it to tmpfile.  If the Window
+        uses smart_cut, smart_cut holds the ( clip, display, channels )
+        arguments of get_smart_cut_cmds, which run_clip_job tries
+        before cmds; the keyframes of the Video are only probed then,
+        so nothing is run or written here.  If peek is True the cache
+        is consulted without recording the access, and without reading
+        Videos whose fingerprints have not been computed.
+        '''
+        display = self.get_display( clip )
 
-                overlay_video = Video( concat_vid )
-            else:
-                # There is just one non-overlay.
-                overlay_video = Video( clip_files[0] )
-                concat_vid = clip_files[0]
+        scale_clause = self.get_scale_clause( clip, display )
 
-            audio_clause = ""
-            if overlay_video.channels is None:
-                audio_clause = " [0:a] afifo "
-            else:
-                audio_clause = " [0:a] afifo [a0] ; [1:a] afifo [a1] ; [a0] [a1] amix=inputs=2:duration=longest:dropout_transition=5 "
+        # Check the cache for such a clip.
+        clip_hash = self.get_clip_hash( clip=clip, 
+                                        width=self.width, 
+                                        height=self.height, 
+                                        pan_direction=display.prior_pan, 
+                                        pix_fmt=self.pix_fmt, 
+                                        include_audio=display.include_audio,
+                                        smart_cut=self.smart_cut,
+                                        peek=peek ) 
+
+        filename = "%s/%s.%s" % ( Window.tmpdir, clip_hash, Window.get_codecs()['extension'] )
+
+        cached_file = None
+        if not self.force:
+            cached_file = Window.get_cache_entry( clip_hash, peek=peek, filename=filename )
+
+        if cached_file is not None:
+            return { 'clip_hash' : clip_hash,
+                     'filename'  : cached_file,
+                     'tmpfile'   : None,
+                     'cached'    : True,
+                     'cmds'      : [],
+                     'smart_cut' : None }
+
+        # OK - because we want to be able to concatenate clips,
+        # and concatenate requires identical video and audio
+        # stream configurations, we have to create a silent audio
+        # channels if none exists.            
+        add_silent_audio = []
+        if clip.get_channels() is None or not display.include_audio:
+            add_silent_audio = [ '-f', 'lavfi', '-i', 'aevalsrc=0' ]
+
+        audio_args = add_silent_audio + [ '-ac', '%d' % ( channels ) ]
+
+        filter_components = []
+        if scale_clause != "":
+            filter_components.append( scale_clause )
+        if clip.get_channels() is None or not display.include_audio:
+            filter_components.append( "[1:a] afifo" )
+
+        filter_args = []
+        if len( filter_components ):
+            filter_args = [ '-filter_complex', " ; ".join( filter_components ) ]
+
+        # We render to a uniquely named file and then move it into
+        # place, so concurrent renders of the same clip don't write
+        # to the same file.
+        tmpfile = self.get_next_renderfile()
+        codecs = Window.get_codecs()
 
-            # Put the result on top of the background_file.
-            tmpfile = self.get_next_renderfile()
-            cmd = '%s -y -i %s -i %s -pix_fmt %s -r 30000/1001 -crf 16 -c:v libx264 -c:a libfdk_aac -ac %d -filter_complex " [0:v] fifo,setpts=PTS-STARTPTS/TB [a] ; [1:v] fifo,setpts=PTS-STARTPTS/TB [b] ; [a] [b] overlay=x=0:y=0:eof_action=pass ; %s " -t %f %s' % ( FFMPEG, background_file, concat_vid, self.pix_fmt, audio_channels, audio_clause, self.duration, tmpfile )
+        smart_cut = None
+        if self.smart_cut:
+            smart_cut = ( clip, display, channels )
 
-            log.info( "Running: %s" % ( cmd ) )
-            ( status, output ) = subprocess.getstatusoutput( cmd )
-            log.debug( "Output was: %s" % ( output ) )
-            if status != 0 or not os.path.exists( tmpfile ):
-                raise Exception( "Error producing concatenated clip file %s with command: %s\n\nOutput was: %s" % ( tmpfile, cmd, output ) )
-        else:
-            tmpfile = background_file
+        cmds = [ [ FFMPEG, '-y', '-ss', '%f' % ( clip.start ), '-i', clip.video.filename ] + audio_args + [ '-pix_fmt', self.pix_fmt, '-r', '30000/1001' ] + codecs['video'].split() + codecs['audio'].split() + filter_args + [ '-t', '%f' % ( clip.get_duration() ), tmpfile ] ]
 
+        return { 'clip_hash' : clip_hash,
+                 'filename'  : filename,
+                 'tmpfile'   : tmpfile,
+                 'cached'    : False,
+                 'cmds'      : cmds,
+                 'smart_cut' : smart_cut }
 
-        # Add our overlays.
-        ( duration, overlay_timing ) = self.compute_duration( clips, include_overlay_timing=True )
 
-        # Goofy nested for loops here because ffmpeg has problems if
-        # the command line gets too long with too many overlays, so we
-        # do it a bit at a time.
-        for overlay_group in range( 0, len( overlays ), self.overlay_batch_concurrency ):
-            prior_overlay = '0:v'
-            cmd = "%s -y -i %s " % ( FFMPEG, tmpfile )
-            include_clause = ""
-            scale_clause = ""
-            filter_complex = ' -pix_fmt %s -r 30000/1001 -crf 16 -c:v libx264 -c:a libfdk_aac -ac %d -filter_complex " ' % ( self.pix_fmt, audio_channels )
-            audio_clips = []
-            for overlay_idx in range( overlay_group, min( len( overlays ), overlay_group + self.overlay_batch_concurrency ) ):
-                overlay_start = overlay_timing[overlay_idx][0]
-                overlay_end = overlay_timing[overlay_idx][1]
-                overlay = overlays[overlay_idx]['clip']
-                display = self.get_display( overlay )
-                filename = overlays[overlay_idx]['filename']
-
-                include_clause += " -i %s " % ( filename )
-
-                scale = random.uniform( 1.0/3, 2.0/3 )
-                # Set the width to be randomly between 2/3 and 1/3th
-                # of the window width, and the height so the aspect
-                # ratio is retained.
-                ow = 2*int( self.width*scale // 2 )
-                oh = 2*int( overlay.video.height * ow // int( overlay.video.width * 2 ) )
-                ilabel = overlay_idx + 1 - overlay_group
-                filter_complex += " [%d:v] fifo,scale=width=%d:height=%d,setpts=PTS-STARTPTS+%f/TB [o%d] ; " % ( ilabel, ow, oh, overlay_start, overlay_idx )
-                
-                # Only include audio for this clip if the display says to include it.
-                if display.include_audio:
-                    adelay = overlay_start*1000
-
-                    audio_clips.append( {
-                        "ilabel" : ilabel,
-                        "start" : adelay,
-                        "channels" : overlay.get_channels(),
-                    } )
-
-                direction = display.overlay_direction
-
-                if direction in [ UP, DOWN ]:
-                    x = random.randint( 0, self.width - ow )
-                    if direction == UP:
-                        y = "'if( gte(t,%f), H-(t-%f)*%f, NAN)'" % ( overlay_start, overlay_start, float( self.height+oh ) / overlay.get_duration() )
-                    elif direction == DOWN:
-                        y = "'if( gte(t,%f), -h+(t-%f)*%f, NAN)'" % ( overlay_start, overlay_start, float( self.height+oh ) / overlay.get_duration() )
-                else:
-                    y = random.randint( 0, self.height - oh )
-                    if direction == LEFT:
-                        x = "'if( gte(t,%f), -w+(t-%f)*%f, NAN)'" % ( overlay_start, overlay_start, float( self.width+ow ) / overlay.get_duration() )
-                    elif direction == RIGHT:
-                        x = "'if( gte(t,%f), W-(t-%f)*%f, NAN)'" % ( overlay_start, overlay_start, float( self.width+ow ) / overlay.get_duration() )
+    ### Window method ########################################
+    def get_smart_cut_cmds( self, clip, display, channels, tmpfile ):
+        '''Internal utility function which returns the commands that
+        render clip to tmpfile by re-encoding only the video from the
+        start of the clip to the first keyframe in it, and from the
+        last keyframe in it to the end of the clip, and copying the
+        video between those keyframes.  The audio is re-encoded in
+        one piece and combined with the video at the end.
+
+        H.264 ends are encoded with the profile and level of the
+        Video, and with their parameter sets repeated in-band, as are
+        those of the copied video, so each piece carries the parameter
+        sets it is decoded with and they need not be identical.  The
+        pieces must still be checked with run_smart_cut_pieces before
+        they are joined, as an encoder may not honor the profile or
+        level it is asked for.
+
+        Returns a dictionary of the cmds which render the pieces, the
+        list of pieces, the join_cmds which join them into tmpfile,
+        and the list of scratch files all of those write, or None if
+        the clip can't be cut this way, because it would need to be
+        scaled or converted, or has too few keyframes which begin a
+        closed GOP for copying to be worthwhile.
+        '''
+        codecs = Window.get_codecs()
+        video = clip.video
+
+        # If the Video is already the size of this Window then the
+        # scale_clause of any display_style has no effect, and
+        # OVERLAY Clips are never scaled here.
+        if display.display_style != OVERLAY and ( video.width != self.width or video.height != self.height ):
+            return None
+        if video.pix_fmt != self.pix_fmt or video.frame_rate != "30000/1001" or video.codec_name != codecs['codec_name']:
+            return None
+
+        encode_args = codecs['video'].split()
+        copy_args = [ '-c:v', 'copy' ]
+        if video.codec_name == 'h264':
+            if video.profile not in X264_PROFILES or video.level is None or video.level <= 0:
+                return None
+            encode_args += [ '-profile:v', X264_PROFILES[video.profile], '-level', '%d' % ( video.level ), '-x264-params', 'repeat-headers=1' ]
+            copy_args += [ '-bsf:v', 'dump_extra' ]
+
+        keyframes = [ k for k in video.get_keyframes() if k >= clip.start and k <= clip.end ]
+        if len( keyframes ) < 2 or keyframes[-1] - keyframes[0] < 1:
+            return None
+        ( copy_start, copy_end ) = ( keyframes[0], keyframes[-1] )
+
+        cmds = []
+        pieces = []
+
+        # The video from the start of the clip to the first keyframe.
+        if copy_start > clip.start:
+            head = self.get_next_renderfile()
+            cmds.append( [ FFMPEG, '-y', '-ss', '%f' % ( clip.start ), '-i', video.filename, '-an', '-pix_fmt', self.pix_fmt, '-r', '30000/1001' ] + encode_args + [ '-t', '%f' % ( copy_start - clip.start ), head ] )
+            pieces.append( head )
+
+        # The whole GOPs between the first and last keyframes.
+        middle = self.get_next_renderfile()
+        cmds.append( [ FFMPEG, '-y', '-ss', '%f' % ( copy_start ), '-i', video.filename, '-an' ] + copy_args + [ '-avoid_negative_ts', 'make_zero', '-t', '%f' % ( copy_end - copy_start ), middle ] )
+        pieces.append( middle )
+
+        # The video from the last keyframe to the end of the clip.
+        if clip.end > copy_end:
+            tail = self.get_next_renderfile()
+            cmds.append( [ FFMPEG, '-y', '-ss', '%f' % ( copy_end ), '-i', video.filename, '-an', '-pix_fmt', self.pix_fmt, '-r', '30000/1001' ] + encode_args + [ '-t', '%f' % ( clip.end - copy_end ), tail ] )
+            pieces.append( tail )
+
+        join_cmds = []
+
+        concat_file = self.write_scratch_file( "".join( [ "file '%s'\n" % ( piece ) for piece in pieces ] ), prefix="concat-" )
+        video_file = self.get_next_renderfile()
+        join_cmds.append( [ FFMPEG, '-y', '-f', 'concat', '-safe', '0', '-i', concat_file, '-c', 'copy', video_file ] )
+
+        # The audio for the whole clip.
+        if clip.get_channels() is None or not display.include_audio:
+            audio_input = [ '-f', 'lavfi', '-i', 'aevalsrc=0' ]
+        else:
+            audio_input = [ '-ss', '%f' % ( clip.start ), '-i', video.filename ]
+        audio_file = self.get_next_renderfile()
+        join_cmds.append( [ FFMPEG, '-y' ] + audio_input + [ '-vn', '-ac', '%d' % ( channels ) ] + codecs['audio'].split() + [ '-t', '%f' % ( clip.get_duration() ), audio_file ] )
 
-                filter_complex += ' [%s] [o%d] overlay=x=%s:y=%s:eof_action=pass [t%d] ; ' % ( prior_overlay, overlay_idx, x, y, overlay_idx )
-                prior_overlay = 't%d' % ( overlay_idx )
+        join_cmds.append( [ FFMPEG, '-y', '-i', video_file, '-i', audio_file, '-map', '0:v', '-map', '1:a', '-c', 'copy', '-t', '%f' % ( clip.get_duration() ), tmpfile ] )
 
-            tmpfile = self.get_next_renderfile()                                          
+        return { 'cmds'      : cmds,
+                 'pieces'    : pieces,
+                 'join_cmds' : join_cmds,
+                 'scratch'   : pieces + [ concat_file, video_file, audio_file ] }
 
-            # Strip off the trailing [t##] ; of the filter_complex
-            filter_complex = filter_complex[:-(6+len( str( overlay_idx - 1 ) ) )]
-            filter_complex += " [outv] ; "
-            
-            audio_offsets = ""
-            audio_mix = " [0:a] "
-            aindex = 1
-            for aclip in audio_clips:
-                adelay_clause = ""
-                if aclip['start'] > 0:
-                    adelay_clause = ",adelay=" + "|".join( [ str( aclip['start'] ) for x in range( aclip['channels'] ) ] )
-                audio_offsets += " [%d:a] afifo%s [a%d] ; " % ( aclip['ilabel'], adelay_clause, aindex )
-                audio_mix += " [a%d] " % ( aindex )
-                aindex += 1
-            if aindex > 1:
-                audio_clause = audio_offsets + audio_mix + " amix=inputs=%d:duration=longest:dropout_transition=5 [outa] " % ( aindex )
-            else:
-                audio_clause = audio_offsets + audio_mix + " afifo [outa] "
 
-            filter_complex += audio_clause
-            cmd += include_clause + filter_complex + ' " -map "[outv]" -map "[outa]" %s' % ( tmpfile )
-            log.info( "Running: %s" % ( cmd ) )
-            ( status, output ) = subprocess.getstatusoutput( cmd )
+    ### Window method ########################################
+    def run_smart_cut_pieces( self, smart_cut ):
+        '''Internal utility function which renders the pieces of a smart
+        cut described by the output of get_smart_cut_cmds.
+
+        Returns True if the pieces were rendered and their video
+        streams have identical codecs, profiles, levels and formats,
+        so they can be joined without re-encoding, and False if the
+        Clip must be transcoded instead.  Their parameter sets are
+        repeated in-band, so they are not compared.
+        '''
+        for cmd in smart_cut['cmds']:
+            log.info( "Running: %s" % ( FFmpegJob.quote_cmd( cmd ) ) )
+            ( status, output ) = Window.run_command( cmd )
             log.debug( "Output was: %s" % ( output ) )
-            if status != 0 or not os.path.exists( tmpfile ):
-                raise Exception( "Error producing clip file by %s at: %s\n\nOutput was: %s" % ( cmd, tmpfile, output ) )
+            if status != 0:
+                log.warn( "Error producing smart cut piece by %s, output was: %s" % ( FFmpegJob.quote_cmd( cmd ), output ) )
+                return False
 
-        return tmpfile
+        params = set( [ Video( piece, persist=False ).get_decoding_params() for piece in smart_cut['pieces'] ] )
+        if len( params ) != 1:
+            log.info( "Smart cut pieces have differing stream parameters and can't be joined without re-encoding: %s" % ( params ) )
+            return False
+
+        return True
 
 
     ### Window method ########################################
-    def clip_render( self, clip, channels ):
-        '''Render a single clip into the tmpdir according to the rules defined
-        by the appropriate Display object.
+    def run_clip_job( self, job ):
+        '''Render a clip as described by the output of get_clip_job, and
+        save it in the cache.
 
         Returns the name of a file where the resulting rendered clip
         is at.
         '''
-        display = self.get_display( clip )
+        if job['cached']:
+            log.info( "Cache hit for clip: %s" % ( job['clip_hash'] ) )
+            return job['filename']
+
+        if os.path.exists( job['filename'] ):
+            # Another program sharing the tmpdir published this clip
+            # since we looked in the cache.
+            log.info( "Clip was published while waiting to render it: %s" % ( job['clip_hash'] ) )
+            Window.add_cache_entry( job['clip_hash'], job['filename'] )
+            return job['filename']
+
+        cmds = job['cmds']
+        scratch = []
+        if job['smart_cut'] is not None:
+            ( clip, display, channels ) = job['smart_cut']
+            smart_cut = self.get_smart_cut_cmds( clip, display, channels, job['tmpfile'] )
+            if smart_cut is not None:
+                if self.run_smart_cut_pieces( smart_cut ):
+                    ( cmds, scratch ) = ( smart_cut['join_cmds'], smart_cut['scratch'] )
+                else:
+                    log.info( "Transcoding all of clip %s instead of smart cutting it." % ( job['clip_hash'] ) )
+                    for filename in smart_cut['scratch']:
+                        self.release_scratch_file( filename )
+
+        for cmd in cmds:
+            log.info( "Running: %s" % ( FFmpegJob.quote_cmd( cmd ) ) )
+            ( status, output ) = Window.run_command( cmd )
+            log.debug( "Output was: %s" % ( output ) )
+            if status != 0:
+                break
+
+        for filename in scratch:
+            self.release_scratch_file( filename )
+
+        if status == 0 and os.path.exists( job['tmpfile'] ):
+            os.rename( job['tmpfile'], job['filename'] )
+            Window.add_cache_entry( job['clip_hash'], job['filename'] )
+        else:
+            raise Exception( "Error producing clip file by %s at: %s\n\nOutput was: %s" % ( FFmpegJob.quote_cmd( cmd ), job['filename'], output ) )
+
+        return job['filename']
 
+
+    ### Window method ########################################
+    def get_scale_clause( self, clip, display ):
+        '''Internal utility function that returns the ffmpeg filter
+        clause that fits a Clip into this Window according to the
+        rules of its Display object.
+
+        NOTE: For the PAN display_style this advances the pan
+        direction of the Display if the Clip will be panned.
+        '''
         scale_clause = ""
-        clip_width = None
-        clip_height = None
 
         if display.display_style == PAD:
             ( scale, ow, oh ) = self.get_output_dimensions( clip.video.width, clip.video.height, self.width, self.height, min )
 
-            clip_width = ow
-            clip_height = oh
-
             xterm = ""
             if ow != self.width:
                 xterm = ":x=%d" % ( ( self.width - ow ) // 2 )
@@ -1317,9 +4478,6 @@ class Window( object ):
         elif display.display_style == CROP:
             ( scale, ow, oh ) = self.get_output_dimensions( clip.video.width, clip.video.height, self.width, self.height, max )
 
-            clip_width = ow
-            clip_height = oh
-
             if scale != 1:
                 scale_clause = "scale=width=%d:height=%d," % ( ow, oh )
                 
@@ -1328,9 +4486,6 @@ class Window( object ):
         elif display.display_style == PAN:
             ( scale, ow, oh ) = self.get_output_dimensions( clip.video.width, clip.video.height, self.width, self.height, max )
 
-            clip_width = ow
-            clip_height = oh
-
             if scale != 1:
                 scale_clause = "scale=width=%d:height=%d," % ( ow, oh )
 
@@ -1364,60 +4519,10 @@ class Window( object ):
             # scales.
             scale_clause = ""
 
-            clip_width = clip.video.width
-            clip_height = clip.video.height
-
         else:
             raise Exception( "Error, unknown display style: %s" % ( display.display_style ) )
 
-        # Check the cache for such a clip.
-        # If not, produce it and save it in the cache.
-        clip_hash = self.get_clip_hash( clip=clip, 
-                                        width=self.width, 
-                                        height=self.height, 
-                                        pan_direction=display.prior_pan, 
-                                        pix_fmt=self.pix_fmt, 
-                                        include_audio=display.include_audio ) 
-
-        if clip_hash in Window.cache_dict and not self.force:
-            log.info( "Cache hit for clip: %s" % ( clip_hash ) )
-            return Window.cache_dict[clip_hash]
-        else:
-            filename = "%s/%s.mp4" % ( Window.tmpdir, clip_hash )
-            
-            # OK - because we want to be able to concatenate clips,
-            # and concatenate requires identical video and audio
-            # stream configurations, we have to create a silent audio
-            # channels if none exists.            
-            add_silent_audio = ""
-            audio_channels_clause = " -ac %d " % ( channels )
-            if clip.get_channels() is None or not display.include_audio:
-                add_silent_audio = " -f lavfi -i aevalsrc=0 "
-
-            audio_clause = add_silent_audio + audio_channels_clause
-
-            filter_components = []
-            if scale_clause != "":
-                filter_components.append( scale_clause )
-            if clip.get_channels is None or not display.include_audio:
-                filter_components.append( " [1:a] afifo " )
-
-            filter_clause = ""
-            if len( filter_components ):
-                filter_clause = ' -filter_complex " %s " ' % ( " ; ".join( filter_components ) )
-
-            cmd = '%s -y -ss %f -i %s %s -pix_fmt %s -r 30000/1001 -crf 16 -c:v libx264 -c:a libfdk_aac %s -t %f %s' % ( FFMPEG, clip.start, clip.video.filename, audio_clause, self.pix_fmt, filter_clause, clip.get_duration(), filename )
-            
-            log.info( "Running: %s" % ( cmd ) )
-            ( status, output ) = subprocess.getstatusoutput( cmd )
-            log.debug( "Output was: %s" % ( output ) )
-            if status == 0 and os.path.exists( filename ):
-                Window.cache_dict[clip_hash] = filename
-                Window.save_cache_dict()
-            else:
-                raise Exception( "Error producing clip file by %s at: %s\n\nOutput was: %s" % ( cmd, filename, output ) )
-
-        return filename
+        return scale_clause
 
 
     ### Window method ########################################
@@ -1558,7 +4663,7 @@ class Window( object ):
             objects onto a single list.'''
 
             for el in l:
-                if isinstance( el, collections.Iterable ) and not ( isinstance( el, str ) or isinstance( el, bytes ) ):
+                if isinstance( el, Iterable ) and not ( isinstance( el, str ) or isinstance( el, bytes ) ):
                     for sub in flatten( el ):
                         yield sub
                 else:
@@ -1570,6 +4675,63 @@ class Window( object ):
         return flatten( prepend + [ w.get_child_windows( include_self=True ) for w in self.windows ] )
 
 
+    ### Window method ########################################
+    def render_clips( self, clips, background_file, audio_channels ):
+        '''Deprecated, render schedules the clips of each Window itself.
+
+        Render clips, transcoding any which are not in the cache, and
+        composite them onto background_file as render would.  Returns
+        the path of the file generated, or background_file if clips
+        is the empty list.
+        '''
+        log.warn( "Window.render_clips is deprecated and will be removed, use Window.render." )
+        scheduler = Scheduler( Window.max_concurrency )
+        background = scheduler.add( lambda: background_file, name="using background %s" % ( background_file ) )
+        task = self.schedule_clips( scheduler, clips, background, audio_channels )
+        Window.hold_cache_pins()
+        try:
+            scheduler.run()
+        finally:
+            Window.release_cache_pins()
+        return task['result']
+
+
+    ### Window method ########################################
+    def clip_render( self, clip, channels ):
+        '''Deprecated, render schedules the clips of each Window itself.
+
+        Render a single clip into the tmpdir according to the rules
+        defined by the appropriate Display object, or find it in the
+        cache.  Returns the name of a file where the resulting rendered
+        clip is at.
+        '''
+        log.warn( "Window.clip_render is deprecated and will be removed, use Window.render." )
+        return self.run_clip_job( self.get_clip_job( clip, channels ) )
+
+
+    ### Window method ########################################
+    def add_watermarks( self, watermarks, current ):
+        '''Deprecated, render overlays the Watermarks of each Window
+        within a step which re-encodes the video anyway.
+
+        Overlay watermarks on current for the duration of this Window.
+        Returns the path of the file generated.
+        '''
+        log.warn( "Window.add_watermarks is deprecated and will be removed, use Window.render." )
+        ( saved, self.watermarks ) = ( self.watermarks, watermarks )
+        try:
+            watermark_layer = self.render_watermark_layer()
+        finally:
+            self.watermarks = saved
+        stage = { 'name'   : "adding watermarks",
+                  'cmd'    : functools.partial( self.get_watermark_layer_cmd, watermark_layer ),
+                  'inputs' : [] }
+        try:
+            return self.run_stages( [ stage ], current )
+        finally:
+            os.remove( watermark_layer )
+
+
 # Note - I had intended to offer scale arguments for watermark, but
 # ran across FFMPEG bugs (segmentation faults, memory corruption) when
 # using the FFMPEG scale filter on PNG images, so I left it out.
@@ -1655,6 +4817,800 @@ class Watermark( object ):
 
 
 
+################################################################################
+class FilterGraph( object ):
+    '''Internal helper used when a Window is rendered with single_pass
+    set.  A FilterGraph accumulates the inputs and filters of a single
+    ffmpeg filter_complex as a tree of Windows is compiled into it.
+
+    '''
+
+    def __init__( self ):
+        self.inputs = []
+        self.filters = []
+        self.label_count = 0
+
+    def add_input( self, input_args ):
+        '''Add the arguments of an input such as [ '-ss', '1', '-t', '2',
+        '-i', 'video.mp4' ] to the command, returns the index of the
+        resulting ffmpeg input.'''
+        self.inputs.append( input_args )
+        return len( self.inputs ) - 1
+
+    def add_filter( self, filter_clause ):
+        '''Add a filter chain such as "[0:v] scale=... [v1]" to the
+        filter_complex.'''
+        self.filters.append( filter_clause )
+
+    def get_label( self, prefix ):
+        '''Returns a new unique label for a filter output.'''
+        self.label_count += 1
+        return "%s%d" % ( prefix, self.label_count )
+
+    def get_input_args( self ):
+        return [ arg for input_args in self.inputs for arg in input_args ]
+
+    def get_filter_complex( self ):
+        return " ;\n".join( self.filters )
+
+    @staticmethod
+    def get_channel_layout( channels ):
+        '''Returns the ffmpeg channel layout for a number of audio
+        channels.'''
+        if channels == 1:
+            return 'mono'
+        elif channels == 2:
+            return 'stereo'
+        else:
+            return '%dc' % ( channels )
+
+
+################################################################################
+class FFmpegJob( object ):
+    '''A single run of the ffmpeg or ffprobe commands.  All the
+    commands vedit runs go through FFmpegJob, generally by way of
+    Window.run_command.
+
+    Inputs:
+
+    - cmd - A list of arguments, or a string which is split into
+      arguments as the shell would split it.  No shell is run.
+    - timeout - Optional.  If the command has not finished after this
+      many seconds it is killed.
+    - callback - Optional.  A function which is called with this
+      FFmpegJob each time an ffmpeg command reports its progress, and
+      once more when the command finishes.
+
+    While an ffmpeg command is running, progress holds the most recent
+    progress it reported, a dictionary of the key=value pairs output
+    by ffmpeg's -progress option, such as out_time and speed.
+
+    Once finished is True, status holds the exit status of the command
+    (negative if it was killed by a signal), output holds what it
+    wrote, elapsed holds the wall clock seconds it ran for, and
+    cpu_time holds the CPU seconds it used (None where this can't be
+    measured).
+
+    '''
+
+    def __init__( self,
+                  cmd,
+                  timeout = None,
+                  callback = None ):
+
+        if isinstance( cmd, list ):
+            self.argv = cmd
+        else:
+            self.argv = shlex.split( cmd )
+
+        self.timeout = timeout
+        self.callback = callback
+
+        self.process = None
+        self.progress = {}
+        self.finished = False
+        self.exited = False
+        self.lock = threading.Lock()
+        self.timed_out = False
+        self.status = None
+        self.output = ""
+        self.elapsed = None
+        self.cpu_time = None
+
+    def get_cmd( self ):
+        '''Returns the command as it could be typed into a shell.'''
+        return FFmpegJob.quote_cmd( self.argv )
+
+    @staticmethod
+    def quote_cmd( argv ):
+        '''Returns argv, a list of arguments, as it could be typed into
+        a shell.'''
+        return " ".join( [ quote( arg ) for arg in argv ] )
+
+    def run( self ):
+        '''Run the command and wait for it to finish, returns this
+        FFmpegJob.'''
+        self.start()
+        return self.wait()
+
+    def start( self, stdin=None, stdout=None ):
+        '''Start the command without waiting for it to finish.
+
+        By default the command reads nothing from its standard input
+        and what it writes to its standard output is collected.
+        Alternatively stdin and stdout may be given to connect the
+        command to files or other commands, in which case progress is
+        not reported.
+        '''
+        argv = self.argv
+        report_progress = ( stdout is None and os.path.basename( argv[0] ) == os.path.basename( FFMPEG ) )
+        if report_progress:
+            argv = argv[:1] + [ '-progress', 'pipe:1', '-nostats' ] + argv[1:]
+
+        self.devnull = None
+        if stdin is None:
+            self.devnull = open( os.devnull, 'rb' )
+            stdin = self.devnull
+
+        self.stdout_lines = []
+        self.stderr_lines = []
+
+        self.start_time = time.time()
+        if stdout is None:
+            self.process = subprocess.Popen( argv, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE )
+        else:
+            self.process = subprocess.Popen( argv, stdin=stdin, stdout=stdout, stderr=subprocess.PIPE )
+
+        # We read standard error, and standard output if we own it, as
+        # it is written so the command never blocks on a full pipe.
+        self.readers = [ threading.Thread( target=self.read_lines, args=( self.process.stderr, self.stderr_lines ) ) ]
+        if stdout is None:
+            if report_progress:
+                self.readers.append( threading.Thread( target=self.read_progress, args=( self.process.stdout, ) ) )
+            else:
+                self.readers.append( threading.Thread( target=self.read_lines, args=( self.process.stdout, self.stdout_lines ) ) )
+        for reader in self.readers:
+            reader.daemon = True
+            reader.start()
+
+        self.timer = None
+        if self.timeout is not None:
+            self.timer = threading.Timer( self.timeout, self.kill )
+            self.timer.daemon = True
+            self.timer.start()
+
+    def wait( self ):
+        '''Wait for a started command to finish, returns this
+        FFmpegJob.'''
+        if hasattr( os, 'wait4' ) and hasattr( os, 'waitid' ):
+            # Once the command is reaped its pid may be reused, so the
+            # timer is stopped first, and kill told the command has
+            # exited, while it can still be reaped.
+            os.waitid( os.P_PID, self.process.pid, os.WEXITED | os.WNOWAIT )
+            self.stop_timer()
+            ( pid, wait_status, rusage ) = os.wait4( self.process.pid, 0 )
+            if os.WIFSIGNALED( wait_status ):
+                self.status = -os.WTERMSIG( wait_status )
+            else:
+                self.status = os.WEXITSTATUS( wait_status )
+            self.process.returncode = self.status
+            self.cpu_time = rusage.ru_utime + rusage.ru_stime
+        else:
+            self.status = self.process.wait()
+            self.stop_timer()
+
+        self.elapsed = time.time() - self.start_time
+
+        for reader in self.readers:
+            reader.join()
+        for pipe in [ self.process.stdout, self.process.stderr, self.devnull ]:
+            if pipe is not None:
+                pipe.close()
+
+        self.output = "".join( self.stdout_lines + self.stderr_lines ).rstrip( "\n" )
+        if self.timed_out:
+            self.output += "\n\nCommand was killed after running for more than %s seconds." % ( self.timeout )
+
+        if self.cpu_time is not None:
+            log.info( "Finished with status %d after %0.2f seconds using %0.2f seconds of CPU: %s" % ( self.status, self.elapsed, self.cpu_time, self.get_cmd() ) )
+        else:
+            log.info( "Finished with status %d after %0.2f seconds: %s" % ( self.status, self.elapsed, self.get_cmd() ) )
+
+        self.finished = True
+        if self.callback is not None:
+            self.callback( self )
+
+        return self
+
+    def stop_timer( self ):
+        '''Note that the command has exited, so kill leaves it alone,
+        and cancel the timer which would kill it.'''
+        with self.lock:
+            self.exited = True
+            if self.timer is not None:
+                self.timer.cancel()
+
+    def kill( self ):
+        '''Kill the command if it is still running.'''
+        with self.lock:
+            if not self.exited and self.process.returncode is None:
+                log.warn( "Killing command which has run for more than %s seconds: %s" % ( self.timeout, self.get_cmd() ) )
+                self.timed_out = True
+                try:
+                    self.process.kill()
+                except OSError:
+                    pass
+
+    def read_lines( self, pipe, lines ):
+        for line in iter( pipe.readline, b'' ):
+            lines.append( line.decode( 'utf-8', 'replace' ) )
+
+    def read_progress( self, pipe ):
+        # ffmpeg writes blocks of key=value lines, the last of which is
+        # progress=continue, or progress=end.
+        progress = {}
+        for line in iter( pipe.readline, b'' ):
+            line = line.decode( 'utf-8', 'replace' ).strip()
+            if '=' in line:
+                ( key, value ) = line.split( '=', 1 )
+                progress[key] = value
+                if key == 'progress':
+                    self.progress = progress
+                    progress = {}
+                    if self.callback is not None:
+                        self.callback( self )
+
+
+################################################################################
+class Workspace( object ):
+    '''The intermediate files written to the tmpdir by a render in
+    progress.
+
+    Inputs:
+
+    - scratch_limit - Optional.  The number of bytes the files may
+      use, beyond which add and measure raise an Exception.
+
+    Files are added before they are written, measured once they have
+    been written, and released, which deletes them, once they have
+    been used.  Files which are moved into the cache are forgotten
+    first, and so are not deleted.  usage holds the bytes the files
+    use, and peak_usage the most they have used at once.
+    '''
+
+    # The Workspace which tracks each file, so the output of a command
+    # can be measured without knowing which render it belongs to.
+    owners = {}
+    owners_lock = threading.Lock()
+
+    def __init__( self,
+                  scratch_limit = None ):
+
+        self.scratch_limit = scratch_limit
+
+        # The size of each tracked file when it was last measured.
+        self.files = {}
+        self.usage = 0
+        self.peak_usage = 0
+        self.lock = threading.Lock()
+
+    def add( self, filename ):
+        '''Track filename, which is about to be written.'''
+        with self.lock:
+            self.check_usage()
+            self.files[filename] = 0
+        with Workspace.owners_lock:
+            Workspace.owners[filename] = self
+
+    def measure( self, filename ):
+        '''Record the size of filename, which has been written, if it
+        is tracked by this Workspace.'''
+        with self.lock:
+            if filename in self.files:
+                size = Window.get_file_size( filename )
+                self.usage += size - self.files[filename]
+                self.files[filename] = size
+                self.peak_usage = max( self.peak_usage, self.usage )
+                self.check_usage()
+
+    def release( self, filename ):
+        '''Delete filename if it is tracked by this Workspace.'''
+        with self.lock:
+            if filename in self.files:
+                self.untrack( filename )
+                if os.path.exists( filename ):
+                    os.remove( filename )
+
+    def forget( self, filename ):
+        '''Stop tracking filename without deleting it, before it is
+        moved out of the Workspace.'''
+        with self.lock:
+            if filename in self.files:
+                self.untrack( filename )
+
+    def cleanup( self, keep=None ):
+        '''Delete all the tracked files, other than those in keep,
+        which are forgotten.'''
+        if keep is None:
+            keep = []
+        for filename in list( self.files ):
+            if filename in keep:
+                self.forget( filename )
+            else:
+                self.release( filename )
+
+    def untrack( self, filename ):
+        '''Internal utility function which stops tracking filename.
+        The caller must hold lock.
+        '''
+        self.usage -= self.files.pop( filename )
+        with Workspace.owners_lock:
+            if Workspace.owners.get( filename ) is self:
+                del Workspace.owners[filename]
+
+    def check_usage( self ):
+        '''Internal utility function which raises an Exception if the
+        tracked files use more than scratch_limit bytes.  The caller
+        must hold lock.
+        '''
+        if self.scratch_limit is not None and self.usage > self.scratch_limit:
+            raise Exception( "Intermediate files are using %d bytes in %s, which exceeds the scratch_limit of %d bytes." % ( self.usage, Window.tmpdir, self.scratch_limit ) )
+
+    @staticmethod
+    def measure_output( filename ):
+        '''Record the size of filename, which a command has written,
+        in the Workspace which tracks it, if any.'''
+        with Workspace.owners_lock:
+            workspace = Workspace.owners.get( filename )
+        if workspace is not None:
+            workspace.measure( filename )
+
+
+################################################################################
+class FarmQueue( object ):
+    '''A queue of commands in a directory, through which a render hands
+    its ffmpeg commands to worker processes when
+    Window.set_render_farm( True ) has been called.  The directory is
+    in the tmpdir, so workers on any machine which shares the tmpdir,
+    for example over NFS, can take part, provided the input files of
+    the render are at the same paths there.
+
+    Inputs:
+
+    - path - The directory of the queue, which is created if needed.
+
+    Each command is a JSON file, which is written to the pending
+    directory under a temporary name and then renamed into place.  A
+    worker claims a command by renaming its file into the claimed
+    directory, which only one worker can do, and when it has run it
+    writes the result to the done directory the same way.  No locks
+    are needed, only a filesystem on which rename is atomic.
+
+    While a worker runs a command it renews its claim by touching the
+    claimed file.  If the claim isn't renewed for lease_duration
+    seconds the worker is presumed dead and the command is returned
+    to pending for another worker.  A render gives up on a command,
+    and withdraws it from the queue, if no worker claims it within
+    claim_timeout seconds, if it doesn't finish within its timeout
+    and deadline_slack seconds of being claimed, or if it has been
+    claimed max_attempts times without finishing.
+
+    '''
+
+    # The name of the queue directory in the tmpdir.
+    queue_dir = 'farm'
+
+    # How many seconds to wait between looking for new commands and
+    # results.
+    poll_interval = 0.2
+
+    # How many seconds a claim lasts without being renewed.  Workers
+    # renew their claims four times as often as this.
+    lease_duration = 60
+
+    # How many times a command may be claimed by workers which die
+    # before it is given up on.
+    max_attempts = 3
+
+    # How many seconds a command may wait to be claimed.
+    claim_timeout = 600
+
+    # How many seconds beyond the timeout of a claimed command to wait
+    # for its result.
+    deadline_slack = 60
+
+    def __init__( self,
+                  path ):
+
+        self.path = path
+
+        for subdir in [ 'pending', 'claimed', 'done' ]:
+            directory = "%s/%s" % ( path, subdir )
+            if not os.path.isdir( directory ):
+                try:
+                    os.makedirs( directory )
+                except OSError:
+                    # Another process created it first.
+                    if not os.path.isdir( directory ):
+                        raise
+
+    def write( self, subdir, job_id, contents ):
+        '''Atomically write contents as JSON to job_id in subdir.'''
+        tmpfile = "%s/%s/.%s.%s" % ( self.path, subdir, job_id, str( uuid.uuid4() ) )
+        f = open( tmpfile, 'w' )
+        json.dump( contents, f )
+        f.close()
+        os.rename( tmpfile, "%s/%s/%s" % ( self.path, subdir, job_id ) )
+
+    def submit( self, argv, timeout=None ):
+        '''Add the command argv to the queue, and return its job_id.
+        Commands are claimed in the order they were submitted.'''
+        job_id = "%017.6f-%s.json" % ( time.time(), str( uuid.uuid4() ) )
+        self.write( 'pending', job_id, { 'argv'    : argv,
+                                         'timeout' : timeout } )
+        return job_id
+
+    def wait( self, job_id, timeout=None ):
+        '''Wait for the command job_id, which was submitted with
+        timeout, to be run, and return its result, a dictionary with
+        the status and output of the command, and the host and pid of
+        the worker which ran it.
+
+        If the command is given up on as described above, it is
+        withdrawn from the queue and the result has a status of -1,
+        an output explaining why, and no host or pid.
+        '''
+        done_file = "%s/done/%s" % ( self.path, job_id )
+        claimed_file = "%s/claimed/%s" % ( self.path, job_id )
+
+        attempts = 0
+        # When the command was last put in pending, when it was
+        # claimed, and the modification time of the claimed file and
+        # when we first saw it, all in our own clock so we don't
+        # depend on the clock of a file server.
+        pending_since = time.time()
+        claimed_since = None
+        lease = None
+        while not os.path.exists( done_file ):
+            now = time.time()
+            try:
+                mtime = os.stat( claimed_file ).st_mtime
+            except OSError:
+                mtime = None
+
+            error = None
+            if mtime is None:
+                if claimed_since is not None:
+                    # It was returned to pending, or has just finished.
+                    ( pending_since, claimed_since, lease ) = ( now, None, None )
+                elif now - pending_since > FarmQueue.claim_timeout:
+                    error = "No farm worker claimed the command within %s seconds." % ( FarmQueue.claim_timeout )
+            else:
+                if claimed_since is None:
+                    claimed_since = now
+                    attempts += 1
+                if lease is None or lease[0] != mtime:
+                    lease = ( mtime, now )
+
+                if timeout is not None and now - claimed_since > timeout + FarmQueue.deadline_slack:
+                    error = "The farm worker running the command did not finish it within %s seconds." % ( timeout + FarmQueue.deadline_slack )
+                elif now - lease[1] > FarmQueue.lease_duration:
+                    if attempts >= FarmQueue.max_attempts:
+                        error = "The command was claimed %d times by farm workers which stopped renewing their claims." % ( attempts )
+                    else:
+                        log.warn( "Farm worker stopped renewing its claim on %s, returning it to the queue." % ( job_id ) )
+                        try:
+                            os.rename( claimed_file, "%s/pending/%s" % ( self.path, job_id ) )
+                        except OSError:
+                            # It finished after all.
+                            pass
+                        ( pending_since, claimed_since, lease ) = ( now, None, None )
+
+            if error is not None:
+                self.withdraw( job_id )
+                return { 'status' : -1,
+                         'output' : "Farm job %s failed: %s" % ( job_id, error ),
+                         'host'   : None,
+                         'pid'    : None }
+
+            time.sleep( FarmQueue.poll_interval )
+
+        f = open( done_file )
+        result = json.load( f )
+        f.close()
+        os.remove( done_file )
+        return result
+
+    def withdraw( self, job_id ):
+        '''Remove the command job_id from the queue, whether it is
+        pending or claimed.  A worker running it will find its claim
+        gone, and its result is discarded.'''
+        for subdir in [ 'pending', 'claimed', 'done' ]:
+            try:
+                os.remove( "%s/%s/%s" % ( self.path, subdir, job_id ) )
+            except OSError:
+                pass
+
+    def run( self, argv, timeout=None ):
+        '''Have a worker run argv, and return a ( status, output )
+        tuple as for Window.run_command.'''
+        job_id = self.submit( argv, timeout=timeout )
+        log.info( "Submitted to farm as %s: %s" % ( job_id, " ".join( [ quote( arg ) for arg in argv ] ) ) )
+        result = self.wait( job_id, timeout=timeout )
+        log.info( "Farm job %s finished with status %d on %s." % ( job_id, result['status'], result['host'] ) )
+        return ( result['status'], result['output'] )
+
+    def claim( self ):
+        '''Claim the oldest pending command.  Returns a ( job_id, job )
+        tuple, or None if no commands are pending.'''
+        for job_id in sorted( os.listdir( "%s/pending" % ( self.path ) ) ):
+            if job_id.startswith( '.' ):
+                continue
+            claimed_file = "%s/claimed/%s" % ( self.path, job_id )
+            try:
+                os.rename( "%s/pending/%s" % ( self.path, job_id ), claimed_file )
+            except OSError:
+                # Another worker claimed it.
+                continue
+            f = open( claimed_file )
+            job = json.load( f )
+            f.close()
+            return ( job_id, job )
+        return None
+
+    def renew( self, job_id ):
+        '''Renew the claim on the command job_id.  Returns False if the
+        claim has been withdrawn or returned to pending.'''
+        try:
+            os.utime( "%s/claimed/%s" % ( self.path, job_id ), None )
+            return True
+        except OSError:
+            return False
+
+    def finish( self, job_id, status, output ):
+        '''Record the result of the claimed command job_id, unless the
+        claim has been withdrawn or returned to pending.'''
+        if not os.path.exists( "%s/claimed/%s" % ( self.path, job_id ) ):
+            log.warn( "Claim on farm job %s was lost, discarding its result." % ( job_id ) )
+            return
+        self.write( 'done', job_id, { 'status' : status,
+                                      'output' : output,
+                                      'host'   : socket.gethostname(),
+                                      'pid'    : os.getpid() } )
+        try:
+            os.remove( "%s/claimed/%s" % ( self.path, job_id ) )
+        except OSError:
+            pass
+
+
+################################################################################
+class Scheduler( object ):
+    '''Internal helper which runs the graph of tasks that renders a
+    Window.
+
+    Inputs:
+
+    - max_workers - The most tasks which may run at once.
+    - dry_run - Defaults to False.  If True the graph is only laid
+      out to be inspected, as by Window.plan, and can't be run, and
+      the code adding tasks looks in the cache without recording the
+      access.
+
+    Each task is a function which is called once all the tasks it
+    depends on have finished, and which can find their results in
+    their 'result' entries.  Of the tasks which are ready to run,
+    those with the most estimated work along the chain of tasks
+    which depend on them are started first, so the longest chains
+    through the graph are not left until last.
+
+    If a task raises an Exception no more tasks are started, and run
+    raises it once the running tasks have finished.
+
+    '''
+
+    def __init__( self,
+                  max_workers = 1,
+                  dry_run = False ):
+
+        self.max_workers = max( 1, max_workers )
+        self.dry_run = dry_run
+
+        self.tasks = []
+        self.keys = {}
+
+        self.condition = threading.Condition()
+        self.ready = []
+        self.running = 0
+        self.finished = 0
+        self.error = None
+
+    def add( self, func, depends=None, cost=0, name="", key=None, cached=False ):
+        '''Add a task which calls func once the tasks in depends have
+        finished, and returns it.  cost is an estimate of the work it
+        does, and cached is True if it only returns a file from the
+        cache.  If key is given and a task with the same key has been
+        added, that task is returned instead.
+        '''
+        if key is not None and key in self.keys:
+            return self.keys[key]
+
+        # A task may be listed more than once, as when identical clips
+        # share one task.
+        unique = []
+        for dep in depends or []:
+            if dep['id'] not in [ other['id'] for other in unique ]:
+                unique.append( dep )
+        depends = unique
+
+        task = { 'id'         : len( self.tasks ),
+                 'name'       : name,
+                 'func'       : func,
+                 'depends'    : depends,
+                 'dependents' : [],
+                 'waiting'    : len( depends ),
+                 'cost'       : cost,
+                 'priority'   : cost,
+                 'cached'     : cached,
+                 'result'     : None }
+        for dep in depends:
+            dep['dependents'].append( task )
+        self.tasks.append( task )
+
+        if key is not None:
+            self.keys[key] = task
+        return task
+
+    def get( self, key ):
+        '''Returns the task added with key, or None.'''
+        return self.keys.get( key, None )
+
+    def run( self ):
+        '''Run all the tasks, and wait for them to finish.'''
+        if self.dry_run:
+            raise Exception( "A dry run Scheduler can't be run." )
+
+        # Tasks only depend on tasks added before them, so working
+        # backwards each task's dependents already have their
+        # priorities.
+        for task in reversed( self.tasks ):
+            if len( task['dependents'] ):
+                task['priority'] = task['cost'] + max( [ dependent['priority'] for dependent in task['dependents'] ] )
+
+        for task in self.tasks:
+            if task['waiting'] == 0:
+                heapq.heappush( self.ready, ( -task['priority'], task['id'] ) )
+
+        workers = [ threading.Thread( target=self.work ) for i in range( min( self.max_workers, len( self.tasks ) ) ) ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        if self.error is not None:
+            raise self.error
+
+    def work( self ):
+        '''Run ready tasks until there are none left to run.'''
+        while True:
+            with self.condition:
+                while len( self.ready ) == 0 and self.error is None and self.finished + self.running < len( self.tasks ):
+                    self.condition.wait()
+                if len( self.ready ) == 0 or self.error is not None:
+                    self.condition.notify_all()
+                    return
+                ( priority, idx ) = heapq.heappop( self.ready )
+                task = self.tasks[idx]
+                self.running += 1
+
+            try:
+                log.debug( "Starting task: %s" % ( task['name'] ) )
+                task['result'] = task['func']()
+                error = None
+            except Exception as e:
+                error = e
+
+            with self.condition:
+                self.running -= 1
+                self.finished += 1
+                if error is not None:
+                    if self.error is None:
+                        self.error = error
+                else:
+                    for dependent in task['dependents']:
+                        dependent['waiting'] -= 1
+                        if dependent['waiting'] == 0:
+                            heapq.heappush( self.ready, ( -dependent['priority'], dependent['id'] ) )
+                self.condition.notify_all()
+
+
+################################################################################
+class RenderPlan( object ):
+    '''The tasks rendering a Window would run, as returned by
+    Window.plan.
+
+    jobs is a list of dictionaries, one for each task of the graph
+    render would run, in the order they were added to it, with:
+
+    - id - The index of the job in jobs.
+    - name - A description of the job.
+    - depends - The ids of the jobs which must finish before this
+      one can start.
+    - pixel_seconds - An estimate of the work the job does, the
+      width times height times duration of the video it encodes, for
+      each time it encodes it, or 0 if it is cached or copies the
+      video without re-encoding.
+    - cached - True if the job only takes its output from the cache.
+
+    windows is a list of dictionaries of the settings each Window
+    would be rendered with, with the window itself, and its width,
+    height, duration, sample_aspect_ratio, pix_fmt, and
+    audio_channels.
+
+    '''
+
+    def __init__( self ):
+        self.jobs = []
+        self.windows = []
+
+    def add_window( self, window, audio_channels ):
+        '''Record the settings window would be rendered with.'''
+        self.windows.append( { 'window'              : window,
+                               'width'               : window.width,
+                               'height'              : window.height,
+                               'duration'            : window.duration,
+                               'sample_aspect_ratio' : window.sample_aspect_ratio,
+                               'pix_fmt'             : window.pix_fmt,
+                               'audio_channels'      : audio_channels } )
+
+    def add_tasks( self, tasks ):
+        '''Add a job for each of the tasks of a Scheduler.'''
+        for task in tasks:
+            self.jobs.append( { 'id'            : task['id'],
+                                'name'          : task['name'],
+                                'depends'       : [ dep['id'] for dep in task['depends'] ],
+                                'pixel_seconds' : task['cost'],
+                                'cached'        : task['cached'] } )
+
+    def get_pixel_seconds( self ):
+        '''Returns the estimated work of all the jobs which would run.'''
+        return sum( [ job['pixel_seconds'] for job in self.jobs ] )
+
+    def get_cache_hits( self ):
+        '''Returns the list of jobs satisfied from the cache.'''
+        return [ job for job in self.jobs if job['cached'] ]
+
+    def get_critical_path( self ):
+        '''Returns the list of jobs, in order, along the chain of
+        dependent jobs with the most estimated work, which bounds how
+        quickly the render could finish however many jobs are run at
+        once.'''
+        # Jobs only depend on jobs added before them, so we can find
+        # the heaviest chain ending at each job in one pass.
+        costs = []
+        prior = []
+        for job in self.jobs:
+            best = None
+            for dep in job['depends']:
+                if best is None or costs[dep] > costs[best]:
+                    best = dep
+            cost = job['pixel_seconds']
+            if best is not None:
+                cost += costs[best]
+            costs.append( cost )
+            prior.append( best )
+
+        if len( self.jobs ) == 0:
+            return []
+
+        path = []
+        idx = max( range( len( self.jobs ) ), key=lambda x: costs[x] )
+        while idx is not None:
+            path.append( self.jobs[idx] )
+            idx = prior[idx]
+        path.reverse()
+        return path
+
+
 ######################################################################
 ######################################################################
 ######################################################################
@@ -1664,7 +5620,67 @@ class Watermark( object ):
 ######################################################################
 
 ######################################################################
-def distribute_clips( clips, windows, min_duration=None, randomize_clips=False ):
+def run_farm_worker( tmpdir=None, max_jobs=None, idle_timeout=None ):
+    '''Run ffmpeg commands from the FarmQueue in tmpdir, which
+    defaults to Window.tmpdir, on behalf of renders which have called
+    Window.set_render_farm( True ).  Any number of workers may be
+    run, on any machines which share the tmpdir.
+
+    Inputs:
+
+    - tmpdir - Optional.  The tmpdir of the renders to work for.
+    - max_jobs - Optional.  Return after running this many commands.
+    - idle_timeout - Optional.  Return after this many seconds with
+      no commands to run.
+
+    By default the worker runs until it is killed.  Commands are run
+    with the timeout they were submitted with.  Returns the number of
+    commands run.
+    '''
+    if tmpdir is None:
+        tmpdir = Window.tmpdir
+    queue = FarmQueue( "%s/%s" % ( tmpdir, FarmQueue.queue_dir ) )
+
+    jobs = 0
+    idle_since = time.time()
+    while max_jobs is None or jobs < max_jobs:
+        claimed = queue.claim()
+        if claimed is None:
+            if idle_timeout is not None and time.time() - idle_since > idle_timeout:
+                break
+            time.sleep( FarmQueue.poll_interval )
+            continue
+
+        ( job_id, job ) = claimed
+        log.info( "Running farm job %s" % ( job_id ) )
+
+        # Renew our claim while the command runs.
+        finished = threading.Event()
+        def renew_claim():
+            while not finished.wait( FarmQueue.lease_duration / 4.0 ):
+                if not queue.renew( job_id ):
+                    break
+        renewer = threading.Thread( target=renew_claim )
+        renewer.daemon = True
+        renewer.start()
+
+        try:
+            ffmpeg_job = FFmpegJob( job['argv'], timeout=job['timeout'], callback=Window.job_callback ).run()
+            ( status, output ) = ( ffmpeg_job.status, ffmpeg_job.output )
+        except Exception as e:
+            ( status, output ) = ( -1, "Error running farm job: %s" % ( e ) )
+        finally:
+            finished.set()
+            renewer.join()
+        queue.finish( job_id, status, output )
+
+        jobs += 1
+        idle_since = time.time()
+
+    return jobs
+
+######################################################################
+def distribute_clips( clips, windows, min_duration=None, randomize_clips=False, seed=None ):
     '''Utility function for creating collage videos of a set of clips.
 
     Input/Output parameters: 
@@ -1689,6 +5705,8 @@ def distribute_clips( clips, windows, min_duration=None, randomize_clips=False )
     - randomize_clips - If true the input clips array will have it's
       contents randomized prior to being distributed, otherwise the
       resulting clips will be shown in order.
+    - seed - Optional.  If set along with randomize_clips, the clips
+      are randomized the same way each time for a given seed.
 
     The main idea is that a set of "windows" will be defined, such as
     this: ::
@@ -1734,6 +5752,11 @@ def distribute_clips( clips, windows, min_duration=None, randomize_clips=False )
     if len( clips ) == 0:
         return
 
+    if seed is not None:
+        rng = random.Random( seed )
+    else:
+        rng = random
+
     window_stats = []
     for window in windows:
         ar = float( window.width ) / window.height
@@ -1746,7 +5769,7 @@ def distribute_clips( clips, windows, min_duration=None, randomize_clips=False )
     # things.
     def add_clips_helper():
         if randomize_clips:
-            random.shuffle( clips )
+            rng.shuffle( clips )
 
         for clip in clips:
             ar = float( clip.video.width ) / clip.video.height
@@ -1822,21 +5845,21 @@ def gen_background_video( duration,
         width = bgimage_info.width
         height = bgimage_info.height
 
-    if output_file is None:
-        w = Window( duration     = duration,
-                    width        = width,
-                    height       = height,
-                    bgcolor      = bgcolor,
-                    bgimage_file = bgimage_file )
-    else:
-        w = Window( duration     = duration,
-                    width        = width,
-                    height       = height,
-                    bgcolor      = bgcolor,
-                    bgimage_file = bgimage_file,
-                    output_file  = output_file )
-
-    return w.render()
+    w = Window( duration     = duration,
+                width        = width,
+                height       = height,
+                bgcolor      = bgcolor,
+                bgimage_file = bgimage_file )
+
+    # There is nothing but background to render, so we skip the rest
+    # of rendering.
+    ( audio_channels, sar_clause ) = w.resolve_render_settings()
+    background_file = w.render_background( audio_channels, sar_clause, final=True )
+
+    if output_file is not None:
+        shutil.copyfile( background_file, output_file )
+
+    return background_file
 
 if __name__ == '__main__':
     ''' Example usage: